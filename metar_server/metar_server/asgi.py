@@ -2,6 +2,10 @@
 ASGI config for metar_server project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+The Server-Sent Events of new METARs (/metarapp/stream/) are served by
+MetarStreamApp, and the other paths by the WSGI application of Django in the
+threads of METAR_WSGI_THREADS. The 'web' process of the Procfile runs this
+entry point with the workers of uvicorn.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
@@ -9,8 +13,17 @@ https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+from django.conf import settings
+from django.core.wsgi import get_wsgi_application
+from uvicorn.middleware.wsgi import WSGIMiddleware
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'metar_server.settings')
 
-application = get_asgi_application()
+django_application = get_wsgi_application()
+
+from metarapp import streaming  # noqa: E402
+
+application = streaming.route(WSGIMiddleware(
+    streaming.close_response(django_application),
+    workers=getattr(settings, 'METAR_WSGI_THREADS', 10)
+))
@@ -43,6 +43,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'metarapp.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -57,7 +58,7 @@ ROOT_URLCONF = 'metar_server.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'metarapp.template_backends.TimedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -134,6 +135,76 @@ SESSION_COOKIE_AGE = 1800
 
 SESSION_SAVE_EVERY_REQUEST = True
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000
+        }
+    },
+    # Shared by all processes, so that the invalidation by the ingest reaches
+    # the web workers. Create the table by 'manage.py createcachetable'.
+    'metar': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'metar_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000
+        }
+    }
+}
+
+# Cache of the searched METARs by station and local day.
+METAR_CACHE_ALIAS = 'metar'
+# Days closed longer than this (seconds) are cached with the long timeout.
+METAR_CACHE_CLOSED_MARGIN = 6 * 3600
+METAR_CACHE_CLOSED_TIMEOUT = 7 * 24 * 3600
+METAR_CACHE_OPEN_TIMEOUT = 60
+
+# Minimums of the rollups. The rollups should be rebuilt after changing them.
+METAR_CEILING_MINIMUM_FT = 1000
+METAR_VISIBILITY_MINIMUM_M = 5000
+
+# Directory of the archive files of old METARs (archiveMetar command).
+METAR_ARCHIVE_DIR = os.environ.get('METAR_ARCHIVE_DIR', os.path.join(BASE_DIR, 'metar_archive'))
+
+# The number of threads running the fetch jobs from the admin page.
+METAR_JOB_WORKERS = 2
+# Running jobs started longer ago than this (seconds) are run again by
+# runFetchJobs, since their worker is regarded as dead.
+METAR_JOB_STALE_TIMEOUT = 3600
+
+# Dotted path of the MetarWriter class. If it is empty, COPY is used on
+# PostgreSQL and bulk_create on the other databases.
+METAR_WRITER = ''
+# 'keep', 'correction' (corrected reports replace the stored ones) or
+# 'replace' (any different report replaces the stored one).
+METAR_CORRECTION_POLICY = 'correction'
+
+# Seconds the airport registry is cached in each process. Saves in this
+# process invalidate it at once.
+METAR_AIRPORT_REGISTRY_TIMEOUT = 300
+
+# Sampled requests slower than this (seconds) are logged with their SQL.
+METAR_SLOW_REQUEST_SECONDS = 1.0
+METAR_SLOW_REQUEST_SAMPLE_RATE = 0.1
+METAR_SLOW_REQUEST_MAX_QUERIES = 50
+
+# Threads of a web worker running the views of Django on the ASGI entry point.
+METAR_WSGI_THREADS = 10
+
+# Server-Sent Events of new METARs on the ASGI entry point (the 'web'
+# process of the Procfile). New METARs are notified on this channel on
+# PostgreSQL and polled on the other databases.
+METAR_STREAM_CHANNEL = 'metar_inserted'
+METAR_STREAM_POLL_SECONDS = 5.0
+METAR_STREAM_HEARTBEAT_SECONDS = 15.0
+# METARs queued for a subscriber before its connection is closed.
+METAR_STREAM_QUEUE_SIZE = 100
+
+# Seconds until the latest METAR store of each process reads the METARs
+# written by the other processes.
+METAR_LATEST_REFRESH_SECONDS = 60
+
 try:
     from .local_settings import *
 except ImportError:
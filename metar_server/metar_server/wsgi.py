@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'metar_server.settings')
 
 application = get_wsgi_application()
+
+from metarapp.myfunction import latest_function  # noqa: E402
+
+latest_function.warm_store()
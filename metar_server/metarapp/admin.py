@@ -1,10 +1,11 @@
 from __future__ import annotations
 from django.contrib import admin
+from django.http import HttpResponseRedirect
 from django.shortcuts import render
 from django.urls import path, URLPattern
 from .forms import GetMetarNowForm
-from .models import Airport, Metar
-from .myfunction import airport_function, metar_function
+from .models import Airport, FetchJob, Metar
+from .myfunction import airport_function, cache_function, job_function
 
 
 @admin.register(Metar)
@@ -21,34 +22,50 @@ class MetarAdmin(admin.ModelAdmin):
         return my_urls + urls
 
     def metar_manage_view(self, request):
+        # The choices of the form are the fetched airports of the registry.
+        if (request.method == 'POST'):
+            form = GetMetarNowForm(airport_function.get_airport_list(), request.POST)
+            if form.is_valid():
+                fetch_airport: list[str] = form.cleaned_data['airport']
+                job = job_function.enqueue_fetch_job(fetch_airport)
+                self.message_user(request, f'The fetch job {job.id} is queued. The status is shown in the job table.')
+                # Reloading the redirected page does not queue the job again.
+                return HttpResponseRedirect(request.path)
+        else:
+            form = GetMetarNowForm(airport_function.get_airport_list())
         airport_metar_newest = airport_function.AirportMetarNewest()
         params = {
             'newest_datetimes': airport_metar_newest.newest_dict,
-            'form': GetMetarNowForm(airport_metar_newest.airport_list),
-            'get_metar_response': ''
+            'form': form,
+            'cache_stats': cache_function.stats.as_dict(),
+            'jobs': job_function.get_recent_jobs()
         }
-        if (request.method == 'POST'):
-            fetch_airport: list[str] = request.POST.getlist('airport')
-            get_metar = metar_function.MetarInput(fetch_airport)
-            get_metar.fetch_and_save()
-            metar_num_dict: dict[str: int] = {}
-            for metar in get_metar.fetched_data:
-                if metar.station_id in metar_num_dict:
-                    metar_num_dict[metar.station_id] += 1
-                else:
-                    metar_num_dict[metar.station_id] = 1
-            metar_all_num = 0
-            for station in metar_num_dict:
-                metar_all_num += metar_num_dict[station]
-            fetched_time = get_metar.fetched_time.strftime(r"%Y %b %d %X %Z")
-            params['get_metar_response'] = [
-                'The METARs are fetched.',
-                'The number of the METAR data in each airport:',
-                str(metar_num_dict),
-                f'The total number: {metar_all_num}',
-                f'fetched datetime: {fetched_time}'
-            ]
         return render(request, 'admin/metarapp/metar/metar_manage_view.html', params)
 
 
-admin.site.register(Airport)
+@admin.register(FetchJob)
+class FetchJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'status', 'created_at', 'duration', 'inserted_count', 'duplicate_count')
+    list_filter = ('status',)
+
+
+@admin.register(Airport)
+class AirportAdmin(admin.ModelAdmin):
+    list_display = ('station_id', 'name', 'is_fetched', 'latitude', 'longitude', 'elevation_ft', 'timezone')
+    list_filter = ('is_fetched',)
+    search_fields = ('station_id', 'name')
+    actions = ('start_fetching', 'stop_fetching')
+
+    @admin.action(description='Fetch METARs of the selected airports')
+    def start_fetching(self, request, queryset):
+        self.__set_fetched(request, queryset, True)
+
+    @admin.action(description='Stop fetching METARs of the selected airports')
+    def stop_fetching(self, request, queryset):
+        self.__set_fetched(request, queryset, False)
+
+    def __set_fetched(self, request, queryset, is_fetched: bool) -> None:
+        count = queryset.update(is_fetched=is_fetched)
+        # update() does not send the signals.
+        airport_function.invalidate_registry()
+        self.message_user(request, '%s airports are updated.' % count)
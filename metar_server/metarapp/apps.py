@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class MetarappConfig(AppConfig):
     name = 'metarapp'
+
+    def ready(self):
+        from . import receivers  # noqa: F401
@@ -1,8 +1,12 @@
 from __future__ import annotations
 import re
+from datetime import datetime, timedelta
+from typing import Optional
 from django import forms
 from django.contrib.auth.forms import AuthenticationForm
+from django.utils import timezone
 from .models import Metar
+from .myfunction import airport_function, analytics_function, chart_function, condition_function, search_function
 
 
 class MyLoginForm(AuthenticationForm):
@@ -14,8 +18,9 @@ class MyLoginForm(AuthenticationForm):
 
 
 class MetarAppForm(forms.Form):
+    STATION_SEPARATOR_RE = r'[\s,]+'
     icao = forms.CharField(
-        label='空港コード（RJ__）',
+        label='空港コード（RJ__、複数はカンマ区切り）',
         widget=forms.TextInput(
             attrs={'class': 'form-control'}
         )
@@ -27,6 +32,14 @@ class MetarAppForm(forms.Form):
             attrs={'class': 'form-control flatpickr'}
         )
     )
+    end_date = forms.DateTimeField(
+        input_formats=[r'%Y-%m-%d'],
+        label='終了日（省略時は一日分）',
+        required=False,
+        widget=forms.DateTimeInput(
+            attrs={'class': 'form-control flatpickr'}
+        )
+    )
     metar_order = forms.ChoiceField(
         label='METAR並び順（時間）',
         choices=[
@@ -37,16 +50,329 @@ class MetarAppForm(forms.Form):
     )
 
     def clean(self) -> dict[str, any]:
+        """Validate the inputs and add 'stations' to cleaned_data.
+
+        'stations' is the list of ICAO ids split from 'icao', and 'end_date'
+        is the same as 'search_date' if it is not given.
+        """
         cleaned_data = super().clean()
-        cleaned_icao = cleaned_data.get('icao')
-        if not re.search(Metar.STATION_ID_RE, cleaned_icao):
+        cleaned_icao = cleaned_data.get('icao') or ''
+        stations = [icao for icao in re.split(self.STATION_SEPARATOR_RE, cleaned_icao.upper()) if icao]
+        if not stations or not all(re.fullmatch(Metar.STATION_ID_RE, icao) for icao in stations):
             raise forms.ValidationError('ICAO ID "RJ__"を入力してください')
+        cleaned_data['stations'] = stations
         cleaned_search_date = cleaned_data.get('search_date')
         if not cleaned_search_date:
             raise forms.ValidationError('日付を入力してください')
+        cleaned_end_date = cleaned_data.get('end_date') or cleaned_search_date
+        if cleaned_end_date < cleaned_search_date:
+            raise forms.ValidationError('終了日は日付以降を入力してください')
+        cleaned_data['end_date'] = cleaned_end_date
         return cleaned_data
 
 
+class MetarApiForm(forms.Form):
+    """Query parameters of the METAR API.
+
+    'start' and 'end' are ISO 8601 datetimes or dates. 'end' is now and
+    'start' is a day before 'end' if they are not given. 'derived' is the
+    keys of analytics_function.DERIVED_FIELDS, and the wind components need
+    the heading 'runway'. 'near' is 'latitude,longitude', and the airports
+    within 'radius_km' of it are added to 'stations'.
+    """
+    FORMAT_CHOICES = [
+        ('json', 'json'),
+        ('ndjson', 'ndjson')
+    ]
+    DEFAULT_LIMIT = 500
+    MAX_LIMIT = 5000
+    DEFAULT_RADIUS_KM = 100.0
+    MAX_RADIUS_KM = 1000.0
+    MAX_NEAR_STATIONS = 100
+    stations = forms.CharField(required=False)
+    start = forms.DateTimeField(required=False)
+    end = forms.DateTimeField(required=False)
+    fields = forms.CharField(required=False)
+    limit = forms.IntegerField(required=False, min_value=1, max_value=MAX_LIMIT)
+    after = forms.CharField(required=False)
+    format = forms.ChoiceField(required=False, choices=FORMAT_CHOICES)
+    derived = forms.CharField(required=False)
+    runway = forms.IntegerField(required=False, min_value=0, max_value=360)
+    elevation_ft = forms.FloatField(required=False)
+    near = forms.CharField(required=False)
+    radius_km = forms.FloatField(required=False, min_value=0.0, max_value=MAX_RADIUS_KM)
+
+    def __init__(self, field_names: list[str], *args, **kwargs) -> None:
+        """Set the field names which can be selected by 'fields'.
+
+        Other arguments are for super().__init__()
+
+        Args:
+            field_names (list[str]): Selectable field names of Metar.
+        """
+        super().__init__(*args, **kwargs)
+        self.field_names = field_names
+
+    def clean_stations(self) -> list[str]:
+        if not self.cleaned_data['stations']:
+            return []
+        return _clean_stations(self.cleaned_data['stations'])
+
+    def clean_near(self) -> Optional[tuple[float, float]]:
+        if not self.cleaned_data['near']:
+            return None
+        try:
+            latitude, longitude = map(float, self.cleaned_data['near'].split(','))
+        except ValueError:
+            raise forms.ValidationError('Enter "latitude,longitude".')
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise forms.ValidationError('The coordinates are out of range.')
+        return latitude, longitude
+
+    def clean_fields(self) -> list[str]:
+        fields = [name for name in self.cleaned_data['fields'].split(',') if name]
+        if not fields:
+            return self.field_names
+        unknown = [name for name in fields if name not in self.field_names]
+        if unknown:
+            raise forms.ValidationError('Unknown fields: %s' % ', '.join(unknown))
+        return fields
+
+    def clean_derived(self) -> list[str]:
+        derived = [name for name in self.cleaned_data['derived'].split(',') if name]
+        unknown = [name for name in derived if name not in analytics_function.DERIVED_FIELDS]
+        if unknown:
+            raise forms.ValidationError('Unknown derived quantities: %s' % ', '.join(unknown))
+        return derived
+
+    def clean_after(self) -> Optional[tuple[datetime, int]]:
+        if not self.cleaned_data['after']:
+            return None
+        try:
+            return search_function.decode_cursor(self.cleaned_data['after'])
+        except ValueError as e:
+            raise forms.ValidationError(str(e))
+
+    def clean(self) -> dict[str, any]:
+        cleaned_data = super().clean()
+        if cleaned_data.get('near') is not None:
+            radius_km = cleaned_data.get('radius_km')
+            near_list = airport_function.get_registry().within(
+                *cleaned_data['near'],
+                self.DEFAULT_RADIUS_KM if radius_km is None else radius_km
+            )
+            if len(near_list) > self.MAX_NEAR_STATIONS:
+                raise forms.ValidationError(
+                    'More than %s airports are within "radius_km".' % self.MAX_NEAR_STATIONS
+                )
+            stations = cleaned_data.get('stations') or []
+            cleaned_data['stations'] = stations + [
+                airport.station_id for _, airport in near_list if airport.station_id not in stations
+            ]
+        if 'stations' in cleaned_data and not cleaned_data['stations'] and not self.has_error('near'):
+            self.add_error('stations', 'Enter "stations" or "near".')
+            return cleaned_data
+        cleaned_data['end'] = cleaned_data.get('end') or timezone.now()
+        cleaned_data['start'] = cleaned_data.get('start') or cleaned_data['end'] - timedelta(days=1)
+        if cleaned_data['end'] <= cleaned_data['start']:
+            raise forms.ValidationError('"end" must be after "start".')
+        cleaned_data['format'] = cleaned_data.get('format') or 'json'
+        if cleaned_data.get('runway') is None and \
+                set(cleaned_data.get('derived') or []) & set(analytics_function.RUNWAY_FIELDS):
+            raise forms.ValidationError('"runway" is required for the wind components.')
+        cleaned_data['elevation_ft'] = cleaned_data.get('elevation_ft') or 0.0
+        return cleaned_data
+
+
+class MetarSummaryForm(forms.Form):
+    """Query parameters of the summary API.
+
+    'end' is the same as 'start' if it is not given.
+    """
+    PERIOD_CHOICES = [
+        ('total', 'total'),
+        ('year', 'year'),
+        ('month', 'month'),
+        ('day', 'day')
+    ]
+    stations = forms.CharField()
+    start = forms.DateField()
+    end = forms.DateField(required=False)
+    period = forms.ChoiceField(required=False, choices=PERIOD_CHOICES)
+
+    def clean_stations(self) -> list[str]:
+        return _clean_stations(self.cleaned_data['stations'])
+
+    def clean(self) -> dict[str, any]:
+        cleaned_data = super().clean()
+        if cleaned_data.get('start') is None:
+            return cleaned_data
+        cleaned_data['end'] = cleaned_data.get('end') or cleaned_data['start']
+        if cleaned_data['end'] < cleaned_data['start']:
+            raise forms.ValidationError('"end" must not be before "start".')
+        cleaned_data['period'] = cleaned_data.get('period') or 'total'
+        return cleaned_data
+
+
+class MetarChartForm(forms.Form):
+    """Query parameters of the chart API.
+
+    'fields' are the keys of chart_function.CHART_FIELDS, all of them if it
+    is not given. 'end' is now and 'start' is a week before 'end' if they
+    are not given.
+    """
+    DEFAULT_POINTS = 500
+    MAX_POINTS = 5000
+    METHOD_CHOICES = [(method, method) for method in chart_function.METHODS]
+    station = forms.CharField()
+    start = forms.DateTimeField(required=False)
+    end = forms.DateTimeField(required=False)
+    fields = forms.CharField(required=False)
+    points = forms.IntegerField(required=False, min_value=3, max_value=MAX_POINTS)
+    method = forms.ChoiceField(required=False, choices=METHOD_CHOICES)
+
+    def clean_station(self) -> str:
+        station = self.cleaned_data['station'].upper()
+        if not re.fullmatch(Metar.STATION_ID_RE, station):
+            raise forms.ValidationError('Enter an ICAO id.')
+        return station
+
+    def clean_fields(self) -> list[str]:
+        fields = [name for name in self.cleaned_data['fields'].split(',') if name]
+        if not fields:
+            return list(chart_function.CHART_FIELDS)
+        unknown = [name for name in fields if name not in chart_function.CHART_FIELDS]
+        if unknown:
+            raise forms.ValidationError('Unknown fields: %s' % ', '.join(unknown))
+        return list(dict.fromkeys(fields))
+
+    def clean(self) -> dict[str, any]:
+        cleaned_data = super().clean()
+        cleaned_data['end'] = cleaned_data.get('end') or timezone.now()
+        cleaned_data['start'] = cleaned_data.get('start') or cleaned_data['end'] - timedelta(days=7)
+        if cleaned_data['end'] <= cleaned_data['start']:
+            raise forms.ValidationError('"end" must be after "start".')
+        cleaned_data['points'] = cleaned_data.get('points') or self.DEFAULT_POINTS
+        cleaned_data['method'] = cleaned_data.get('method') or 'minmax'
+        return cleaned_data
+
+
+class MetarConditionForm(forms.Form):
+    """Query parameters of the condition search.
+
+    '<field>_min' and '<field>_max' are the ranges of the fields of
+    condition_function.RANGE_FIELDS (included). 'wx' is the weather codes
+    (comma-separated), and METARs with any of them match. 'category' is the
+    minimum flight category. At least one condition is required. All
+    stations are searched if 'stations' is not given. 'end' is now and
+    'start' is a day before 'end' if they are not given. The archived months
+    are not searched.
+    """
+    DEFAULT_LIMIT = 200
+    MAX_LIMIT = 5000
+    CATEGORY_CHOICES = [(name, name) for name in analytics_function.FLIGHT_CATEGORIES]
+    stations = forms.CharField(
+        label='空港コード（省略時は全空港）',
+        required=False,
+        widget=forms.TextInput(attrs={'class': 'form-control'})
+    )
+    start = forms.DateTimeField(
+        label='開始日時（日本時間）',
+        required=False,
+        widget=forms.DateTimeInput(attrs={'class': 'form-control flatpickr'})
+    )
+    end = forms.DateTimeField(
+        label='終了日時（日本時間）',
+        required=False,
+        widget=forms.DateTimeInput(attrs={'class': 'form-control flatpickr'})
+    )
+    wx = forms.CharField(
+        label='天気（TS, FG, SNなど、カンマ区切り）',
+        required=False,
+        widget=forms.TextInput(attrs={'class': 'form-control'})
+    )
+    category = forms.ChoiceField(
+        label='飛行カテゴリ（以下）',
+        required=False,
+        choices=[('', '')] + CATEGORY_CHOICES,
+        widget=forms.Select(attrs={'class': 'form-select'})
+    )
+    limit = forms.IntegerField(required=False, min_value=1, max_value=MAX_LIMIT, widget=forms.HiddenInput())
+    after = forms.CharField(required=False, widget=forms.HiddenInput())
+
+    def __init__(self, *args, **kwargs) -> None:
+        """Add the fields of the ranges.
+        """
+        super().__init__(*args, **kwargs)
+        for name in condition_function.RANGE_FIELDS:
+            for suffix, label in (('_min', '最小'), ('_max', '最大')):
+                self.fields[name + suffix] = forms.FloatField(
+                    label='%s（%s）' % (name, label),
+                    required=False,
+                    widget=forms.NumberInput(attrs={'class': 'form-control'})
+                )
+
+    def clean_stations(self) -> list[str]:
+        if not self.cleaned_data['stations']:
+            return []
+        return _clean_stations(self.cleaned_data['stations'])
+
+    def clean_wx(self) -> list[str]:
+        wx_codes = [code for code in re.split(MetarAppForm.STATION_SEPARATOR_RE, self.cleaned_data['wx'].upper())
+                    if code]
+        unknown = [code for code in wx_codes if code not in condition_function.WX_BITS]
+        if unknown:
+            raise forms.ValidationError('Unknown weather codes: %s' % ', '.join(unknown))
+        return wx_codes
+
+    def clean_category(self) -> int:
+        if not self.cleaned_data['category']:
+            return 0
+        return list(analytics_function.FLIGHT_CATEGORIES).index(self.cleaned_data['category'])
+
+    def clean_after(self) -> Optional[tuple[datetime, int]]:
+        if not self.cleaned_data['after']:
+            return None
+        try:
+            return search_function.decode_cursor(self.cleaned_data['after'])
+        except ValueError as e:
+            raise forms.ValidationError(str(e))
+
+    def clean(self) -> dict[str, any]:
+        """Add 'ranges' of the given bounds to cleaned_data.
+        """
+        cleaned_data = super().clean()
+        ranges = {}
+        for name in condition_function.RANGE_FIELDS:
+            bounds = (cleaned_data.get(name + '_min'), cleaned_data.get(name + '_max'))
+            if bounds == (None, None):
+                continue
+            if None not in bounds and bounds[1] < bounds[0]:
+                raise forms.ValidationError('"%s_max" must not be less than "%s_min".' % (name, name))
+            ranges[name] = bounds
+        cleaned_data['ranges'] = ranges
+        if not ranges and not cleaned_data.get('wx') and not cleaned_data.get('category'):
+            raise forms.ValidationError('Enter a condition.')
+        cleaned_data['end'] = cleaned_data.get('end') or timezone.now()
+        cleaned_data['start'] = cleaned_data.get('start') or cleaned_data['end'] - timedelta(days=1)
+        if cleaned_data['end'] <= cleaned_data['start']:
+            raise forms.ValidationError('"end" must be after "start".')
+        cleaned_data['limit'] = cleaned_data.get('limit') or self.DEFAULT_LIMIT
+        return cleaned_data
+
+
+class MetarLatestForm(forms.Form):
+    """Query parameters of the latest METAR API. All stations if 'stations'
+    is not given.
+    """
+    stations = forms.CharField(required=False)
+
+    def clean_stations(self) -> Optional[list[str]]:
+        if not self.cleaned_data['stations']:
+            return None
+        return _clean_stations(self.cleaned_data['stations'])
+
+
 class GetMetarNowForm(forms.Form):
     airport = forms.MultipleChoiceField(
         label='Choose airport',
@@ -64,3 +390,15 @@ class GetMetarNowForm(forms.Form):
         """
         super().__init__(*args, **kwargs)
         self.fields['airport'].choices = [(id, id) for id in airport_list]
+
+
+def _clean_stations(text: str) -> list[str]:
+    """Split comma-separated ICAO ids of the API parameter.
+
+    Raises:
+        forms.ValidationError: If an id is not ICAO id.
+    """
+    stations = [icao for icao in re.split(MetarAppForm.STATION_SEPARATOR_RE, text.upper()) if icao]
+    if not stations or not all(re.fullmatch(Metar.STATION_ID_RE, icao) for icao in stations):
+        raise forms.ValidationError('Enter ICAO ids separated by commas.')
+    return stations
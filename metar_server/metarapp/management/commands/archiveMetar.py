@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandParser
+from typing import Any, Optional
+from ...myfunction import archive_function
+
+
+class Command(BaseCommand):
+    help = 'Move METARs of closed months to the archive files.'
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument(
+            '--older-than',
+            action='store',
+            type=int,
+            default=3,
+            help='Archive the months ended more than these months ago (default: 3)',
+            dest='older_than'
+        )
+        parser.add_argument(
+            '--station',
+            action='append',
+            help='ICAO id of the station to be archived (repeatable, default: all)',
+            dest='stations'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show the months without archiving them',
+            dest='dry_run'
+        )
+
+    def handle(self, *args: Any, **options: Any) -> Optional[str]:
+        """Command of archiving the closed months by station.
+
+        Returns:
+            Optional[str]: Options for inherited function.
+        """
+        stations = [station.upper() for station in options['stations']] if options['stations'] else None
+        month_list = archive_function.find_closed_months(options['older_than'], stations)
+        archived_count = 0
+        for station_id, month in month_list:
+            if options['dry_run']:
+                self.stdout.write('%s %s' % (station_id, month.strftime(r'%Y-%m')))
+                continue
+            count = archive_function.archive_month(station_id, month)
+            archived_count += count
+            self.stdout.write('Archived %s METARs of %s %s' % (count, station_id, month.strftime(r'%Y-%m')))
+        self.stdout.write('The number of the archived METARs is %s' % archived_count)
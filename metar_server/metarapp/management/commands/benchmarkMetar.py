@@ -0,0 +1,129 @@
+from __future__ import annotations
+import argparse
+import json
+import os
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from typing import Any, Optional
+from ...myfunction import benchmark_function
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the ingest, search and export paths on a test database.'
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument(
+            '--sizes',
+            action='store',
+            type=self.__valid_arg_sizes,
+            default=[10000],
+            help='Comma separated row counts of Metar, e.g. 10000,1000000 (default: 10000)',
+            dest='sizes'
+        )
+        parser.add_argument(
+            '--stations',
+            action='store',
+            type=int,
+            default=100,
+            help='The number of the synthetic stations (default: 100)',
+            dest='stations'
+        )
+        parser.add_argument(
+            '--seed',
+            action='store',
+            type=int,
+            default=0,
+            help='Seed of the synthetic data (default: 0)',
+            dest='seed'
+        )
+        parser.add_argument(
+            '--repeat',
+            action='store',
+            type=int,
+            default=20,
+            help='Repetitions of the latency benchmarks (default: 20)',
+            dest='repeat'
+        )
+        parser.add_argument(
+            '--output',
+            action='store',
+            help='JSON file the results are written to',
+            dest='output'
+        )
+        parser.add_argument(
+            '--baseline',
+            action='store',
+            help='JSON file of the baseline results to be compared',
+            dest='baseline'
+        )
+        parser.add_argument(
+            '--tolerance',
+            action='store',
+            type=float,
+            default=0.2,
+            help='Allowed ratio of the regression from the baseline (default: 0.2)',
+            dest='tolerance'
+        )
+        parser.add_argument(
+            '--keepdb',
+            action='store_true',
+            help='Keep the test database and the seeded rows for the next run',
+            dest='keepdb'
+        )
+
+    def handle(self, *args: Any, **options: Any) -> Optional[str]:
+        """Command of running the benchmarks by the sizes.
+
+        The sizes should be ascending, because the seeded rows are added to
+        the rows of the previous size.
+
+        Returns:
+            Optional[str]: Options for inherited function.
+        """
+        baseline = None
+        if options['baseline']:
+            if not os.path.exists(options['baseline']):
+                raise CommandError('%s is not found' % options['baseline'])
+            with open(options['baseline']) as f:
+                baseline = json.load(f)['results']
+
+        runner = benchmark_function.BenchmarkRunner(
+            station_count=options['stations'],
+            repeat=options['repeat'],
+            seed=options['seed']
+        )
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        try:
+            results = {}
+            for size in options['sizes']:
+                self.stdout.write('Benchmarking %s rows' % size)
+                results[str(size)] = runner.run(size)
+                for name, metrics in results[str(size)].items():
+                    self.stdout.write('  %s: %s' % (name, ', '.join(
+                        '%s=%.4g' % (metric, value) for metric, value in metrics.items()
+                    )))
+            environment = benchmark_function.get_environment()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'environment': environment, 'results': results}, f, indent=2)
+            self.stdout.write('The results are written to %s' % options['output'])
+        if baseline is not None:
+            regressions = benchmark_function.compare_results(results, baseline, options['tolerance'])
+            if regressions:
+                raise CommandError('Regressions from the baseline:\n%s' % '\n'.join(regressions))
+            self.stdout.write('No regression from the baseline')
+
+    def __valid_arg_sizes(self, myarg) -> list[int]:
+        try:
+            sizes = sorted(int(size) for size in myarg.split(','))
+        except ValueError:
+            raise argparse.ArgumentTypeError('%s is not comma separated integers' % myarg)
+        if sizes[0] <= 0:
+            raise argparse.ArgumentTypeError('The sizes should be positive')
+        return sizes
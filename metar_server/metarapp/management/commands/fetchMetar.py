@@ -1,14 +1,16 @@
+from __future__ import annotations
 import argparse
 from django.core.management.base import BaseCommand, CommandParser
 from typing import Any, Optional
-from ...myfunction import airport_function, metar_function
+from ...myfunction import airport_function, metar_function, pipeline_function, writer_function
 
 
 class Command(BaseCommand):
     help = 'Fetch METAR data and save to database.'
 
     def add_arguments(self, parser: CommandParser):
-        """Add argument '--hour' for MetarInput.hour
+        """Add argument '--hour' for MetarInput.hour and the others for the
+        attributes of MetarInput with the same names
         """
         parser.add_argument(
             '--hour',
@@ -18,6 +20,44 @@ class Command(BaseCommand):
             help='Hours before now for fetching METAR, The maximum value is 72',
             dest='hour'
         )
+        parser.add_argument(
+            '--correction-policy',
+            action='store',
+            choices=writer_function.CORRECTION_POLICIES,
+            required=False,
+            help='Policy for reports of stored observations (default: METAR_CORRECTION_POLICY in settings)',
+            dest='correction_policy'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            action='store',
+            type=int,
+            required=False,
+            help='The number of airports in one request',
+            dest='chunk_size'
+        )
+        parser.add_argument(
+            '--workers',
+            action='store',
+            type=int,
+            required=False,
+            help='The number of concurrent requests',
+            dest='max_workers'
+        )
+        parser.add_argument(
+            '--pipeline',
+            action='store_true',
+            help='Fetch, parse and save in the staged pipeline with parse processes',
+            dest='pipeline'
+        )
+        parser.add_argument(
+            '--parse-workers',
+            action='store',
+            type=int,
+            required=False,
+            help='The number of the parse processes of the pipeline (default: the number of CPUs)',
+            dest='parse_workers'
+        )
 
     def handle(self, *args: Any, **options: Any) -> Optional[str]:
         """Command of fetching and saving METARs.
@@ -26,13 +66,56 @@ class Command(BaseCommand):
             Optional[str]: Options for inherited function.
         """
         airport_list = airport_function.get_airport_list()
-        metar_input = metar_function.MetarInput(airport_list)
+        if options['pipeline']:
+            self.__run_pipeline(airport_list, options)
+            return
+        metar_input = metar_function.MetarInput(
+            airport_list,
+            writer=writer_function.get_writer(options['correction_policy'])
+        )
         if options['hour'] is not None:
             metar_input.hour = options['hour']
+        if options['chunk_size'] is not None:
+            metar_input.chunk_size = options['chunk_size']
+        if options['max_workers'] is not None:
+            metar_input.max_workers = options['max_workers']
         metar_input.fetch_and_save()
         self.stdout.write('Fetched airport is %s' % airport_list)
         self.stdout.write('Fetched time is %s' % metar_input.fetched_time)
         self.stdout.write('The number of the fetched data is %s' % len(metar_input.fetched_data))
+        self.stdout.write('The number of the inserted data is %s' % metar_input.inserted_count)
+        self.stdout.write('The number of the skipped duplicates is %s' % metar_input.duplicate_count)
+        for chunk, error in metar_input.chunk_errors.items():
+            self.stderr.write('Failed to fetch %s: %s' % (chunk, error))
+
+    def __run_pipeline(self, airport_list: list[str], options: dict[str: Any]) -> None:
+        """Fetch and save METARs with pipeline_function.MetarPipeline and
+        write the stats of the stages.
+        """
+        pipeline = pipeline_function.MetarPipeline(
+            airport_list,
+            writer=writer_function.get_writer(options['correction_policy'])
+        )
+        if options['hour'] is not None:
+            pipeline.hour = options['hour']
+        if options['chunk_size'] is not None:
+            pipeline.chunk_size = options['chunk_size']
+        if options['max_workers'] is not None:
+            pipeline.fetch_workers = options['max_workers']
+        if options['parse_workers'] is not None:
+            pipeline.parse_workers = options['parse_workers']
+        pipeline.run()
+        self.stdout.write('Fetched time is %s' % pipeline.fetched_time)
+        self.stdout.write('The number of the fetched data is %s' % pipeline.fetched_count)
+        self.stdout.write('The number of the inserted data is %s' % pipeline.inserted_count)
+        self.stdout.write('The number of the updated data is %s' % pipeline.updated_count)
+        self.stdout.write('The number of the skipped duplicates is %s' % pipeline.duplicate_count)
+        self.stdout.write('The number of the invalid data is %s' % pipeline.invalid_count)
+        for name, stats in pipeline.get_stats().items():
+            self.stdout.write('Stage %s: %s' % (name, ', '.join('%s=%s' % item for item in stats.items())))
+        self.stdout.write('Finished in %.3f s' % pipeline.wall_seconds)
+        for chunk, error in pipeline.chunk_errors.items():
+            self.stderr.write('Failed to fetch %s: %s' % (chunk, error))
 
     def __valid_arg_hour(self, myarg) -> int:
         """Validation of '--hour' argument of the command.
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from typing import Any, Optional
+from ...myfunction import airport_function
+
+
+class Command(BaseCommand):
+    help = 'Create or update the airports from CSV files of OurAirports.'
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument(
+            'airport_file',
+            help='airports.csv of OurAirports'
+        )
+        parser.add_argument(
+            '--runways',
+            action='store',
+            help='runways.csv of OurAirports for the runway headings',
+            dest='runway_file'
+        )
+        parser.add_argument(
+            '--type',
+            action='append',
+            help='Type of the airports to be imported (repeatable, default: %s)' % ', '.join(
+                airport_function.IMPORT_TYPES
+            ),
+            dest='types'
+        )
+
+    def handle(self, *args: Any, **options: Any) -> Optional[str]:
+        """Command of importing the airports. New airports are not fetched
+        until 'is_fetched' is set.
+
+        Returns:
+            Optional[str]: Options for inherited function.
+        """
+        types = options['types'] or airport_function.IMPORT_TYPES
+        try:
+            with open(options['airport_file'], newline='', encoding='utf-8') as airport_file:
+                if options['runway_file']:
+                    with open(options['runway_file'], newline='', encoding='utf-8') as runway_file:
+                        counts = airport_function.import_airports(airport_file, runway_file, types)
+                else:
+                    counts = airport_function.import_airports(airport_file, types=types)
+        except OSError as e:
+            raise CommandError(str(e))
+        self.stdout.write('Created %s and updated %s airports' % counts)
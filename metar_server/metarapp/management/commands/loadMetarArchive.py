@@ -0,0 +1,94 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from django import db
+from django.core.management.base import BaseCommand, CommandParser
+from typing import Any, Optional
+from ...myfunction import backfill_function
+
+
+class Command(BaseCommand):
+    help = 'Load METAR data from archive files (XML or CSV, optionally gzip-compressed) to database.'
+
+    def add_arguments(self, parser: CommandParser):
+        """Add arguments of archive paths, '--workers', '--batch-size' and
+        '--checkpoint'
+        """
+        parser.add_argument(
+            'paths',
+            nargs='+',
+            help='Archive files or directories including them'
+        )
+        parser.add_argument(
+            '--workers',
+            action='store',
+            type=int,
+            default=1,
+            help='The number of processes loading files in parallel',
+            dest='workers'
+        )
+        parser.add_argument(
+            '--batch-size',
+            action='store',
+            type=int,
+            default=5000,
+            help='The number of rows inserted at once',
+            dest='batch_size'
+        )
+        parser.add_argument(
+            '--checkpoint',
+            action='store',
+            required=False,
+            help='JSON file recording loaded files. Recorded files are skipped on the next run',
+            dest='checkpoint'
+        )
+
+    def handle(self, *args: Any, **options: Any) -> Optional[str]:
+        """Command of loading archive files.
+
+        Returns:
+            Optional[str]: Options for inherited function.
+        """
+        checkpoint = backfill_function.load_checkpoint(options['checkpoint'])
+        file_list = [
+            path for path in backfill_function.find_archive_files(options['paths'])
+            if path not in checkpoint
+        ]
+        self.stdout.write('The number of the files to be loaded is %s' % len(file_list))
+        total = {'parsed': 0, 'inserted': 0, 'invalid': 0}
+        for path, result in self.__load_files(file_list, options['workers'], options['batch_size']):
+            if isinstance(result, Exception):
+                self.stderr.write('Failed to load %s: %s' % (path, result))
+                continue
+            checkpoint[path] = result
+            backfill_function.save_checkpoint(options['checkpoint'], checkpoint)
+            for key in total:
+                total[key] += result[key]
+            self.stdout.write('Loaded %s: %s' % (path, result))
+        self.stdout.write('The number of the parsed data is %s' % total['parsed'])
+        self.stdout.write('The number of the inserted data is %s' % total['inserted'])
+        self.stdout.write('The number of the invalid data is %s' % total['invalid'])
+
+    def __load_files(self, file_list: list, workers: int, batch_size: int):
+        """Load the files in this process or in worker processes.
+
+        Yields:
+            tuple: Path and the result dict, or the raised exception.
+        """
+        if workers <= 1:
+            for path in file_list:
+                try:
+                    yield path, backfill_function.load_archive_file(path, batch_size)
+                except Exception as e:
+                    yield path, e
+            return
+        # Worker processes open their own database connections.
+        db.connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(backfill_function.load_archive_file, path, batch_size): path
+                for path in file_list
+            }
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result()
+                except Exception as e:
+                    yield futures[future], e
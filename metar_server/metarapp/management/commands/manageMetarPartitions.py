@@ -0,0 +1,67 @@
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.utils import timezone
+from typing import Any, Optional
+from ...myfunction import partition_function
+
+
+class Command(BaseCommand):
+    help = 'Manage monthly partitions of the Metar table on PostgreSQL.'
+
+    def add_arguments(self, parser: CommandParser):
+        """Add arguments for converting, creating and detaching partitions.
+        """
+        parser.add_argument(
+            '--convert',
+            action='store_true',
+            help='Convert the Metar table to the partitioned table before the other operations',
+            dest='convert'
+        )
+        parser.add_argument(
+            '--ahead',
+            action='store',
+            type=int,
+            default=3,
+            help='Months of the future partitions to be created, The default value is 3',
+            dest='ahead'
+        )
+        parser.add_argument(
+            '--detach-older-than',
+            action='store',
+            type=int,
+            required=False,
+            help='Detach the partitions older than the given months',
+            dest='detach_months'
+        )
+        parser.add_argument(
+            '--drop',
+            action='store_true',
+            help='Drop the detached partitions',
+            dest='drop'
+        )
+
+    def handle(self, *args: Any, **options: Any) -> Optional[str]:
+        """Command of managing the partitions.
+
+        Returns:
+            Optional[str]: Options for inherited function.
+        """
+        try:
+            if options['convert']:
+                copied = partition_function.convert_to_partitioned()
+                self.stdout.write('The number of the copied data is %s' % copied)
+            if not partition_function.is_partitioned():
+                raise CommandError('The Metar table is not partitioned. Run with --convert first.')
+            this_month = timezone.now().date().replace(day=1)
+            created = partition_function.create_partitions(
+                this_month,
+                partition_function.add_months(this_month, options['ahead'])
+            )
+            self.stdout.write('Created partitions are %s' % created)
+            if options['detach_months'] is not None:
+                detached = partition_function.detach_partitions(
+                    partition_function.add_months(this_month, -options['detach_months']),
+                    options['drop']
+                )
+                self.stdout.write('Detached partitions are %s' % detached)
+        except partition_function.PartitionError as e:
+            raise CommandError(str(e))
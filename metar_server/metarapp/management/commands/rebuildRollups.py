@@ -0,0 +1,49 @@
+import argparse
+from datetime import date
+from django.core.management.base import BaseCommand, CommandParser
+from typing import Any, Optional
+from ...myfunction import rollup_function
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the hourly and daily rollups of METARs.'
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument(
+            '--station',
+            action='append',
+            help='ICAO id of the station to be rebuilt (repeatable, default: all)',
+            dest='stations'
+        )
+        parser.add_argument(
+            '--start',
+            action='store',
+            type=self.__valid_arg_date,
+            required=False,
+            help='The first local day, YYYY-MM-DD (default: the oldest METAR)',
+            dest='start'
+        )
+        parser.add_argument(
+            '--end',
+            action='store',
+            type=self.__valid_arg_date,
+            required=False,
+            help='The last local day, YYYY-MM-DD (default: the newest METAR)',
+            dest='end'
+        )
+
+    def handle(self, *args: Any, **options: Any) -> Optional[str]:
+        """Command of rebuilding the rollups by months.
+
+        Returns:
+            Optional[str]: Options for inherited function.
+        """
+        stations = [station.upper() for station in options['stations']] if options['stations'] else None
+        hourly_count = rollup_function.rebuild_rollups(stations, options['start'], options['end'])
+        self.stdout.write('The number of the hourly rollups is %s' % hourly_count)
+
+    def __valid_arg_date(self, myarg) -> date:
+        try:
+            return date.fromisoformat(myarg)
+        except ValueError:
+            raise argparse.ArgumentTypeError('%s is not YYYY-MM-DD' % myarg)
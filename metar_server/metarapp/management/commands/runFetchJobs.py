@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from typing import Any, Optional
+from ...myfunction import job_function
+
+
+class Command(BaseCommand):
+    help = 'Run pending METAR fetch jobs queued from the admin page.'
+
+    def handle(self, *args: Any, **options: Any) -> Optional[str]:
+        """Command of running the pending jobs, e.g. left by a restarted web
+        process.
+
+        Returns:
+            Optional[str]: Options for inherited function.
+        """
+        count = job_function.run_pending_jobs()
+        self.stdout.write('The number of the run jobs is %s' % count)
@@ -0,0 +1,96 @@
+import signal
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandParser
+from typing import Any, Optional
+from ...myfunction import ingest_function
+
+
+class Command(BaseCommand):
+    help = 'Fetch new METARs continuously on the schedule of METAR issue times.'
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Fetch once and exit',
+            dest='once'
+        )
+        parser.add_argument(
+            '--issue-delay',
+            action='store',
+            type=int,
+            default=3,
+            help='Minutes of the poll after the issue times (default: 3)',
+            dest='issue_delay'
+        )
+        parser.add_argument(
+            '--speci-interval',
+            action='store',
+            type=int,
+            default=5,
+            help='The maximum minutes between the polls for SPECI (default: 5)',
+            dest='speci_interval'
+        )
+        parser.add_argument(
+            '--max-hour',
+            action='store',
+            type=int,
+            default=25,
+            help='Hours before now for the airports without METAR (default: 25)',
+            dest='max_hour'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            action='store',
+            type=int,
+            required=False,
+            help='The number of airports in one request',
+            dest='chunk_size'
+        )
+        parser.add_argument(
+            '--workers',
+            action='store',
+            type=int,
+            required=False,
+            help='The number of concurrent requests',
+            dest='max_workers'
+        )
+
+    def handle(self, *args: Any, **options: Any) -> Optional[str]:
+        """Command of the ingest daemon.
+
+        SIGINT and SIGTERM stop the daemon after the running cycle.
+
+        Returns:
+            Optional[str]: Options for inherited function.
+        """
+        scheduler = ingest_function.IngestScheduler(
+            issue_delay=timedelta(minutes=options['issue_delay']),
+            speci_interval=timedelta(minutes=options['speci_interval']),
+            max_hour=options['max_hour']
+        )
+        scheduler.chunk_size = options['chunk_size']
+        scheduler.max_workers = options['max_workers']
+        if options['once']:
+            self.__write_result(scheduler.run_once())
+            return
+
+        def stop(signum, frame):
+            self.stdout.write('Stopping after the running cycle (signal %s)' % signum)
+            scheduler.stop()
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+        scheduler.run(self.__write_result)
+        self.stdout.write('Stopped')
+
+    def __write_result(self, result: dict) -> None:
+        self.stdout.write(
+            '%s: inserted %s, skipped %s, hoursBeforeNow %s' % (
+                result['fetched_time'],
+                result['inserted'],
+                result['duplicates'],
+                result['hours']
+            )
+        )
+        for chunk, error in result['errors'].items():
+            self.stderr.write('Failed to fetch %s: %s' % (chunk, error))
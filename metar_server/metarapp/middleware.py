@@ -0,0 +1,79 @@
+from __future__ import annotations
+import logging
+import random
+import time
+from contextlib import ExitStack
+from django.conf import settings
+from django.db import connections
+from django.http import HttpRequest, HttpResponse
+from typing import Callable
+from .myfunction import metrics_function
+
+logger = logging.getLogger(__name__)
+
+
+class QueryRecorder():
+    """Execute wrapper counting the queries and the SQL time in the record.
+    """
+    def __init__(self, record: metrics_function.RequestRecord, max_queries: int) -> None:
+        self.record = record
+        self.max_queries = max_queries
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            seconds = time.perf_counter() - start
+            self.record.query_count += 1
+            self.record.sql_time += seconds
+            if self.record.queries is not None and len(self.record.queries) < self.max_queries:
+                self.record.queries.append((sql, seconds))
+
+
+class MetricsMiddleware():
+    """Record the latency, the SQL queries, the template render time and the
+    external HTTP time of each request by view.
+
+    Requests slower than METAR_SLOW_REQUEST_SECONDS in settings are logged
+    with their SQL if they are sampled. METAR_SLOW_REQUEST_SAMPLE_RATE of
+    the requests are sampled, and the SQL is kept only for them. The time
+    of streaming responses is until the view returns.
+    """
+    def __init__(self, get_response: Callable[[HttpRequest], HttpResponse]) -> None:
+        self.get_response = get_response
+        self.slow_seconds = getattr(settings, 'METAR_SLOW_REQUEST_SECONDS', 1.0)
+        self.sample_rate = getattr(settings, 'METAR_SLOW_REQUEST_SAMPLE_RATE', 0.1)
+        self.max_queries = getattr(settings, 'METAR_SLOW_REQUEST_MAX_QUERIES', 50)
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        record = metrics_function.start_record(random.random() < self.sample_rate)
+        recorder = QueryRecorder(record, self.max_queries)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(recorder))
+                response = self.get_response(request)
+        finally:
+            metrics_function.end_record()
+        seconds = time.perf_counter() - start
+        match = request.resolver_match
+        view = match.view_name if match is not None else 'unresolved'
+        metrics_function.observe_request(view, seconds, record)
+        if record.queries is not None and seconds >= self.slow_seconds:
+            logger.warning(
+                'Slow request %s %s (%s): %.3f s, %d queries in %.3f s, templates %.3f s, '
+                '%d HTTP requests in %.3f s\n%s',
+                request.method,
+                request.path,
+                view,
+                seconds,
+                record.query_count,
+                record.sql_time,
+                record.template_time,
+                record.http_count,
+                record.http_time,
+                '\n'.join('%.4f s: %s' % (query_seconds, sql) for sql, query_seconds in record.queries)
+            )
+        return response
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.4 on 2026-10-18 08:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metarapp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='metar',
+            index=models.Index(fields=['observation_time'], name='metar_observation_time_idx'),
+        ),
+    ]
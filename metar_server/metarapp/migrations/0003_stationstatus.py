@@ -0,0 +1,37 @@
+# Generated by Django 3.2.4 on 2026-10-18 08:10
+
+import django.core.validators
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def fill_station_status(apps, schema_editor):
+    Metar = apps.get_model('metarapp', 'Metar')
+    StationStatus = apps.get_model('metarapp', 'StationStatus')
+    newest_query = Metar.objects \
+        .values('station_id') \
+        .annotate(newest=Max('observation_time'))
+    StationStatus.objects.bulk_create(
+        [StationStatus(station_id=row['station_id'], newest_observation_time=row['newest'])
+         for row in newest_query]
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metarapp', '0002_metar_observation_time_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StationStatus',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('station_id', models.CharField(max_length=4, unique=True, validators=[django.core.validators.RegexValidator('[A-Z]([A-Z]|[0-9]){2,3}')])),
+                ('newest_observation_time', models.DateTimeField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(fill_station_status, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 3.2.4 on 2026-10-18 08:26
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metarapp', '0004_fetchjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetarDailyRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('station_id', models.CharField(max_length=4, validators=[django.core.validators.RegexValidator('[A-Z]([A-Z]|[0-9]){2,3}')])),
+                ('count', models.PositiveIntegerField()),
+                ('temp_sum', models.FloatField()),
+                ('temp_min', models.FloatField()),
+                ('temp_max', models.FloatField()),
+                ('dewpoint_sum', models.FloatField()),
+                ('wind_speed_sum', models.PositiveIntegerField()),
+                ('wind_speed_max', models.PositiveSmallIntegerField()),
+                ('wind_gust_max', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('altim_sum', models.FloatField()),
+                ('altim_min', models.FloatField()),
+                ('altim_max', models.FloatField()),
+                ('visibility_sum', models.PositiveIntegerField()),
+                ('visibility_min', models.PositiveSmallIntegerField()),
+                ('below_ceiling_count', models.PositiveIntegerField()),
+                ('below_visibility_count', models.PositiveIntegerField()),
+                ('wx_counts', models.JSONField(blank=True, default=dict)),
+                ('day', models.DateField()),
+                ('below_ceiling_hours', models.PositiveSmallIntegerField()),
+                ('below_visibility_hours', models.PositiveSmallIntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MetarHourlyRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('station_id', models.CharField(max_length=4, validators=[django.core.validators.RegexValidator('[A-Z]([A-Z]|[0-9]){2,3}')])),
+                ('count', models.PositiveIntegerField()),
+                ('temp_sum', models.FloatField()),
+                ('temp_min', models.FloatField()),
+                ('temp_max', models.FloatField()),
+                ('dewpoint_sum', models.FloatField()),
+                ('wind_speed_sum', models.PositiveIntegerField()),
+                ('wind_speed_max', models.PositiveSmallIntegerField()),
+                ('wind_gust_max', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('altim_sum', models.FloatField()),
+                ('altim_min', models.FloatField()),
+                ('altim_max', models.FloatField()),
+                ('visibility_sum', models.PositiveIntegerField()),
+                ('visibility_min', models.PositiveSmallIntegerField()),
+                ('below_ceiling_count', models.PositiveIntegerField()),
+                ('below_visibility_count', models.PositiveIntegerField()),
+                ('wx_counts', models.JSONField(blank=True, default=dict)),
+                ('hour', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='metarhourlyrollup',
+            constraint=models.UniqueConstraint(fields=('station_id', 'hour'), name='unique_hourly_rollup'),
+        ),
+        migrations.AddConstraint(
+            model_name='metardailyrollup',
+            constraint=models.UniqueConstraint(fields=('station_id', 'day'), name='unique_daily_rollup'),
+        ),
+    ]
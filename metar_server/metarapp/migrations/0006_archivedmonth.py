@@ -0,0 +1,29 @@
+# Generated by Django 3.2.4 on 2026-10-18 08:31
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metarapp', '0005_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMonth',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('station_id', models.CharField(max_length=4, validators=[django.core.validators.RegexValidator('[A-Z]([A-Z]|[0-9]){2,3}')])),
+                ('month', models.DateField()),
+                ('path', models.CharField(max_length=255)),
+                ('count', models.PositiveIntegerField()),
+                ('archived_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='archivedmonth',
+            constraint=models.UniqueConstraint(fields=('station_id', 'month'), name='unique_archived_month'),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 3.2.4 on 2026-10-18 08:39
+
+import django.core.validators
+from django.db import migrations, models
+
+
+def remove_duplicate_airports(apps, schema_editor):
+    # The first row of each station is kept, and it is fetched if any of the
+    # duplicates was.
+    Airport = apps.get_model('metarapp', 'Airport')
+    kept_dict = {}
+    for airport in Airport.objects.order_by('id'):
+        kept = kept_dict.get(airport.station_id)
+        if kept is None:
+            kept_dict[airport.station_id] = airport
+            continue
+        if airport.is_fetched and not kept.is_fetched:
+            kept.is_fetched = True
+            kept.save(update_fields=['is_fetched'])
+        airport.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metarapp', '0006_archivedmonth'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='airport',
+            name='elevation_ft',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='airport',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True, validators=[django.core.validators.MaxValueValidator(90.0), django.core.validators.MinValueValidator(-90.0)]),
+        ),
+        migrations.AddField(
+            model_name='airport',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True, validators=[django.core.validators.MaxValueValidator(180.0), django.core.validators.MinValueValidator(-180.0)]),
+        ),
+        migrations.AddField(
+            model_name='airport',
+            name='name',
+            field=models.CharField(blank=True, max_length=128),
+        ),
+        migrations.AddField(
+            model_name='airport',
+            name='runway_headings',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='airport',
+            name='timezone',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.RunPython(remove_duplicate_airports, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='airport',
+            constraint=models.UniqueConstraint(fields=('station_id',), name='unique_airport'),
+        ),
+    ]
@@ -0,0 +1,99 @@
+# Generated by Django 3.2.4 on 2026-10-18 09:02
+
+import re
+import django.core.validators
+from django.db import migrations, models
+
+# Copies of condition_function and analytics_function when this migration
+# was written, so that later changes of them do not change the migration.
+WX_CODES = (
+    'MI', 'PR', 'BC', 'DR', 'BL', 'SH', 'TS', 'FZ', 'VC',
+    'DZ', 'RA', 'SN', 'SG', 'IC', 'PL', 'GR', 'GS', 'UP',
+    'BR', 'FG', 'FU', 'VA', 'DU', 'SA', 'HZ', 'PY',
+    'PO', 'SQ', 'FC', 'SS', 'DS'
+)
+WX_CODE_RE = re.compile(r'[A-Z]{2}')
+CEILING_BOUNDS_FT = (500, 1000, 3000)
+VISIBILITY_BOUNDS_M = (1609, 4828, 8047)
+
+
+def get_category(value, bounds):
+    # LIFR and IFR are below the bounds, and MVFR includes the bound.
+    if value is None:
+        return 0
+    if value < bounds[0]:
+        return 3
+    if value < bounds[1]:
+        return 2
+    if value <= bounds[2]:
+        return 1
+    return 0
+
+
+def set_conditions(metar):
+    ceilings = [value for value in (metar.cloud_ceiling, metar.vert_vis_ft) if value is not None]
+    metar.flight_category = max(
+        get_category(min(ceilings) if ceilings else None, CEILING_BOUNDS_FT),
+        get_category(metar.visibility_m, VISIBILITY_BOUNDS_M)
+    )
+    metar.wx_flags = 0
+    for code in WX_CODE_RE.findall(metar.wx_string or ''):
+        if code in WX_CODES:
+            metar.wx_flags |= 1 << WX_CODES.index(code)
+
+
+def fill_conditions(apps, schema_editor):
+    # The rows are read by batches of id, and only the rows which are not
+    # VFR or have the weather are updated.
+    Metar = apps.get_model('metarapp', 'Metar')
+    last_id = 0
+    while True:
+        metars = list(
+            Metar.objects
+            .filter(id__gt=last_id)
+            .order_by('id')
+            .only('id', 'cloud_ceiling', 'vert_vis_ft', 'visibility_m', 'wx_string')[:5000]
+        )
+        if not metars:
+            break
+        last_id = metars[-1].id
+        for metar in metars:
+            set_conditions(metar)
+        Metar.objects.bulk_update(
+            [metar for metar in metars if metar.flight_category or metar.wx_flags],
+            ['flight_category', 'wx_flags'],
+            batch_size=1000
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metarapp', '0007_airport_registry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='metar',
+            name='flight_category',
+            field=models.PositiveSmallIntegerField(default=0, validators=[django.core.validators.MaxValueValidator(3)]),
+        ),
+        migrations.AddField(
+            model_name='metar',
+            name='wx_flags',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_conditions, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='metar',
+            index=models.Index(condition=models.Q(('flight_category__gte', 2)), fields=['observation_time', 'id'], name='metar_ifr_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='metar',
+            index=models.Index(condition=models.Q(('wind_gust_kt__isnull', False)), fields=['observation_time', 'id'], name='metar_gust_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='metar',
+            index=models.Index(condition=models.Q(('wx_flags__gt', 0)), fields=['observation_time', 'id'], name='metar_wx_time_idx'),
+        ),
+    ]
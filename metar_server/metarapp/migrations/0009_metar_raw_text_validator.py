@@ -0,0 +1,19 @@
+# Generated by Django 3.2.4 on 2026-10-18 09:14
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metarapp', '0008_metar_conditions'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='metar',
+            name='raw_text',
+            field=models.TextField(validators=[django.core.validators.RegexValidator('\\A([A-Z]([A-Z]|[0-9]){2,3} [0-3])')]),
+        ),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 3.2.4 on 2026-10-18 10:21
+
+import re
+from django.db import migrations
+
+# Copies of decode_function and analytics_function when this migration was
+# written, so that later changes of them do not change the migration.
+CLOUD_RE = re.compile(r'(?P<cover>FEW|SCT|BKN|OVC|VV)(?P<base>[0-9]{3}|///)(?P<type>CB|TCU|///)?')
+END_SET = frozenset(('RMK', 'NOSIG', 'BECMG', 'TEMPO'))
+CEILING_BOUNDS_FT = (500, 1000, 3000)
+VISIBILITY_BOUNDS_M = (1609, 4828, 8047)
+
+
+def get_category(value, bounds):
+    # LIFR and IFR are below the bounds, and MVFR includes the bound.
+    if value is None:
+        return 0
+    if value < bounds[0]:
+        return 3
+    if value < bounds[1]:
+        return 2
+    if value <= bounds[2]:
+        return 1
+    return 0
+
+
+def get_ceiling(raw_text):
+    # Base of the lowest BKN or OVC layer before the remarks and the trend.
+    for token in raw_text.split()[1:]:
+        if token in END_SET:
+            break
+        match = CLOUD_RE.fullmatch(token)
+        if match is not None and match.group('cover') in ('BKN', 'OVC') and match.group('base') != '///':
+            return int(match.group('base')) * 100
+    return None
+
+
+def fill_overcast_ceiling(apps, schema_editor):
+    # The ceiling was the first BKN layer, so only the rows with an OVC
+    # layer can change. Their ceiling and flight category are recomputed.
+    Metar = apps.get_model('metarapp', 'Metar')
+    last_id = 0
+    while True:
+        metars = list(
+            Metar.objects
+            .filter(id__gt=last_id, raw_text__contains='OVC')
+            .order_by('id')
+            .only('id', 'raw_text', 'cloud_ceiling', 'vert_vis_ft', 'visibility_m')[:5000]
+        )
+        if not metars:
+            break
+        last_id = metars[-1].id
+        changed = []
+        for metar in metars:
+            ceiling = get_ceiling(metar.raw_text)
+            if ceiling is None or ceiling == metar.cloud_ceiling:
+                continue
+            metar.cloud_ceiling = ceiling
+            ceilings = [value for value in (ceiling, metar.vert_vis_ft) if value is not None]
+            metar.flight_category = max(
+                get_category(min(ceilings), CEILING_BOUNDS_FT),
+                get_category(metar.visibility_m, VISIBILITY_BOUNDS_M)
+            )
+            changed.append(metar)
+        Metar.objects.bulk_update(changed, ['cloud_ceiling', 'flight_category'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metarapp', '0009_metar_raw_text_validator'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_overcast_ceiling, migrations.RunPython.noop),
+    ]
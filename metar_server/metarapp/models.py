@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models import Q
 from django.core.validators import MaxValueValidator, MinValueValidator, RegexValidator
 
 
@@ -12,6 +13,9 @@ class Metar(models.Model):
         (METAR, 'METAR'),
         (SPECI, 'SPECI')
     ]
+    # Fields computed from the others by condition_function when the rows
+    # are written. They are not in the CSV files.
+    CONDITION_FIELDS = ('flight_category', 'wx_flags')
     raw_text = models.TextField(
         validators=[RegexValidator(RAW_TEXT_RE)]
     )
@@ -73,6 +77,15 @@ class Metar(models.Model):
         default=METAR,
         max_length=5
     )
+    # 0 (VFR), 1 (MVFR), 2 (IFR) or 3 (LIFR).
+    flight_category = models.PositiveSmallIntegerField(
+        default=0,
+        validators=[MaxValueValidator(3)]
+    )
+    # Bits of condition_function.WX_CODES in wx_string.
+    wx_flags = models.PositiveIntegerField(
+        default=0
+    )
 
     class Meta:
         constraints = [
@@ -81,9 +94,39 @@ class Metar(models.Model):
                 name='unique_metar'
             )
         ]
+        # unique_metar also serves as the index of station_id and the range
+        # of observation_time. This index is for the queries of all stations.
+        # The partial indexes are for the condition search of all stations.
+        indexes = [
+            models.Index(
+                fields=['observation_time'],
+                name='metar_observation_time_idx'
+            ),
+            models.Index(
+                fields=['observation_time', 'id'],
+                name='metar_ifr_time_idx',
+                condition=Q(flight_category__gte=2)
+            ),
+            models.Index(
+                fields=['observation_time', 'id'],
+                name='metar_gust_time_idx',
+                condition=Q(wind_gust_kt__isnull=False)
+            ),
+            models.Index(
+                fields=['observation_time', 'id'],
+                name='metar_wx_time_idx',
+                condition=Q(wx_flags__gt=0)
+            )
+        ]
 
 
 class Airport(models.Model):
+    """Station registry. METARs are fetched for the airports with
+    'is_fetched'.
+
+    'runway_headings' is the list of the true headings of the runway ends
+    in degrees, like [164, 344]. 'timezone' is an IANA time zone name.
+    """
     STATION_ID_RE = r'[A-Z]([A-Z]|[0-9]){2,3}'
     station_id = models.CharField(
         max_length=4,
@@ -91,3 +134,208 @@ class Airport(models.Model):
     )
     register_date = models.DateField()
     is_fetched = models.BooleanField()
+    name = models.CharField(
+        blank=True,
+        max_length=128
+    )
+    latitude = models.FloatField(
+        blank=True,
+        null=True,
+        validators=[
+            MaxValueValidator(90.0),
+            MinValueValidator(-90.0)
+        ]
+    )
+    longitude = models.FloatField(
+        blank=True,
+        null=True,
+        validators=[
+            MaxValueValidator(180.0),
+            MinValueValidator(-180.0)
+        ]
+    )
+    elevation_ft = models.IntegerField(
+        blank=True,
+        null=True
+    )
+    runway_headings = models.JSONField(
+        blank=True,
+        default=list
+    )
+    timezone = models.CharField(
+        blank=True,
+        max_length=64
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['station_id'],
+                name='unique_airport'
+            )
+        ]
+
+    def __str__(self) -> str:
+        return self.station_id
+
+
+class StationStatus(models.Model):
+    """Newest observation time of each station, updated on inserting METARs.
+    """
+    STATION_ID_RE = r'[A-Z]([A-Z]|[0-9]){2,3}'
+    station_id = models.CharField(
+        max_length=4,
+        unique=True,
+        validators=[RegexValidator(STATION_ID_RE)]
+    )
+    newest_observation_time = models.DateTimeField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class FetchJob(models.Model):
+    """Job of fetching METARs queued from the admin page.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'pending'),
+        (RUNNING, 'running'),
+        (DONE, 'done'),
+        (FAILED, 'failed')
+    ]
+    airports = models.JSONField()
+    status = models.CharField(
+        choices=STATUS_CHOICES,
+        default=PENDING,
+        max_length=7
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(
+        blank=True,
+        null=True
+    )
+    finished_at = models.DateTimeField(
+        blank=True,
+        null=True
+    )
+    station_counts = models.JSONField(
+        blank=True,
+        default=dict
+    )
+    inserted_count = models.PositiveIntegerField(default=0)
+    duplicate_count = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['status', 'created_at'],
+                name='fetchjob_status_idx'
+            )
+        ]
+
+    @property
+    def duration(self):
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+
+class MetarRollup(models.Model):
+    """Statistics of METARs of a station in a period.
+
+    The means are the sums divided by 'count'. The reports below the
+    minimums are counted with METAR_CEILING_MINIMUM_FT and
+    METAR_VISIBILITY_MINIMUM_M in settings. 'wx_counts' is the number of
+    the reports of each weather phenomenon, like {"RA": 3, "BR": 1}.
+    """
+    STATION_ID_RE = r'[A-Z]([A-Z]|[0-9]){2,3}'
+    station_id = models.CharField(
+        max_length=4,
+        validators=[RegexValidator(STATION_ID_RE)]
+    )
+    count = models.PositiveIntegerField()
+    temp_sum = models.FloatField()
+    temp_min = models.FloatField()
+    temp_max = models.FloatField()
+    dewpoint_sum = models.FloatField()
+    wind_speed_sum = models.PositiveIntegerField()
+    wind_speed_max = models.PositiveSmallIntegerField()
+    wind_gust_max = models.PositiveSmallIntegerField(
+        blank=True,
+        null=True
+    )
+    altim_sum = models.FloatField()
+    altim_min = models.FloatField()
+    altim_max = models.FloatField()
+    visibility_sum = models.PositiveIntegerField()
+    visibility_min = models.PositiveSmallIntegerField()
+    below_ceiling_count = models.PositiveIntegerField()
+    below_visibility_count = models.PositiveIntegerField()
+    wx_counts = models.JSONField(
+        blank=True,
+        default=dict
+    )
+
+    class Meta:
+        abstract = True
+
+
+class MetarHourlyRollup(MetarRollup):
+    """Statistics of METARs of a station in an hour (UTC).
+    """
+    hour = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['station_id', 'hour'],
+                name='unique_hourly_rollup'
+            )
+        ]
+
+
+class MetarDailyRollup(MetarRollup):
+    """Statistics of METARs of a station in a local day, summed from
+    MetarHourlyRollup.
+
+    'below_ceiling_hours' and 'below_visibility_hours' are the number of
+    the hours which have a report below the minimums.
+    """
+    day = models.DateField()
+    below_ceiling_hours = models.PositiveSmallIntegerField()
+    below_visibility_hours = models.PositiveSmallIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['station_id', 'day'],
+                name='unique_daily_rollup'
+            )
+        ]
+
+
+class ArchivedMonth(models.Model):
+    """METARs of a station in a month (UTC) moved to the archive files.
+
+    'path' is relative to METAR_ARCHIVE_DIR in settings.
+    """
+    STATION_ID_RE = r'[A-Z]([A-Z]|[0-9]){2,3}'
+    station_id = models.CharField(
+        max_length=4,
+        validators=[RegexValidator(STATION_ID_RE)]
+    )
+    month = models.DateField()
+    path = models.CharField(max_length=255)
+    count = models.PositiveIntegerField()
+    archived_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['station_id', 'month'],
+                name='unique_archived_month'
+            )
+        ]
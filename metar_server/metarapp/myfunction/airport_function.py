@@ -1,14 +1,36 @@
 from __future__ import annotations
+import csv
 import datetime
-from django.db.models.query import QuerySet
-from ..models import Airport, Metar
+import math
+import re
+import threading
+import time
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from typing import Iterable, Optional, TextIO
+from ..models import Airport, Metar, StationStatus
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+ICAO_ID_RE = re.compile(r'[A-Z][A-Z0-9]{3}')
+RUNWAY_IDENT_RE = re.compile(r'(\d{1,2})[LCR]?')
+IMPORT_TYPES = ('large_airport', 'medium_airport', 'small_airport')
+# Fields of Airport updated by import_airports.
+IMPORT_FIELDS = ('name', 'latitude', 'longitude', 'elevation_ft', 'runway_headings', 'timezone')
+
+_registry: Optional[AirportRegistry] = None
+_registry_time = 0.0
+_registry_lock = threading.Lock()
 
 
 class AirportMetarNewest():
     """Get and store the newest datetime of the METAR of the airports.
 
     The datetimes are stored as dict: key is station_id, value is
-    observation_time.
+    observation_time. They are read from StationStatus, and only the
+    airports without StationStatus are searched in Metar model.
 
     Attributes:
         airport_list (list[str]): List of airports to be searched the newest.
@@ -16,10 +38,7 @@ class AirportMetarNewest():
     """
     def __init__(self) -> None:
         self.__airport_list = get_airport_list()
-        self.__newest_dict = {}
-        metar_dict = self.__get_newest().values('station_id', 'observation_time')
-        for airport in metar_dict:
-            self.__newest_dict[airport['station_id']] = airport['observation_time']
+        self.__newest_dict = self.__get_newest()
 
     @property
     def airport_list(self) -> list[str]:
@@ -29,33 +48,357 @@ class AirportMetarNewest():
     def newest_dict(self) -> dict[str: datetime]:
         return self.__newest_dict
 
-    def __get_newest(self) -> QuerySet:
-        """Get QuerySet object of the newest data.
+    def __get_newest(self) -> dict[str: datetime]:
+        """Get the newest datetime of each airport.
 
         Returns:
-            QuerySet: QuerySet from Metar model.
+            dict[str: datetime]: station_id and the datetime.
         """
-        metar_query = Metar.objects \
+        status_query = StationStatus.objects \
             .filter(
                 station_id__in=self.__airport_list
             ) \
-            .order_by(
-                'observation_time'
-            ) \
-            .reverse()[:1]
-        return metar_query
+            .values_list('station_id', 'newest_observation_time')
+        newest_dict = dict(status_query)
+        missing = [airport for airport in self.__airport_list if airport not in newest_dict]
+        if missing:
+            newest_dict.update(refresh_station_status(missing))
+        return newest_dict
 
 
-def get_airport_list() -> list[str]:
-    """Get list of aiport ICAO ids from database
+def update_station_status(metars: list[Metar]) -> None:
+    """Update StationStatus with the newest of the inserted METARs.
+
+    Args:
+        metars (list[Metar]): Inserted Metar models.
+    """
+    newest_dict: dict[str: datetime] = {}
+    for metar in metars:
+        if (metar.station_id not in newest_dict or
+                newest_dict[metar.station_id] < metar.observation_time):
+            newest_dict[metar.station_id] = metar.observation_time
+    _save_station_status(newest_dict)
+
+
+def refresh_station_status(station_list: list[str]) -> dict[str: datetime]:
+    """Get the newest datetime of the stations from Metar model and save them
+    to StationStatus.
+
+    The newest datetimes of all stations are searched by one grouped query.
+
+    Args:
+        station_list (list[str]): ICAO ids of the stations.
 
     Returns:
-        list[str]: Stored ICAO ids for fetching METAR.
+        dict[str: datetime]: station_id and the datetime of the stations
+            which have METAR.
     """
-    airport_list_query = Airport.objects \
+    newest_query = Metar.objects \
         .filter(
-            is_fetched=True
+            station_id__in=station_list
         ) \
-        .values_list('station_id', flat=True)
-    airport_list = list(airport_list_query)
-    return airport_list
+        .values('station_id') \
+        .annotate(newest=Max('observation_time')) \
+        .values_list('station_id', 'newest')
+    newest_dict = dict(newest_query)
+    _save_station_status(newest_dict)
+    return newest_dict
+
+
+def _save_station_status(newest_dict: dict[str: datetime]) -> None:
+    """Save the newest datetimes to StationStatus if they are newer.
+
+    Args:
+        newest_dict (dict[str: datetime]): station_id and the datetime.
+    """
+    if not newest_dict:
+        return
+    now = timezone.now()
+    stored_dict = StationStatus.objects.in_bulk(list(newest_dict), field_name='station_id')
+    update_list = []
+    create_list = []
+    for station_id, newest in newest_dict.items():
+        status = stored_dict.get(station_id)
+        if status is None:
+            create_list.append(StationStatus(station_id=station_id, newest_observation_time=newest))
+        elif status.newest_observation_time < newest:
+            status.newest_observation_time = newest
+            status.updated_at = now
+            update_list.append(status)
+    StationStatus.objects.bulk_update(update_list, ['newest_observation_time', 'updated_at'])
+    StationStatus.objects.bulk_create(create_list, ignore_conflicts=True)
+
+
+def get_airport_list() -> list[str]:
+    """Get list of aiport ICAO ids from the registry
+
+    Returns:
+        list[str]: Stored ICAO ids for fetching METAR.
+    """
+    return get_registry().fetched_list
+
+
+class AirportRegistry():
+    """Airports in memory with a grid index of the coordinates.
+
+    The airports with coordinates are put in the cells of 'cell_degrees'
+    latitude and longitude, so a search reads only the cells around the
+    point. Distances are great-circle distances in km.
+
+    Attributes:
+        airport_dict (dict[str: Airport]): station_id and the airport.
+        fetched_list (list[str]): ICAO ids of the airports with 'is_fetched'.
+        cell_degrees (float): Size of the cells in degrees.
+    """
+    def __init__(self, airports: Iterable[Airport], cell_degrees: float = 1.0) -> None:
+        self.airport_dict = {airport.station_id: airport for airport in airports}
+        self.fetched_list = [station_id for station_id, airport in self.airport_dict.items() if airport.is_fetched]
+        self.cell_degrees = cell_degrees
+        self.__column_count = math.ceil(360 / cell_degrees)
+        self.__grid: dict[tuple[int, int]: list[Airport]] = {}
+        for airport in self.airport_dict.values():
+            if airport.latitude is not None and airport.longitude is not None:
+                self.__grid.setdefault(self.__get_cell(airport.latitude, airport.longitude), []).append(airport)
+
+    def get(self, station_id: str) -> Optional[Airport]:
+        return self.airport_dict.get(station_id)
+
+    def within(self, latitude: float, longitude: float, radius_km: float) -> list[tuple[float, Airport]]:
+        """Get the airports within the distance from the point.
+
+        Args:
+            latitude (float): Latitude of the point.
+            longitude (float): Longitude of the point.
+            radius_km (float): Distance in km.
+
+        Returns:
+            list[tuple[float, Airport]]: Distances and the airports, the
+                nearest first.
+        """
+        radius_degrees = radius_km / KM_PER_DEGREE
+        south = max(latitude - radius_degrees, -90.0)
+        north = min(latitude + radius_degrees, 90.0)
+        # The longitude range is widest at the latitude farthest from the
+        # equator.
+        cos_max = math.cos(math.radians(max(abs(south), abs(north))))
+        if cos_max * 180 <= radius_degrees:
+            west, east = -180.0, 180.0
+        else:
+            west = longitude - radius_degrees / cos_max
+            east = longitude + radius_degrees / cos_max
+        result = []
+        for airport in self.__iter_cells(south, west, north, east):
+            distance = get_distance(latitude, longitude, airport.latitude, airport.longitude)
+            if distance <= radius_km:
+                result.append((distance, airport))
+        result.sort(key=lambda item: (item[0], item[1].station_id))
+        return result
+
+    def nearest(
+        self,
+        latitude: float,
+        longitude: float,
+        count: int = 1,
+        max_km: float = math.pi * EARTH_RADIUS_KM
+    ) -> list[tuple[float, Airport]]:
+        """Get the nearest airports of the point.
+
+        The radius of the search is doubled until enough airports are found.
+
+        Args:
+            latitude (float): Latitude of the point.
+            longitude (float): Longitude of the point.
+            count (int, optional): The number of the airports. Defaults to 1.
+            max_km (float, optional): The maximum distance. Defaults to half
+                of the circumference.
+
+        Returns:
+            list[tuple[float, Airport]]: Distances and the airports, the
+                nearest first.
+        """
+        radius_km = min(self.cell_degrees * KM_PER_DEGREE, max_km)
+        while True:
+            result = self.within(latitude, longitude, radius_km)
+            if len(result) >= count or radius_km >= max_km:
+                return result[:count]
+            radius_km = min(radius_km * 2, max_km)
+
+    def in_bbox(self, south: float, west: float, north: float, east: float) -> list[Airport]:
+        """Get the airports in the bounding box.
+
+        The box crosses the antimeridian if 'west' is larger than 'east'.
+
+        Returns:
+            list[Airport]: The airports ordered by station_id.
+        """
+        if west > east:
+            ranges = [(west, 180.0), (-180.0, east)]
+        else:
+            ranges = [(west, east)]
+        result = []
+        for range_west, range_east in ranges:
+            for airport in self.__iter_cells(south, range_west, north, range_east):
+                if south <= airport.latitude <= north and range_west <= airport.longitude <= range_east:
+                    result.append(airport)
+        return sorted(result, key=lambda airport: airport.station_id)
+
+    def __get_cell(self, latitude: float, longitude: float) -> tuple[int, int]:
+        row = math.floor((latitude + 90) / self.cell_degrees)
+        column = math.floor((longitude + 180) / self.cell_degrees) % self.__column_count
+        return row, column
+
+    def __iter_cells(self, south: float, west: float, north: float, east: float) -> Iterable[Airport]:
+        """Iterate the airports in the cells overlapping the box. 'west' and
+        'east' can be out of -180 to 180.
+        """
+        first_row, first_column = self.__get_cell(south, west)
+        last_row = self.__get_cell(north, east)[0]
+        column_span = min(
+            math.floor((east + 180) / self.cell_degrees) - math.floor((west + 180) / self.cell_degrees),
+            self.__column_count - 1
+        )
+        for row in range(first_row, last_row + 1):
+            for offset in range(column_span + 1):
+                yield from self.__grid.get((row, (first_column + offset) % self.__column_count), [])
+
+
+def get_distance(latitude1: float, longitude1: float, latitude2: float, longitude2: float) -> float:
+    """Great-circle distance in km by the haversine formula.
+    """
+    phi1 = math.radians(latitude1)
+    phi2 = math.radians(latitude2)
+    a = math.sin((phi2 - phi1) / 2) ** 2 + \
+        math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(longitude2 - longitude1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def get_registry() -> AirportRegistry:
+    """Get the registry of the airports cached in this process.
+
+    The registry is loaded again after it is invalidated by the signals of
+    Airport, or after METAR_AIRPORT_REGISTRY_TIMEOUT seconds in settings for
+    the changes by the other processes.
+
+    Returns:
+        AirportRegistry: The registry.
+    """
+    global _registry, _registry_time
+    timeout = getattr(settings, 'METAR_AIRPORT_REGISTRY_TIMEOUT', 300)
+    with _registry_lock:
+        if _registry is None or time.monotonic() - _registry_time > timeout:
+            _registry = AirportRegistry(Airport.objects.order_by('station_id'))
+            _registry_time = time.monotonic()
+        return _registry
+
+
+def invalidate_registry() -> None:
+    """Drop the cached registry. Bulk operations of Airport, which do not
+    send the signals, should call this.
+    """
+    global _registry
+    with _registry_lock:
+        _registry = None
+
+
+def import_airports(
+    airport_file: TextIO,
+    runway_file: Optional[TextIO] = None,
+    types: Iterable[str] = IMPORT_TYPES
+) -> tuple[int, int]:
+    """Create or update Airport from CSV files of OurAirports.
+
+    The station id is the first 4-letter ICAO id of 'icao_code', 'ident'
+    and 'gps_code'. Rows without an ICAO id are skipped. The time
+    zone is read from a 'timezone' or 'tz' column if the file has it. The
+    runway headings are 'le_heading_degT' and 'he_heading_degT' of the open
+    runways, or the runway number times 10 if they are missing.
+
+    New airports are not fetched. 'is_fetched' and 'register_date' of the
+    stored airports are kept.
+
+    Args:
+        airport_file (TextIO): airports.csv.
+        runway_file (Optional[TextIO], optional): runways.csv. Defaults to
+            None.
+        types (Iterable[str], optional): Types of the airports to be
+            imported. Defaults to IMPORT_TYPES.
+
+    Returns:
+        tuple[int, int]: The numbers of the created and updated airports.
+    """
+    types = set(types)
+    runway_dict = _read_runways(runway_file) if runway_file is not None else {}
+    imported_dict: dict[str: dict] = {}
+    for row in csv.DictReader(airport_file):
+        if row.get('type') not in types:
+            continue
+        station_id = _get_icao_id(row)
+        if station_id is None:
+            continue
+        imported_dict[station_id] = {
+            'name': (row.get('name') or '')[:128],
+            'latitude': _to_float(row.get('latitude_deg')),
+            'longitude': _to_float(row.get('longitude_deg')),
+            'elevation_ft': _to_int(row.get('elevation_ft')),
+            'runway_headings': runway_dict.get(row.get('ident'), []),
+            'timezone': row.get('timezone') or row.get('tz') or ''
+        }
+
+    stored_dict = Airport.objects.in_bulk(list(imported_dict), field_name='station_id')
+    create_list = []
+    update_list = []
+    today = timezone.localdate()
+    for station_id, values in imported_dict.items():
+        airport = stored_dict.get(station_id)
+        if airport is None:
+            create_list.append(Airport(station_id=station_id, register_date=today, is_fetched=False, **values))
+            continue
+        for name, value in values.items():
+            setattr(airport, name, value)
+        update_list.append(airport)
+    with transaction.atomic():
+        Airport.objects.bulk_create(create_list, batch_size=1000)
+        Airport.objects.bulk_update(update_list, IMPORT_FIELDS, batch_size=1000)
+    invalidate_registry()
+    return len(create_list), len(update_list)
+
+
+def _read_runways(runway_file: TextIO) -> dict[str: list[int]]:
+    """Read the headings of the open runways by 'airport_ident'.
+    """
+    runway_dict: dict[str: list[int]] = {}
+    for row in csv.DictReader(runway_file):
+        if row.get('closed') == '1':
+            continue
+        headings = runway_dict.setdefault(row.get('airport_ident'), [])
+        for end in ('le', 'he'):
+            heading = _to_float(row.get('%s_heading_degT' % end))
+            if heading is None:
+                match = RUNWAY_IDENT_RE.fullmatch(row.get('%s_ident' % end) or '')
+                if match is None:
+                    continue
+                heading = int(match.group(1)) * 10
+            heading = round(heading) % 360 or 360
+            if heading not in headings:
+                headings.append(heading)
+    return runway_dict
+
+
+def _get_icao_id(row: dict[str: str]) -> Optional[str]:
+    for name in ('icao_code', 'ident', 'gps_code'):
+        value = (row.get(name) or '').upper()
+        if ICAO_ID_RE.fullmatch(value):
+            return value
+    return None
+
+
+def _to_float(text: Optional[str]) -> Optional[float]:
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_int(text: Optional[str]) -> Optional[int]:
+    value = _to_float(text)
+    return None if value is None else round(value)
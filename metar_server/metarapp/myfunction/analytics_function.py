@@ -0,0 +1,257 @@
+from __future__ import annotations
+from datetime import datetime
+from itertools import islice
+import numpy as np
+from typing import Iterable, Iterator, Optional
+from ..models import Metar
+from . import search_function
+
+SERIES_FIELDS = (
+    'station_id', 'observation_time', 'temp_c', 'dewpoint_c', 'wind_dir_degrees', 'wind_speed_kt',
+    'wind_gust_kt', 'visibility_m', 'cloud_ceiling', 'vert_vis_ft', 'altim_in_hg'
+)
+# Derived quantities and the fields needed for them.
+DERIVED_FIELDS = {
+    'relative_humidity': ('temp_c', 'dewpoint_c'),
+    'flight_category': ('cloud_ceiling', 'vert_vis_ft', 'visibility_m'),
+    'headwind_kt': ('wind_dir_degrees', 'wind_speed_kt'),
+    'crosswind_kt': ('wind_dir_degrees', 'wind_speed_kt'),
+    'pressure_altitude_ft': ('altim_in_hg',)
+}
+RUNWAY_FIELDS = ('headwind_kt', 'crosswind_kt')
+FLIGHT_CATEGORIES = np.array(['VFR', 'MVFR', 'IFR', 'LIFR'])
+# Upper bounds of LIFR, IFR and MVFR. MVFR includes the bounds (3000 ft
+# and 5 SM), the others do not.
+CEILING_BOUNDS_FT = (500, 1000, 3000)
+VISIBILITY_BOUNDS_M = (1609, 4828, 8047)
+# Constants of the Magnus formula over water.
+MAGNUS_A = 17.625
+MAGNUS_B = 243.04
+STANDARD_ALTIM_IN_HG = 29.92126
+DERIVED_DECIMALS = 1
+
+
+def load_series(
+    stations: list[str],
+    start_time: datetime,
+    end_time: datetime,
+    field_names: Iterable[str] = SERIES_FIELDS
+) -> dict[str: np.ndarray]:
+    """Load METARs of the stations in the time range as columns.
+
+    The rows are read by values_list without Metar instances, with the
+    archived months, ordered by station and observation_time.
+
+    Args:
+        stations (list[str]): ICAO ids of the stations.
+        start_time (datetime): Start of the range (included).
+        end_time (datetime): End of the range (excluded).
+        field_names (Iterable[str], optional): Fields to be loaded.
+            Defaults to SERIES_FIELDS.
+
+    Returns:
+        dict[str: np.ndarray]: Field names and the columns from to_columns.
+    """
+    field_names = list(field_names)
+    # The keys are read for merging the archived months.
+    read_fields = field_names + [name for name in ('station_id', 'observation_time') if name not in field_names]
+    rows = search_function.iter_metar_rows(stations, start_time, end_time, read_fields, by_station=True)
+    return to_columns(list(rows), read_fields, field_names)
+
+
+def to_columns(
+    rows: list[tuple],
+    field_names: list[str],
+    names: Optional[Iterable[str]] = None
+) -> dict[str: np.ndarray]:
+    """Convert rows of values_list to columns.
+
+    Numeric fields are float64 and None is NaN. 'observation_time' is
+    datetime64[s] in UTC. The other fields are arrays of the values.
+
+    Args:
+        rows (list[tuple]): Rows of the fields.
+        field_names (list[str]): Field names of the rows.
+        names (Optional[Iterable[str]], optional): Fields to be converted.
+            Defaults to None (all fields).
+
+    Returns:
+        dict[str: np.ndarray]: Field names and the columns.
+    """
+    names = field_names if names is None else names
+    columns = {}
+    transposed = list(zip(*rows)) if rows else [()] * len(field_names)
+    for name in names:
+        values = transposed[field_names.index(name)]
+        field = Metar._meta.get_field(name)
+        internal_type = field.get_internal_type()
+        if internal_type == 'DateTimeField':
+            timestamps = np.fromiter(map(datetime.timestamp, values), np.float64, len(values))
+            columns[name] = timestamps.astype(np.int64).astype('datetime64[s]')
+        elif internal_type in ('CharField', 'TextField'):
+            columns[name] = np.array(values, dtype=object)
+        elif field.null:
+            column = np.array(values, dtype=object)
+            column[np.equal(column, None)] = np.nan
+            columns[name] = column.astype(np.float64)
+        else:
+            columns[name] = np.array(values, dtype=np.float64)
+    return columns
+
+
+def relative_humidity(temp_c: np.ndarray, dewpoint_c: np.ndarray) -> np.ndarray:
+    """Relative humidity (%) by the Magnus formula.
+    """
+    return 100 * np.exp(
+        MAGNUS_A * dewpoint_c / (MAGNUS_B + dewpoint_c) - MAGNUS_A * temp_c / (MAGNUS_B + temp_c)
+    )
+
+
+def wind_components(
+    wind_dir_degrees: np.ndarray,
+    wind_speed_kt: np.ndarray,
+    runway_heading: float
+) -> tuple[np.ndarray, np.ndarray]:
+    """Headwind and crosswind components for the runway heading.
+
+    Crosswind is positive from the right. Direction 0 is variable wind
+    (VRB) in Metar, so the components are NaN unless the wind is calm.
+
+    Args:
+        wind_dir_degrees (np.ndarray): Wind directions.
+        wind_speed_kt (np.ndarray): Wind speeds.
+        runway_heading (float): Heading of the runway in degrees.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Headwind and crosswind in knots.
+    """
+    angle = np.radians(wind_dir_degrees - runway_heading)
+    variable = (wind_dir_degrees == 0) & (wind_speed_kt > 0)
+    headwind = np.where(variable, np.nan, wind_speed_kt * np.cos(angle))
+    crosswind = np.where(variable, np.nan, wind_speed_kt * np.sin(angle))
+    return headwind, crosswind
+
+
+def flight_category(cloud_ceiling: np.ndarray, vert_vis_ft: np.ndarray, visibility_m: np.ndarray) -> np.ndarray:
+    """Flight category codes, the indexes of FLIGHT_CATEGORIES.
+
+    The ceiling is the lower of 'cloud_ceiling' (the lowest BKN or OVC
+    layer) and the vertical visibility. NaN ceiling is no ceiling.
+
+    Returns:
+        np.ndarray: 0 (VFR), 1 (MVFR), 2 (IFR) or 3 (LIFR).
+    """
+    ceiling = np.fmin(cloud_ceiling, vert_vis_ft)
+    # NaN is larger than the bounds for searchsorted.
+    ceiling_category = 3 - np.searchsorted(CEILING_BOUNDS_FT, ceiling, side='right')
+    ceiling_category[ceiling == CEILING_BOUNDS_FT[2]] = 1
+    visibility_category = 3 - np.searchsorted(VISIBILITY_BOUNDS_M, visibility_m, side='right')
+    visibility_category[visibility_m == VISIBILITY_BOUNDS_M[2]] = 1
+    return np.maximum(ceiling_category, visibility_category)
+
+
+def pressure_altitude(altim_in_hg: np.ndarray, elevation_ft: float = 0.0) -> np.ndarray:
+    """Pressure altitude (ft) of the field from the altimeter setting.
+    """
+    return elevation_ft + 145366.45 * (1 - (altim_in_hg / STANDARD_ALTIM_IN_HG) ** 0.190284)
+
+
+def derive(
+    columns: dict[str: np.ndarray],
+    derived_names: Iterable[str],
+    runway_heading: Optional[float] = None,
+    elevation_ft: float = 0.0
+) -> dict[str: np.ndarray]:
+    """Compute the derived quantities from the columns.
+
+    Args:
+        columns (dict[str: np.ndarray]): Columns including the fields of
+            DERIVED_FIELDS of the names.
+        derived_names (Iterable[str]): Keys of DERIVED_FIELDS.
+        runway_heading (Optional[float], optional): Heading for the wind
+            components. Defaults to None.
+        elevation_ft (float, optional): Field elevation for the pressure
+            altitude. Defaults to 0.0.
+
+    Raises:
+        ValueError: If a wind component is required without runway_heading.
+
+    Returns:
+        dict[str: np.ndarray]: Names and the derived columns.
+            'flight_category' is the labels.
+    """
+    derived = {}
+    for name in derived_names:
+        if name == 'relative_humidity':
+            derived[name] = relative_humidity(columns['temp_c'], columns['dewpoint_c'])
+        elif name == 'flight_category':
+            codes = flight_category(columns['cloud_ceiling'], columns['vert_vis_ft'], columns['visibility_m'])
+            derived[name] = FLIGHT_CATEGORIES[codes]
+        elif name in RUNWAY_FIELDS:
+            if runway_heading is None:
+                raise ValueError('%s needs the runway heading' % name)
+            headwind, crosswind = wind_components(
+                columns['wind_dir_degrees'],
+                columns['wind_speed_kt'],
+                runway_heading
+            )
+            derived[name] = headwind if name == 'headwind_kt' else crosswind
+        elif name == 'pressure_altitude_ft':
+            derived[name] = pressure_altitude(columns['altim_in_hg'], elevation_ft)
+        else:
+            raise ValueError('Unknown derived quantity: %s' % name)
+    return derived
+
+
+def get_source_fields(derived_names: Iterable[str]) -> list[str]:
+    """Get the fields needed for the derived quantities without duplicates.
+    """
+    return list(dict.fromkeys(name for derived_name in derived_names for name in DERIVED_FIELDS[derived_name]))
+
+
+def iter_derived_rows(
+    rows: Iterable[tuple],
+    field_names: list[str],
+    derived_names: list[str],
+    chunk_size: int = 2000,
+    runway_heading: Optional[float] = None,
+    elevation_ft: float = 0.0
+) -> Iterator[tuple]:
+    """Add the derived quantities to the rows of values_list by chunks.
+
+    The fields of the rows should include get_source_fields(derived_names).
+    NaN is None and the numbers are rounded to DERIVED_DECIMALS.
+
+    Args:
+        rows (Iterable[tuple]): Rows of the fields.
+        field_names (list[str]): Field names of the rows.
+        derived_names (list[str]): Keys of DERIVED_FIELDS.
+        chunk_size (int, optional): The number of rows computed at once.
+            Defaults to 2000.
+        runway_heading (Optional[float], optional): Heading for the wind
+            components. Defaults to None.
+        elevation_ft (float, optional): Field elevation for the pressure
+            altitude. Defaults to 0.0.
+
+    Yields:
+        Iterator[tuple]: The rows with the derived values.
+    """
+    source_fields = get_source_fields(derived_names)
+    row_iterator = iter(rows)
+    while True:
+        chunk = list(islice(row_iterator, chunk_size))
+        if not chunk:
+            return
+        columns = to_columns(chunk, field_names, source_fields)
+        derived = derive(columns, derived_names, runway_heading, elevation_ft)
+        derived_lists = [_to_list(derived[name]) for name in derived_names]
+        for row, values in zip(chunk, zip(*derived_lists)):
+            yield row + values
+
+
+def _to_list(column: np.ndarray) -> list:
+    if column.dtype.kind != 'f':
+        return column.tolist()
+    rounded = np.round(column, DERIVED_DECIMALS).astype(object)
+    rounded[np.isnan(column)] = None
+    return rounded.tolist()
@@ -0,0 +1,325 @@
+from __future__ import annotations
+import heapq
+import json
+import os
+import shutil
+import zlib
+from datetime import date, datetime, timedelta
+from itertools import chain
+from operator import itemgetter
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+from typing import Iterable, Iterator, Optional
+from ..models import ArchivedMonth, Metar
+from . import partition_function
+
+# Fixed-width columns of the numeric fields. -1 is None of the nullable
+# integers, and 'metar_type' is the index of METAR_TYPES.
+ARCHIVE_DTYPE = np.dtype([
+    ('temp_c', '<f8'),
+    ('dewpoint_c', '<f8'),
+    ('wind_dir_degrees', '<i2'),
+    ('wind_speed_kt', '<i2'),
+    ('wind_gust_kt', '<i2'),
+    ('visibility_m', '<i2'),
+    ('altim_in_hg', '<f8'),
+    ('cloud_ceiling', '<i4'),
+    ('vert_vis_ft', '<i4'),
+    ('metar_type', 'i1')
+])
+NULLABLE_FIELDS = ('wind_gust_kt', 'cloud_ceiling', 'vert_vis_ft')
+TEXT_FIELDS = ('raw_text', 'wx_string')
+METAR_TYPES = (Metar.METAR, Metar.SPECI)
+ARCHIVE_FIELDS = ('observation_time',) + TEXT_FIELDS + ARCHIVE_DTYPE.names
+# The number of rows in a compressed block of the texts.
+TEXT_BLOCK_SIZE = 256
+TIME_FILE = 'time.npy'
+COLUMN_FILE = 'columns.npy'
+TEXT_FILE = 'text.bin'
+TEXT_INDEX_FILE = 'text_index.npy'
+
+
+class ArchiveReader():
+    """Reader of the METARs of a station in an archived month.
+
+    The files of a month are:
+
+    - time.npy: observation_time (UTC epoch seconds, sorted), the index of
+      the rows.
+    - columns.npy: the numeric fields in ARCHIVE_DTYPE.
+    - text.bin: raw_text and wx_string compressed by blocks of
+      TEXT_BLOCK_SIZE rows.
+    - text_index.npy: offsets of the blocks in text.bin.
+
+    The arrays are memory-mapped, so only the rows in the range are read.
+
+    Attributes:
+        station_id (str): ICAO id of the station.
+        path (str): Directory of the files.
+    """
+    def __init__(self, station_id: str, path: str) -> None:
+        self.station_id = station_id
+        self.path = path
+        self.__times = np.load(os.path.join(path, TIME_FILE), mmap_mode='r')
+        self.__columns = np.load(os.path.join(path, COLUMN_FILE), mmap_mode='r')
+        self.__text_index = np.load(os.path.join(path, TEXT_INDEX_FILE))
+
+    def __len__(self) -> int:
+        return len(self.__times)
+
+    def find_range(self, start_time: datetime, end_time: datetime) -> tuple[int, int]:
+        """Get the row range of the time range by binary search.
+
+        Args:
+            start_time (datetime): Start of the range (included).
+            end_time (datetime): End of the range (excluded).
+
+        Returns:
+            tuple[int, int]: Start and end indexes of the rows.
+        """
+        start_index = int(np.searchsorted(self.__times, start_time.timestamp(), side='left'))
+        end_index = int(np.searchsorted(self.__times, end_time.timestamp(), side='left'))
+        return start_index, end_index
+
+    def iter_rows(self, field_names: Iterable[str], start_index: int = 0, end_index: int = None) -> Iterator[tuple]:
+        """Read the rows as values_list of Metar.
+
+        Args:
+            field_names (Iterable[str]): Fields of Metar except 'id'.
+            start_index (int, optional): The first row. Defaults to 0.
+            end_index (int, optional): The end of the rows (excluded).
+                Defaults to None (the last row).
+
+        Returns:
+            Iterator[tuple]: Rows of the fields.
+        """
+        end_index = len(self) if end_index is None else end_index
+        count = max(end_index - start_index, 0)
+        columns = self.__columns[start_index:end_index]
+        texts = None
+        value_lists = []
+        for name in field_names:
+            if name == 'station_id':
+                value_lists.append([self.station_id] * count)
+            elif name == 'observation_time':
+                value_lists.append([
+                    datetime.fromtimestamp(timestamp, timezone.utc)
+                    for timestamp in self.__times[start_index:end_index].tolist()
+                ])
+            elif name in TEXT_FIELDS:
+                if texts is None:
+                    texts = self.read_texts(start_index, end_index)
+                value_lists.append([text[TEXT_FIELDS.index(name)] for text in texts])
+            elif name == 'metar_type':
+                value_lists.append([METAR_TYPES[value] for value in columns[name].tolist()])
+            elif name in NULLABLE_FIELDS:
+                value_lists.append([None if value < 0 else value for value in columns[name].tolist()])
+            else:
+                value_lists.append(columns[name].tolist())
+        return zip(*value_lists)
+
+    def read_texts(self, start_index: int, end_index: int) -> list[list[str]]:
+        """Decompress the blocks of the rows and get raw_text and wx_string.
+        """
+        if end_index <= start_index:
+            return []
+        first_block = start_index // TEXT_BLOCK_SIZE
+        last_block = (end_index - 1) // TEXT_BLOCK_SIZE
+        texts = []
+        with open(os.path.join(self.path, TEXT_FILE), 'rb') as text_file:
+            text_file.seek(int(self.__text_index[first_block]))
+            for block in range(first_block, last_block + 1):
+                size = int(self.__text_index[block + 1] - self.__text_index[block])
+                texts.extend(json.loads(zlib.decompress(text_file.read(size))))
+        offset = first_block * TEXT_BLOCK_SIZE
+        return texts[start_index - offset:end_index - offset]
+
+
+def get_archive_dir() -> str:
+    return getattr(settings, 'METAR_ARCHIVE_DIR', os.path.join(settings.BASE_DIR, 'metar_archive'))
+
+
+def write_month(path: str, rows: list[tuple]) -> None:
+    """Write the rows of ARCHIVE_FIELDS ordered by observation_time to the
+    files of a month.
+
+    The files are written to a temporary directory and replace the old
+    directory at once.
+
+    Args:
+        path (str): Directory of the files.
+        rows (list[tuple]): Rows of ARCHIVE_FIELDS.
+    """
+    columns = np.zeros(len(rows), dtype=ARCHIVE_DTYPE)
+    value_lists = list(zip(*rows)) if rows else [()] * len(ARCHIVE_FIELDS)
+    times = np.array([value.timestamp() for value in value_lists[0]], dtype=np.int64)
+    for name in ARCHIVE_DTYPE.names:
+        values = value_lists[ARCHIVE_FIELDS.index(name)]
+        if name == 'metar_type':
+            values = [METAR_TYPES.index(value) for value in values]
+        elif name in NULLABLE_FIELDS:
+            values = [-1 if value is None else value for value in values]
+        columns[name] = values
+    texts = [list(text) for text in zip(value_lists[1], value_lists[2])]
+
+    temporary_path = path + '.tmp'
+    shutil.rmtree(temporary_path, ignore_errors=True)
+    os.makedirs(temporary_path)
+    np.save(os.path.join(temporary_path, TIME_FILE), times)
+    np.save(os.path.join(temporary_path, COLUMN_FILE), columns)
+    offsets = [0]
+    with open(os.path.join(temporary_path, TEXT_FILE), 'wb') as text_file:
+        for i in range(0, len(texts), TEXT_BLOCK_SIZE):
+            block = zlib.compress(json.dumps(texts[i:i + TEXT_BLOCK_SIZE]).encode(), 9)
+            text_file.write(block)
+            offsets.append(offsets[-1] + len(block))
+    np.save(os.path.join(temporary_path, TEXT_INDEX_FILE), np.array(offsets, dtype=np.int64))
+    old_path = path + '.old'
+    if os.path.exists(path):
+        os.replace(path, old_path)
+    os.replace(temporary_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def archive_month(station_id: str, month: date) -> int:
+    """Move METARs of the station in the month (UTC) to the archive.
+
+    If the month is already archived, the stored rows are merged into the
+    files (the rows in Metar win for the same observation_time).
+
+    Args:
+        station_id (str): ICAO id of the station.
+        month (date): The first day of the month.
+
+    Returns:
+        int: The number of the rows deleted from Metar.
+    """
+    start_time = _utc_datetime(month)
+    end_time = _utc_datetime(partition_function.add_months(month, 1))
+    stored_query = Metar.objects \
+        .filter(
+            station_id=station_id,
+            observation_time__gte=start_time,
+            observation_time__lt=end_time
+        ) \
+        .values_list('id', *ARCHIVE_FIELDS)
+    stored_rows = list(stored_query)
+    archived = ArchivedMonth.objects.filter(station_id=station_id, month=month).first()
+    relative_path = os.path.join(station_id, month.strftime(r'%Y-%m'))
+    row_dict = {}
+    if archived is not None:
+        reader = ArchiveReader(station_id, os.path.join(get_archive_dir(), archived.path))
+        row_dict.update((row[0], row) for row in reader.iter_rows(ARCHIVE_FIELDS))
+    row_dict.update((row[1], row[1:]) for row in stored_rows)
+    rows = [row_dict[key] for key in sorted(row_dict)]
+    write_month(os.path.join(get_archive_dir(), relative_path), rows)
+    with transaction.atomic():
+        ArchivedMonth.objects.update_or_create(
+            station_id=station_id,
+            month=month,
+            defaults={'path': relative_path, 'count': len(rows)}
+        )
+        id_list = [row[0] for row in stored_rows]
+        for i in range(0, len(id_list), 1000):
+            Metar.objects.filter(id__in=id_list[i:i + 1000]).delete()
+    return len(stored_rows)
+
+
+def find_closed_months(older_than_months: int, stations: Optional[list[str]] = None) -> list[tuple[str, date]]:
+    """Get stations and months (UTC) of the METARs in Metar which ended
+    more than the months ago.
+
+    Args:
+        older_than_months (int): The number of the months after the end.
+        stations (Optional[list[str]], optional): ICAO ids of the stations.
+            Defaults to None (all stations).
+
+    Returns:
+        list[tuple[str, date]]: Stations and the first days of the months.
+    """
+    this_month = timezone.now().date().replace(day=1)
+    cutoff = _utc_datetime(partition_function.add_months(this_month, -older_than_months))
+    metar_query = Metar.objects.filter(observation_time__lt=cutoff)
+    if stations is not None:
+        metar_query = metar_query.filter(station_id__in=stations)
+    month_query = metar_query \
+        .annotate(month=TruncMonth('observation_time', tzinfo=timezone.utc)) \
+        .values_list('station_id', 'month') \
+        .order_by('station_id', 'month') \
+        .distinct()
+    return [(station_id, _to_date(month)) for station_id, month in month_query]
+
+
+def get_archived_months(stations: list[str], start_time: datetime, end_time: datetime) -> list[ArchivedMonth]:
+    """Get the archived months of the stations overlapping the time range.
+    """
+    if end_time <= start_time:
+        return []
+    archived_query = ArchivedMonth.objects \
+        .filter(
+            station_id__in=stations,
+            month__gte=start_time.astimezone(timezone.utc).date().replace(day=1),
+            month__lte=(end_time - timedelta(microseconds=1)).astimezone(timezone.utc).date()
+        ) \
+        .order_by('station_id', 'month')
+    return list(archived_query)
+
+
+def iter_archive_rows(
+    archived_months: list[ArchivedMonth],
+    start_time: datetime,
+    end_time: datetime,
+    field_names: list[str],
+    by_station: bool = False
+) -> Iterator[tuple]:
+    """Read the rows of the archived months in the time range.
+
+    The field names should include 'station_id' and 'observation_time'.
+
+    Args:
+        archived_months (list[ArchivedMonth]): Months from
+            get_archived_months.
+        start_time (datetime): Start of the range (included).
+        end_time (datetime): End of the range (excluded).
+        field_names (list[str]): Fields of Metar except 'id'.
+        by_station (bool, optional): Order by station and observation_time
+            if True, otherwise observation_time and station. Defaults to
+            False.
+
+    Returns:
+        Iterator[tuple]: Rows of the fields.
+    """
+    station_dict: dict[str: list[ArchivedMonth]] = {}
+    for archived in archived_months:
+        station_dict.setdefault(archived.station_id, []).append(archived)
+    station_iterators = [
+        chain.from_iterable(_iter_month_rows(archived, start_time, end_time, field_names) for archived in month_list)
+        for _, month_list in sorted(station_dict.items())
+    ]
+    if by_station:
+        return chain.from_iterable(station_iterators)
+    key = itemgetter(field_names.index('observation_time'), field_names.index('station_id'))
+    return heapq.merge(*station_iterators, key=key)
+
+
+def get_archived_stations(stations: list[str], start_time: datetime, end_time: datetime) -> set[str]:
+    """Get the stations which have archived months in the time range.
+    """
+    return {archived.station_id for archived in get_archived_months(stations, start_time, end_time)}
+
+
+def _iter_month_rows(archived: ArchivedMonth, start_time: datetime, end_time: datetime, field_names: list[str]):
+    reader = ArchiveReader(archived.station_id, os.path.join(get_archive_dir(), archived.path))
+    start_index, end_index = reader.find_range(start_time, end_time)
+    return reader.iter_rows(field_names, start_index, end_index)
+
+
+def _utc_datetime(day: date) -> datetime:
+    return datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+
+
+def _to_date(value) -> date:
+    return value.date() if isinstance(value, datetime) else value
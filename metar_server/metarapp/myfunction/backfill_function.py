@@ -0,0 +1,218 @@
+from __future__ import annotations
+import csv
+import gzip
+import json
+import os
+import re
+from datetime import date
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.utils import timezone
+from typing import Callable, Iterator, Optional, TextIO
+from ..models import Metar
+from ..signals import metars_inserted
+from . import metar_function, partition_function, writer_function
+
+XML_SUFFIXES = ('.xml', '.xml.gz')
+CSV_SUFFIXES = ('.csv', '.csv.gz')
+
+
+def find_archive_files(path_list: list[str]) -> list[str]:
+    """Get archive files from the paths. Directories are searched
+    recursively for XML and CSV files, optionally gzip-compressed.
+
+    Args:
+        path_list (list[str]): Paths of files or directories.
+
+    Returns:
+        list[str]: Sorted absolute paths of the archive files, which are the
+            keys of the checkpoint.
+    """
+    file_list = []
+    for path in map(os.path.abspath, path_list):
+        if not os.path.isdir(path):
+            file_list.append(path)
+            continue
+        for root, _, names in os.walk(path):
+            for name in names:
+                if name.endswith(XML_SUFFIXES + CSV_SUFFIXES):
+                    file_list.append(os.path.join(root, name))
+    return sorted(file_list)
+
+
+def load_archive_file(path: str, batch_size: int = 5000) -> dict[str: int]:
+    """Load METARs in the archive file to database.
+
+    The rows are parsed, validated, and inserted by batches skipping the
+    stored rows. 'metars_inserted' is sent once after the file, even if it
+    fails, with the newest inserted METAR of each station and local day.
+    So the receivers rebuild the rollups and remove the cache of each
+    station-day once, instead of after every batch.
+
+    Args:
+        path (str): Path of the archive file.
+        batch_size (int, optional): The number of rows inserted at once.
+            Defaults to 5000.
+
+    Returns:
+        dict[str: int]: The numbers of 'parsed', 'inserted' and 'invalid'
+            rows.
+    """
+    result = {'parsed': 0, 'inserted': 0, 'invalid': 0}
+
+    def count_invalid(error: Exception) -> None:
+        result['invalid'] += 1
+
+    partitioned = connection.vendor == 'postgresql' and partition_function.is_partitioned()
+    partition_months: set[date] = set()
+    newest_dict: dict[tuple[str, date]: Metar] = {}
+    try:
+        for batch in iter_file_batches(path, batch_size, count_invalid):
+            valid_list = []
+            for metar in batch:
+                try:
+                    metar.clean_fields()
+                except ValidationError as e:
+                    count_invalid(e)
+                    continue
+                valid_list.append(metar)
+            result['parsed'] += len(batch)
+            if not valid_list:
+                continue
+            if partitioned:
+                months = {metar.observation_time.date().replace(day=1) for metar in valid_list}
+                if not months <= partition_months:
+                    partition_function.create_partitions(min(months), max(months))
+                    partition_months |= months
+            inserted = writer_function.insert_metars(valid_list)
+            result['inserted'] += len(inserted)
+            for metar in inserted:
+                key = (metar.station_id, timezone.localtime(metar.observation_time).date())
+                if key not in newest_dict or newest_dict[key].observation_time < metar.observation_time:
+                    newest_dict[key] = metar
+    finally:
+        if newest_dict:
+            metars_inserted.send(sender=Metar, metars=list(newest_dict.values()))
+    return result
+
+
+def iter_file_batches(
+    path: str,
+    batch_size: int = 5000,
+    on_error: Optional[Callable[[Exception], None]] = None
+) -> Iterator[list[Metar]]:
+    """Parse the archive file incrementally and yield Metar models.
+
+    AWC-style XML and CSV files are supported. Files ending with '.gz' are
+    decompressed while they are read.
+
+    Args:
+        path (str): Path of the archive file.
+        batch_size (int, optional): The number of Metar in a batch.
+            Defaults to 5000.
+        on_error (Optional[Callable[[Exception], None]], optional): Called
+            with the error of a row and the row is skipped. Defaults to None.
+
+    Raises:
+        ValueError: Raises if the file type is not supported.
+
+    Yields:
+        Iterator[list[Metar]]: Lists of at most batch_size Metar.
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    if path.endswith(XML_SUFFIXES):
+        with opener(path, 'rb') as f:
+            yield from metar_function.iter_metar_batches(f, batch_size, on_error)
+    elif path.endswith(CSV_SUFFIXES):
+        with opener(path, 'rt', newline='') as f:
+            yield from iter_csv_batches(f, batch_size, on_error)
+    else:
+        raise ValueError('%s is not XML or CSV file' % path)
+
+
+def iter_csv_batches(
+    f: TextIO,
+    batch_size: int = 5000,
+    on_error: Optional[Callable[[Exception], None]] = None
+) -> Iterator[list[Metar]]:
+    """Parse CSV data of METAR and yield Metar models.
+
+    Both of AWC CSV data and CSV files exported by this app are supported,
+    and the missing columns are decoded from 'raw_text'. Lines before the
+    header starting with 'raw_text' are skipped. The ceiling is the base of
+    the lowest BKN or OVC layer in the repeated 'sky_cover' and
+    'cloud_base_ft_agl' columns, or 'cloud_ceiling' column.
+
+    Args:
+        f (TextIO): File object of the CSV data.
+        batch_size (int, optional): The number of Metar in a batch.
+            Defaults to 5000.
+        on_error (Optional[Callable[[Exception], None]], optional): Called
+            with the error of a row and the row is skipped. If it is None,
+            the error is raised. Defaults to None.
+
+    Yields:
+        Iterator[list[Metar]]: Lists of at most batch_size Metar.
+    """
+    header = None
+    batch = []
+    for row in csv.reader(f):
+        if header is None:
+            if row and row[0] == 'raw_text':
+                header = row
+            continue
+        texts: dict[str: Optional[str]] = {'cloud_ceiling': None} if 'sky_cover' in header else {}
+        for i, (name, value) in enumerate(zip(header, row)):
+            if name == 'sky_cover':
+                if texts['cloud_ceiling'] is None and value in metar_function.CEILING_COVERS:
+                    texts['cloud_ceiling'] = row[i + 1] or None
+            elif name not in texts:
+                texts[name] = value or None
+        try:
+            metar = metar_function.create_metar(texts)
+        except (KeyError, TypeError, ValueError, re.error) as e:
+            if on_error is None:
+                raise
+            on_error(e)
+            continue
+        if metar is None:
+            continue
+        batch.append(metar)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def load_checkpoint(path: Optional[str]) -> dict[str: dict[str: int]]:
+    """Load the results of the loaded files.
+
+    Args:
+        path (Optional[str]): Path of the checkpoint file.
+
+    Returns:
+        dict[str: dict[str: int]]: Absolute paths of the archive files and
+            the results. The relative paths of the older checkpoints are
+            made absolute from the current directory.
+    """
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return {os.path.abspath(file_path): result for file_path, result in json.load(f).items()}
+
+
+def save_checkpoint(path: Optional[str], checkpoint: dict[str: dict[str: int]]) -> None:
+    """Save the results of the loaded files atomically.
+
+    Args:
+        path (Optional[str]): Path of the checkpoint file.
+        checkpoint (dict[str: dict[str: int]]): Archive file paths and the
+            results.
+    """
+    if path is None:
+        return
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(temp_path, path)
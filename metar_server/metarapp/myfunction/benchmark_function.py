@@ -0,0 +1,432 @@
+from __future__ import annotations
+import io
+import platform
+import statistics
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import django
+import numpy as np
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client
+from django.utils import timezone
+from typing import Callable, Iterator
+from ..models import Airport, Metar
+from . import airport_function, cache_function, metar_function, writer_function
+
+# Observations of the seeded rows end at this time, so the same seed makes
+# the same table.
+SEED_END_TIME = datetime(2021, 1, 1, tzinfo=timezone.utc)
+SEED_BATCH_SIZE = 10000
+SEED_INTERVAL = timedelta(minutes=30)
+BENCHMARK_USER = 'benchmark'
+
+METAR_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<response>
+  <data num_results="%d">
+%s
+  </data>
+</response>'''
+
+METAR_ELEMENT = '''    <METAR>
+      <raw_text>%(raw_text)s</raw_text>
+      <station_id>%(station_id)s</station_id>
+      <observation_time>%(observation_time)s</observation_time>
+      <temp_c>%(temp_c).1f</temp_c>
+      <dewpoint_c>%(dewpoint_c).1f</dewpoint_c>
+      <wind_dir_degrees>%(wind_dir_degrees)d</wind_dir_degrees>
+      <wind_speed_kt>%(wind_speed_kt)d</wind_speed_kt>
+      <altim_in_hg>%(altim_in_hg).2f</altim_in_hg>
+      <sky_condition sky_cover="BKN" cloud_base_ft_agl="%(cloud_ceiling)d" />
+      <metar_type>METAR</metar_type>
+    </METAR>'''
+
+
+class BenchmarkRunner():
+    """Benchmarks of the ingest, search and export paths.
+
+    The benchmarks should run on a test database, because the table is
+    filled with synthetic METARs. The rows are generated from 'seed', so
+    the runs are reproducible.
+
+    Metric names end with the unit: '_per_s' is better if higher, '_ms'
+    and '_bytes' are better if lower.
+
+    Attributes:
+        station_count (int): The number of the synthetic stations.
+        fetch_hours (int): Hours of the synthetic AWC response.
+        repeat (int): Repetitions of the latency benchmarks.
+        seed (int): Seed of the synthetic data.
+    """
+    def __init__(self, station_count: int = 100, fetch_hours: int = 25, repeat: int = 20, seed: int = 0) -> None:
+        self.station_count = station_count
+        self.fetch_hours = fetch_hours
+        self.repeat = repeat
+        self.seed = seed
+        self.stations = get_station_list(station_count)
+
+    def run(self, size: int) -> dict[str: dict[str: float]]:
+        """Seed the table to the size and run all benchmarks.
+
+        Args:
+            size (int): The number of the rows of Metar.
+
+        Returns:
+            dict[str: dict[str: float]]: Benchmark names and the metrics.
+        """
+        seed_metars(size, self.stations, self.seed)
+        return {
+            'parse': self.bench_parse(),
+            'get_models': self.bench_get_models(),
+            'insert': self.bench_insert(),
+            'index_day': self.bench_index_day(),
+            'csv_export': self.bench_csv_export(),
+            'airport_newest': self.bench_airport_newest()
+        }
+
+    def bench_parse(self) -> dict[str: float]:
+        """Parse throughput of the AWC XML without the network and database.
+        """
+        element_dict = create_metar_elements(self.stations, self.__get_fetch_times(), self.seed)
+        xml = create_awc_xml([element for elements in element_dict.values() for element in elements])
+        seconds, count = _measure(lambda: sum(map(len, metar_function.iter_metar_batches(io.BytesIO(xml)))))
+        return {'rows': count, 'rows_per_s': count / seconds}
+
+    def bench_get_models(self) -> dict[str: float]:
+        """MetarInput.get_models from a local stub server, before and after
+        the rows are stored (all duplicates).
+        """
+        fetch_times = self.__get_fetch_times()
+        server = _start_stub_server(create_metar_elements(self.stations, fetch_times, self.seed))
+        try:
+            url = 'http://127.0.0.1:%s/' % server.server_port
+            seconds, metars = _measure(lambda: self.__create_input(url).get_models())
+            result = {'rows': len(metars), 'rows_per_s': len(metars) / seconds}
+            writer_function.insert_metars(metars)
+            seconds, metar_input = _measure(lambda: _get_models_input(self.__create_input(url)))
+            result['duplicates_per_s'] = metar_input.duplicate_count / seconds
+            Metar.objects.filter(observation_time__gte=fetch_times[0]).delete()
+        finally:
+            server.shutdown()
+            server.server_close()
+        return result
+
+    def bench_insert(self) -> dict[str: float]:
+        """Insert rate of the writer of MetarInput by its batches.
+        """
+        start_time = timezone.now() + timedelta(days=3650)
+        metars = [
+            metar
+            for batch in generate_metars(0, SEED_BATCH_SIZE, self.stations, self.seed, start_time)
+            for metar in batch
+        ]
+        metar_input = metar_function.MetarInput([])
+        batches = [metars[i:i + metar_input.batch_size] for i in range(0, len(metars), metar_input.batch_size)]
+        seconds, _ = _measure(lambda: [metar_input.writer.write(batch) for batch in batches])
+        Metar.objects.filter(observation_time__gt=start_time - timedelta(days=3650)).delete()
+        return {'rows': len(metars), 'rows_per_s': len(metars) / seconds}
+
+    def bench_index_day(self) -> dict[str: float]:
+        """Latency of the index view of one station-day, without and with the
+        day cache.
+        """
+        client = _create_client()
+        day = timezone.localtime(SEED_END_TIME - timedelta(days=1)).strftime(r'%Y-%m-%d')
+        data = {'icao': self.stations[0], 'search_date': day, 'metar_order': 'asc'}
+
+        def post_cold():
+            cache_function.get_metar_cache().clear()
+            return client.post('/metarapp/', data)
+        cold = _repeat(post_cold, self.repeat)
+        warm = _repeat(lambda: client.post('/metarapp/', data), self.repeat)
+        return {
+            'cold_median_ms': statistics.median(cold) * 1000,
+            'warm_median_ms': statistics.median(warm) * 1000,
+            'warm_p95_ms': _percentile(warm, 95) * 1000
+        }
+
+    def bench_csv_export(self) -> dict[str: float]:
+        """CSV export of the whole seeded range of one station: rows per
+        second and the peak of the traced memory.
+        """
+        client = _create_client()
+        oldest = Metar.objects.filter(station_id=self.stations[0]).order_by('observation_time').first()
+        if oldest is None:
+            return {}
+        data = {
+            'icao': self.stations[0],
+            'search_date': timezone.localtime(oldest.observation_time).strftime(r'%Y-%m-%d'),
+            'end_date': timezone.localtime(SEED_END_TIME).strftime(r'%Y-%m-%d'),
+            'metar_order': 'asc',
+            'submit_csv': 'CSV'
+        }
+
+        def export() -> int:
+            response = client.post('/metarapp/', data)
+            return sum(1 for _ in response.streaming_content) - 1
+        seconds, count = _measure(export)
+        tracemalloc.start()
+        try:
+            export()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return {'rows': count, 'rows_per_s': count / seconds, 'peak_bytes': peak}
+
+    def bench_airport_newest(self) -> dict[str: float]:
+        """Latency of AirportMetarNewest of all stations with StationStatus.
+        """
+        if not Airport.objects.exists():
+            Airport.objects.bulk_create([
+                Airport(station_id=station_id, register_date=SEED_END_TIME.date(), is_fetched=True)
+                for station_id in self.stations
+            ])
+            airport_function.invalidate_registry()
+        airport_function.refresh_station_status(self.stations)
+        latencies = _repeat(airport_function.AirportMetarNewest, self.repeat)
+        return {'median_ms': statistics.median(latencies) * 1000}
+
+    def __get_fetch_times(self) -> list[datetime]:
+        now = timezone.now().replace(minute=0, second=0, microsecond=0)
+        return [now - timedelta(hours=hour) for hour in range(self.fetch_hours, 0, -1)]
+
+    def __create_input(self, url: str) -> metar_function.MetarInput:
+        metar_input = metar_function.MetarInput(self.stations, hour=self.fetch_hours)
+        metar_input.url = url
+        return metar_input
+
+
+def get_station_list(station_count: int) -> list[str]:
+    """Get ICAO-like ids of the synthetic stations, like 'Z001'.
+    """
+    return ['Z%03d' % i for i in range(station_count)]
+
+
+def generate_metars(
+    start_index: int,
+    count: int,
+    stations: list[str],
+    seed: int,
+    end_time: datetime = SEED_END_TIME
+) -> Iterator[list[Metar]]:
+    """Generate synthetic METARs by batches of SEED_BATCH_SIZE.
+
+    The row of an index is a report of stations[index % len(stations)],
+    (index // len(stations)) intervals before end_time. The values are
+    random from the seed and the index of the batch.
+
+    Args:
+        start_index (int): Index of the first row.
+        count (int): The number of the rows.
+        stations (list[str]): ICAO ids of the stations.
+        seed (int): Seed of the values.
+        end_time (datetime, optional): Time of the newest rows. Defaults to
+            SEED_END_TIME.
+
+    Yields:
+        Iterator[list[Metar]]: Lists of Metar models.
+    """
+    for batch_start in range(start_index, start_index + count, SEED_BATCH_SIZE):
+        batch_count = min(SEED_BATCH_SIZE, start_index + count - batch_start)
+        values = _random_values(seed, batch_start, batch_count)
+        batch = []
+        for i in range(batch_count):
+            index = batch_start + i
+            station_id = stations[index % len(stations)]
+            observation_time = end_time - SEED_INTERVAL * (index // len(stations))
+            row = {name: column[i] for name, column in values.items()}
+            row['raw_text'] = _raw_text(station_id, observation_time, row)
+            batch.append(Metar(station_id=station_id, observation_time=observation_time, **row))
+        yield batch
+
+
+def seed_metars(size: int, stations: list[str], seed: int) -> int:
+    """Insert synthetic METARs until Metar has the rows of the size.
+
+    Args:
+        size (int): The number of the rows.
+        stations (list[str]): ICAO ids of the stations.
+        seed (int): Seed of the values.
+
+    Returns:
+        int: The number of the inserted rows.
+    """
+    stored_count = Metar.objects.count()
+    inserted_count = 0
+    for batch in generate_metars(stored_count, max(size - stored_count, 0), stations, seed):
+        inserted_count += len(writer_function.insert_metars(batch))
+    return inserted_count
+
+
+def create_metar_elements(
+    stations: list[str],
+    observation_times: list[datetime],
+    seed: int
+) -> dict[str: list[str]]:
+    """Create 'METAR' elements of AWC XML of the stations at the times.
+
+    Returns:
+        dict[str: list[str]]: ICAO ids and the elements.
+    """
+    values = _random_values(seed, 0, len(stations) * len(observation_times))
+    element_dict: dict[str: list[str]] = {station_id: [] for station_id in stations}
+    for i, (observation_time, station_id) in enumerate(
+        (observation_time, station_id) for observation_time in observation_times for station_id in stations
+    ):
+        row = {name: column[i] for name, column in values.items()}
+        element_dict[station_id].append(METAR_ELEMENT % dict(
+            row,
+            raw_text=_raw_text(station_id, observation_time, row),
+            station_id=station_id,
+            observation_time=observation_time.strftime(r'%Y-%m-%dT%H:%M:%SZ')
+        ))
+    return element_dict
+
+
+def create_awc_xml(elements: list[str]) -> bytes:
+    """Create AWC XML response of the 'METAR' elements.
+    """
+    return (METAR_XML % (len(elements), '\n'.join(elements))).encode()
+
+
+def compare_results(
+    current: dict[str: dict],
+    baseline: dict[str: dict],
+    tolerance: float = 0.2
+) -> list[str]:
+    """Compare the results with the baseline and get the regressions.
+
+    A metric regresses if it is worse than the baseline by more than the
+    tolerance (ratio). Metrics missing in either result are ignored.
+
+    Args:
+        current (dict[str: dict]): Sizes and the results from run().
+        baseline (dict[str: dict]): Results in the same form.
+        tolerance (float, optional): Allowed ratio. Defaults to 0.2.
+
+    Returns:
+        list[str]: Descriptions of the regressions.
+    """
+    regressions = []
+    for size, benchmarks in current.items():
+        for name, metrics in benchmarks.items():
+            base_metrics = baseline.get(size, {}).get(name, {})
+            for metric, value in metrics.items():
+                base_value = base_metrics.get(metric)
+                if not base_value:
+                    continue
+                if metric.endswith('_per_s'):
+                    regressed = value < base_value * (1 - tolerance)
+                elif metric.endswith(('_ms', '_bytes')):
+                    regressed = value > base_value * (1 + tolerance)
+                else:
+                    continue
+                if regressed:
+                    regressions.append('%s rows %s.%s: %.4g (baseline %.4g)' % (size, name, metric, value, base_value))
+    return regressions
+
+
+def get_environment() -> dict[str: str]:
+    """Get versions and the database of the benchmark run.
+    """
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'numpy': np.__version__,
+        'database': connection.vendor,
+        'machine': platform.machine(),
+        'processor': platform.processor()
+    }
+
+
+class _StubAWCHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        if 'stationString' not in query:
+            self.send_response(400)
+            self.end_headers()
+            return
+        station_list = query['stationString'][0].split(',')
+        body = create_awc_xml([
+            element for station_id in station_list for element in self.server.element_dict.get(station_id, [])
+        ])
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _start_stub_server(element_dict: dict[str: list[str]]) -> ThreadingHTTPServer:
+    """Start a local AWC server returning the elements of the requested
+    stations.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _StubAWCHandler)
+    server.element_dict = element_dict
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _get_models_input(metar_input: metar_function.MetarInput) -> metar_function.MetarInput:
+    metar_input.get_models()
+    return metar_input
+
+
+def _create_client() -> Client:
+    user = User.objects.filter(username=BENCHMARK_USER).first()
+    if user is None:
+        user = User.objects.create_user(BENCHMARK_USER)
+    client = Client()
+    client.force_login(user)
+    return client
+
+
+def _random_values(seed: int, start_index: int, count: int) -> dict[str: list]:
+    """Random values of the fields, reproducible from the seed and index.
+    """
+    rng = np.random.default_rng([seed, start_index])
+    temp = np.round(rng.normal(15, 8, count), 1)
+    return {
+        'temp_c': temp.tolist(),
+        'dewpoint_c': np.round(temp - rng.uniform(0, 10, count), 1).tolist(),
+        'wind_dir_degrees': (rng.integers(1, 37, count) * 10).tolist(),
+        'wind_speed_kt': rng.integers(0, 30, count).tolist(),
+        'altim_in_hg': np.round(rng.normal(29.92, 0.2, count), 2).tolist(),
+        'cloud_ceiling': (rng.integers(3, 120, count) * 100).tolist()
+    }
+
+
+def _raw_text(station_id: str, observation_time: datetime, row: dict) -> str:
+    temp = '%s%02d' % ('M' if row['temp_c'] < 0 else '', abs(round(row['temp_c'])))
+    dewpoint = '%s%02d' % ('M' if row['dewpoint_c'] < 0 else '', abs(round(row['dewpoint_c'])))
+    return '%s %s %03d%02dKT 9999 BKN%03d %s/%s A%04d' % (
+        station_id,
+        observation_time.strftime(r'%d%H%MZ'),
+        row['wind_dir_degrees'],
+        row['wind_speed_kt'],
+        row['cloud_ceiling'] // 100,
+        temp,
+        dewpoint,
+        round(row['altim_in_hg'] * 100)
+    )
+
+
+def _measure(func: Callable) -> tuple[float, any]:
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def _repeat(func: Callable, repeat: int) -> list[float]:
+    return [_measure(func)[0] for _ in range(repeat)]
+
+
+def _percentile(values: list[float], percent: float) -> float:
+    return float(np.percentile(values, percent))
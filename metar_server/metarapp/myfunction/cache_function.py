@@ -0,0 +1,134 @@
+from __future__ import annotations
+import threading
+from datetime import date, datetime, timedelta
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+from ..models import Metar
+from . import search_function
+
+CACHE_KEY_FORMAT = 'metar:day:%s:%s'
+
+
+class CacheStats():
+    """Counters of the METAR cache in this process.
+
+    Attributes:
+        hits (int): The number of the station-days read from the cache.
+        misses (int): The number of the station-days read from database.
+        invalidations (int): The number of the station-days removed from
+            the cache because METARs were inserted.
+    """
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def add(self, hits: int = 0, misses: int = 0, invalidations: int = 0) -> None:
+        with self.__lock:
+            self.hits += hits
+            self.misses += misses
+            self.invalidations += invalidations
+
+    def as_dict(self) -> dict[str: int]:
+        with self.__lock:
+            return {'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations}
+
+
+stats = CacheStats()
+
+
+def get_metar_cache():
+    """Get the cache backend for METARs, 'METAR_CACHE_ALIAS' in settings.
+    """
+    return caches[getattr(settings, 'METAR_CACHE_ALIAS', 'default')]
+
+
+def get_cached_metars(stations: list[str], start_date: datetime, end_date: datetime) -> list[Metar]:
+    """Get METARs of the stations between the two local days through the
+    cache.
+
+    The METARs are cached by station and local day. The missing station-days
+    are searched in one query and stored. Days closed more than
+    METAR_CACHE_CLOSED_MARGIN ago are stored for METAR_CACHE_CLOSED_TIMEOUT
+    seconds, and the others for METAR_CACHE_OPEN_TIMEOUT seconds.
+
+    Args:
+        stations (list[str]): ICAO ids of the airports.
+        start_date (datetime): The first day of the search (0:00 local).
+        end_date (datetime): The last day of the search (0:00 local).
+
+    Returns:
+        list[Metar]: Metar models ordered by observation_time.
+    """
+    cache = get_metar_cache()
+    day_list = [
+        start_date.date() + timedelta(days=i)
+        for i in range((end_date.date() - start_date.date()).days + 1)
+    ]
+    keys = {
+        get_cache_key(station, day): (station, day)
+        for station in stations
+        for day in day_list
+    }
+    cached_dict = cache.get_many(list(keys))
+    missing = {key: keys[key] for key in keys if key not in cached_dict}
+    stats.add(hits=len(cached_dict), misses=len(missing))
+    metar_list = [metar for metars in cached_dict.values() for metar in metars]
+    if missing:
+        metar_list.extend(_load_days(missing))
+    metar_list.sort(key=lambda metar: (metar.observation_time, metar.station_id))
+    return metar_list
+
+
+def invalidate_metars(metars: list[Metar]) -> None:
+    """Remove the cached station-days of the inserted METARs.
+
+    Args:
+        metars (list[Metar]): Inserted Metar models.
+    """
+    keys = {
+        get_cache_key(metar.station_id, timezone.localtime(metar.observation_time).date())
+        for metar in metars
+    }
+    if not keys:
+        return
+    get_metar_cache().delete_many(list(keys))
+    stats.add(invalidations=len(keys))
+
+
+def get_cache_key(station: str, day: date) -> str:
+    return CACHE_KEY_FORMAT % (station, day.isoformat())
+
+
+def _load_days(missing: dict[str: tuple[str, date]]) -> list[Metar]:
+    """Search the missing station-days in one query and store them.
+
+    Args:
+        missing (dict[str: tuple[str, date]]): Cache keys and the
+            station-days.
+
+    Returns:
+        list[Metar]: Metar models of the station-days.
+    """
+    stations = sorted({station for station, _ in missing.values()})
+    days = [day for _, day in missing.values()]
+    start_date = timezone.make_aware(datetime.combine(min(days), datetime.min.time()))
+    end_date = timezone.make_aware(datetime.combine(max(days), datetime.min.time()))
+    day_dict: dict[str: list[Metar]] = {key: [] for key in missing}
+    metar_list = []
+    for metar in search_function.search_metar_all(stations, start_date, end_date):
+        key = get_cache_key(metar.station_id, timezone.localtime(metar.observation_time).date())
+        if key in day_dict:
+            day_dict[key].append(metar)
+            metar_list.append(metar)
+
+    closed_margin = timedelta(seconds=getattr(settings, 'METAR_CACHE_CLOSED_MARGIN', 6 * 3600))
+    closed_before = (timezone.localtime() - closed_margin).date()
+    closed_dict = {key: day_dict[key] for key in day_dict if missing[key][1] < closed_before}
+    open_dict = {key: day_dict[key] for key in day_dict if key not in closed_dict}
+    cache = get_metar_cache()
+    cache.set_many(closed_dict, getattr(settings, 'METAR_CACHE_CLOSED_TIMEOUT', 7 * 24 * 3600))
+    cache.set_many(open_dict, getattr(settings, 'METAR_CACHE_OPEN_TIMEOUT', 60))
+    return metar_list
@@ -0,0 +1,252 @@
+from __future__ import annotations
+import math
+from datetime import datetime
+import numpy as np
+from ..models import MetarHourlyRollup
+from . import analytics_function
+
+# Fields of the charts and the columns of the hourly rollups for the sum,
+# the minimum and the maximum. None if the rollups do not have it.
+CHART_FIELDS = {
+    'temp_c': ('temp_sum', 'temp_min', 'temp_max'),
+    'dewpoint_c': ('dewpoint_sum', None, None),
+    'wind_speed_kt': ('wind_speed_sum', None, 'wind_speed_max'),
+    'wind_gust_kt': (None, None, 'wind_gust_max'),
+    'altim_in_hg': ('altim_sum', 'altim_min', 'altim_max'),
+    'visibility_m': ('visibility_sum', 'visibility_min', None)
+}
+METHODS = ('minmax', 'lttb')
+# The hourly rollups are read if a bucket is at least an hour.
+ROLLUP_SECONDS = 3600
+CHART_DECIMALS = 2
+
+
+class ChartSeries():
+    """Columns of a field to be bucketed, from the METARs or the hourly
+    rollups. For a METAR, the sum is the value, the count is 1 if it is
+    not NaN, and the minimum and the maximum are the value. The missing
+    statistics of the rollups are None.
+
+    Attributes:
+        sums (Optional[np.ndarray]): Sums of the values.
+        counts (np.ndarray): Numbers of the values.
+        mins (Optional[np.ndarray]): Minimums of the values.
+        maxs (Optional[np.ndarray]): Maximums of the values.
+    """
+    def __init__(self, sums: np.ndarray, counts: np.ndarray, mins: np.ndarray, maxs: np.ndarray) -> None:
+        self.sums = sums
+        self.counts = counts
+        self.mins = mins
+        self.maxs = maxs
+
+    @property
+    def means(self) -> np.ndarray:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.sums / self.counts
+
+
+def get_chart(
+    station_id: str,
+    start_time: datetime,
+    end_time: datetime,
+    field_names: list[str],
+    points: int = 500,
+    method: str = 'minmax'
+) -> dict:
+    """Get the series of the fields of the station downsampled to about
+    'points' points.
+
+    'minmax' splits the range into 'points' buckets of the same length, and
+    gives the minimum, the maximum and the mean of each bucket. 'lttb'
+    selects 'points' points of each field by Largest-Triangle-Three-Buckets.
+    If a bucket is at least an hour, the hourly rollups are read instead of
+    the METARs; the buckets are whole hours, 'lttb' selects from the hourly
+    means, and the statistics which the rollups do not have are omitted.
+    The times are UNIX seconds, the buckets by their starts.
+
+    Args:
+        station_id (str): ICAO id of the station.
+        start_time (datetime): Start of the range (included).
+        end_time (datetime): End of the range (excluded).
+        field_names (list[str]): Keys of CHART_FIELDS.
+        points (int, optional): The number of the buckets or the points.
+            Defaults to 500.
+        method (str, optional): One of METHODS. Defaults to 'minmax'.
+
+    Returns:
+        dict: 'source' ('metar' or 'hourly'), 'time' and 'series' of the
+            statistics for 'minmax', or 'series' of 'time' and 'value' for
+            'lttb'.
+    """
+    start_seconds = int(start_time.timestamp())
+    end_seconds = math.ceil(end_time.timestamp())
+    bucket_seconds = max(1, math.ceil((end_seconds - start_seconds) / points))
+    if bucket_seconds >= ROLLUP_SECONDS:
+        bucket_seconds = math.ceil(bucket_seconds / ROLLUP_SECONDS) * ROLLUP_SECONDS
+        start_seconds -= start_seconds % ROLLUP_SECONDS
+        source = 'hourly'
+        times, series_dict = load_rollup_series(station_id, start_time, end_time, field_names)
+    else:
+        source = 'metar'
+        times, series_dict = load_metar_series(station_id, start_time, end_time, field_names)
+    chart = {
+        'station_id': station_id,
+        'start': start_time,
+        'end': end_time,
+        'method': method,
+        'source': source
+    }
+    if method == 'lttb':
+        chart['series'] = {}
+        for name, series in series_dict.items():
+            values = series.means if series.sums is not None else series.maxs
+            valid = ~np.isnan(values)
+            indexes = lttb(times[valid], values[valid], points)
+            chart['series'][name] = {
+                'time': times[valid][indexes].tolist(),
+                'value': _to_list(values[valid][indexes])
+            }
+        return chart
+
+    bucket_indexes = (times - start_seconds) // bucket_seconds
+    starts = np.flatnonzero(np.diff(bucket_indexes, prepend=-1)) if len(times) else np.array([], dtype=np.intp)
+    chart['bucket_seconds'] = bucket_seconds
+    chart['time'] = (start_seconds + bucket_indexes[starts] * bucket_seconds).tolist()
+    chart['series'] = {name: bucket_series(series, starts) for name, series in series_dict.items()}
+    return chart
+
+
+def bucket_series(series: ChartSeries, starts: np.ndarray) -> dict[str: list]:
+    """Reduce the series to the minimums, the maximums and the means of the
+    buckets beginning at 'starts'.
+    """
+    if not len(starts):
+        return {name: [] for name, column in (('min', series.mins), ('max', series.maxs), ('mean', series.sums))
+                if column is not None}
+    bucketed = {}
+    if series.mins is not None:
+        bucketed['min'] = _to_list(np.fmin.reduceat(series.mins, starts))
+    if series.maxs is not None:
+        bucketed['max'] = _to_list(np.fmax.reduceat(series.maxs, starts))
+    if series.sums is not None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = np.add.reduceat(series.sums, starts) / np.add.reduceat(series.counts, starts)
+        bucketed['mean'] = _to_list(means)
+    return bucketed
+
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """Select points by Largest-Triangle-Three-Buckets.
+
+    The first and the last points are kept, and the others are split into
+    'threshold' - 2 buckets. From each bucket, the point making the largest
+    triangle with the previous selected point and the mean of the next
+    bucket is selected.
+
+    Args:
+        x (np.ndarray): Ascending x of the points.
+        y (np.ndarray): y of the points without NaN.
+        threshold (int): The number of the selected points.
+
+    Returns:
+        np.ndarray: Indexes of the selected points.
+    """
+    count = len(x)
+    if threshold >= count or threshold < 3:
+        return np.arange(count)
+    x = x.astype(np.float64)
+    edges = np.linspace(1, count - 1, threshold - 1).astype(np.intp)
+    sizes = np.diff(edges)
+    mean_x = np.add.reduceat(x[1:count - 1], edges[:-1] - 1) / sizes
+    mean_y = np.add.reduceat(y[1:count - 1], edges[:-1] - 1) / sizes
+    # The next of the last bucket is the last point.
+    mean_x = np.append(mean_x[1:], x[-1])
+    mean_y = np.append(mean_y[1:], y[-1])
+    selected = np.empty(threshold, dtype=np.intp)
+    selected[0] = 0
+    selected[-1] = count - 1
+    previous = 0
+    for i in range(threshold - 2):
+        bucket_x = x[edges[i]:edges[i + 1]]
+        bucket_y = y[edges[i]:edges[i + 1]]
+        areas = np.abs(
+            (x[previous] - mean_x[i]) * (bucket_y - y[previous]) - (x[previous] - bucket_x) * (mean_y[i] - y[previous])
+        )
+        previous = edges[i] + int(np.argmax(areas))
+        selected[i + 1] = previous
+    return selected
+
+
+def load_metar_series(
+    station_id: str,
+    start_time: datetime,
+    end_time: datetime,
+    field_names: list[str]
+) -> tuple[np.ndarray, dict[str: ChartSeries]]:
+    """Load the METARs of the station as the series.
+
+    Returns:
+        tuple[np.ndarray, dict[str: ChartSeries]]: UNIX seconds and the
+            series of the fields.
+    """
+    columns = analytics_function.load_series([station_id], start_time, end_time, ['observation_time'] + field_names)
+    times = columns['observation_time'].astype(np.int64)
+    series_dict = {}
+    for name in field_names:
+        values = columns[name]
+        valid = ~np.isnan(values)
+        series_dict[name] = ChartSeries(np.where(valid, values, 0.0), valid.astype(np.int64), values, values)
+    return times, series_dict
+
+
+def load_rollup_series(
+    station_id: str,
+    start_time: datetime,
+    end_time: datetime,
+    field_names: list[str]
+) -> tuple[np.ndarray, dict[str: ChartSeries]]:
+    """Load the hourly rollups of the station in the hours overlapping the
+    range as the series.
+
+    Returns:
+        tuple[np.ndarray, dict[str: ChartSeries]]: UNIX seconds of the
+            hours and the series of the fields.
+    """
+    first_hour = start_time.replace(minute=0, second=0, microsecond=0)
+    column_names = list(dict.fromkeys(
+        column for name in field_names for column in CHART_FIELDS[name] if column is not None
+    ))
+    rows = list(
+        MetarHourlyRollup.objects
+        .filter(
+            station_id=station_id,
+            hour__gte=first_hour,
+            hour__lt=end_time
+        )
+        .order_by('hour')
+        .values_list('hour', 'count', *column_names)
+    )
+    transposed = list(zip(*rows)) if rows else [()] * (len(column_names) + 2)
+    times = np.fromiter((hour.timestamp() for hour in transposed[0]), np.float64, len(rows)).astype(np.int64)
+    counts = np.array(transposed[1], dtype=np.int64)
+    columns = {}
+    for index, column_name in enumerate(column_names, 2):
+        column = np.array(transposed[index], dtype=object)
+        column[np.equal(column, None)] = np.nan
+        columns[column_name] = column.astype(np.float64)
+    series_dict = {}
+    for name in field_names:
+        sum_name, min_name, max_name = CHART_FIELDS[name]
+        series_dict[name] = ChartSeries(
+            columns.get(sum_name),
+            counts,
+            columns.get(min_name),
+            columns.get(max_name)
+        )
+    return times, series_dict
+
+
+def _to_list(column: np.ndarray) -> list:
+    rounded = np.round(column, CHART_DECIMALS).astype(object)
+    rounded[np.isnan(column)] = None
+    return rounded.tolist()
@@ -0,0 +1,147 @@
+from __future__ import annotations
+from datetime import datetime
+from django.db.models import F, Q, QuerySet
+from typing import Iterable, Optional
+from ..models import Metar
+from . import analytics_function, rollup_function
+
+# Two-letter codes of the present weather, the bits of Metar.wx_flags.
+WX_CODES = (
+    'MI', 'PR', 'BC', 'DR', 'BL', 'SH', 'TS', 'FZ', 'VC',
+    'DZ', 'RA', 'SN', 'SG', 'IC', 'PL', 'GR', 'GS', 'UP',
+    'BR', 'FG', 'FU', 'VA', 'DU', 'SA', 'HZ', 'PY',
+    'PO', 'SQ', 'FC', 'SS', 'DS'
+)
+WX_BITS = {code: 1 << index for index, code in enumerate(WX_CODES)}
+# Decoded fields which can be searched by ranges.
+RANGE_FIELDS = (
+    'temp_c', 'dewpoint_c', 'wind_dir_degrees', 'wind_speed_kt', 'wind_gust_kt', 'visibility_m',
+    'cloud_ceiling', 'vert_vis_ft', 'altim_in_hg'
+)
+
+
+def get_wx_flags(wx_string: Optional[str]) -> int:
+    """Get the bits of the weather codes in wx_string, like TS and RA of
+    '+TSRA'. The unknown codes are ignored.
+    """
+    flags = 0
+    for code in rollup_function.WX_CODE_RE.findall(wx_string or ''):
+        flags |= WX_BITS.get(code, 0)
+    return flags
+
+
+def get_wx_mask(codes: Iterable[str]) -> int:
+    """Get the bits of the weather codes.
+
+    Raises:
+        ValueError: If a code is not in WX_CODES.
+    """
+    mask = 0
+    for code in codes:
+        if code not in WX_BITS:
+            raise ValueError('Unknown weather code: %s' % code)
+        mask |= WX_BITS[code]
+    return mask
+
+
+def set_conditions(metars: list[Metar]) -> None:
+    """Set flight_category and wx_flags of the METARs from the decoded
+    fields. The flight categories of the batch are computed at once.
+    """
+    if not metars:
+        return
+    columns = analytics_function.to_columns(
+        [(metar.cloud_ceiling, metar.vert_vis_ft, metar.visibility_m) for metar in metars],
+        ['cloud_ceiling', 'vert_vis_ft', 'visibility_m']
+    )
+    categories = analytics_function.flight_category(
+        columns['cloud_ceiling'],
+        columns['vert_vis_ft'],
+        columns['visibility_m']
+    )
+    for metar, category in zip(metars, categories.tolist()):
+        metar.flight_category = category
+        metar.wx_flags = get_wx_flags(metar.wx_string)
+
+
+def get_implied_category(ranges: dict[str: tuple[Optional[float], Optional[float]]]) -> int:
+    """Get the flight category which the maximum ceiling and visibility of
+    the ranges imply at least.
+
+    The ceiling of the category is the lower of cloud_ceiling and
+    vert_vis_ft, so the maximum of cloud_ceiling bounds it. The condition is
+    added to the search to use the partial index of IFR and LIFR.
+    """
+    category = 0
+    for name, bounds in (('cloud_ceiling', analytics_function.CEILING_BOUNDS_FT),
+                         ('visibility_m', analytics_function.VISIBILITY_BOUNDS_M)):
+        maximum = ranges.get(name, (None, None))[1]
+        if maximum is None:
+            continue
+        if maximum < bounds[0]:
+            category = max(category, 3)
+        elif maximum < bounds[1]:
+            category = max(category, 2)
+        elif maximum <= bounds[2]:
+            category = max(category, 1)
+    return category
+
+
+def search_conditions(
+    stations: list[str],
+    start_time: datetime,
+    end_time: datetime,
+    ranges: dict[str: tuple[Optional[float], Optional[float]]],
+    wx_codes: list[str],
+    category: int = 0,
+    after: Optional[tuple[datetime, int]] = None
+) -> QuerySet:
+    """Get METARs matching all of the conditions, for keyset pagination.
+
+    Only the Metar table is searched. The METARs of the archived months
+    (archive_function) have no id for the cursor, and are not searched.
+
+    Args:
+        stations (list[str]): ICAO ids of the airports. All stations if it
+            is empty.
+        start_time (datetime): Start of the range (included).
+        end_time (datetime): End of the range (excluded).
+        ranges (dict[str: tuple[Optional[float], Optional[float]]]): Keys of
+            RANGE_FIELDS and the minimum and the maximum (included). None is
+            not bounded.
+        wx_codes (list[str]): Weather codes of WX_CODES. METARs with any of
+            them match.
+        category (int, optional): The minimum flight category, 0 (VFR) to
+            3 (LIFR). Defaults to 0.
+        after (Optional[tuple[datetime, int]]): observation_time and id of
+            the last METAR of the previous page.
+
+    Returns:
+        QuerySet: Metar QuerySet ordered by observation_time and id.
+    """
+    metar_query = Metar.objects \
+        .filter(
+            observation_time__gte=start_time,
+            observation_time__lt=end_time
+        )
+    if stations:
+        metar_query = metar_query.filter(station_id__in=stations)
+    for name, (minimum, maximum) in ranges.items():
+        if minimum is not None:
+            metar_query = metar_query.filter(**{name + '__gte': minimum})
+        if maximum is not None:
+            metar_query = metar_query.filter(**{name + '__lte': maximum})
+    category = max(category, get_implied_category(ranges))
+    if category:
+        metar_query = metar_query.filter(flight_category__gte=category)
+    if wx_codes:
+        # wx_flags > 0 is implied, but written for the partial index.
+        metar_query = metar_query \
+            .annotate(wx_match=F('wx_flags').bitand(get_wx_mask(wx_codes))) \
+            .filter(wx_flags__gt=0, wx_match__gt=0)
+    if after is not None:
+        after_time, after_id = after
+        metar_query = metar_query.filter(
+            Q(observation_time__gt=after_time) | Q(observation_time=after_time, id__gt=after_id)
+        )
+    return metar_query.order_by('observation_time', 'id')
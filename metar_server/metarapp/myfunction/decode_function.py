@@ -0,0 +1,275 @@
+from __future__ import annotations
+import re
+from functools import lru_cache
+from typing import Any, Iterable, Optional
+
+KT_PER_MPS = 1.943844
+KT_PER_KMH = 0.539957
+M_PER_SM = 1609.344
+HPA_PER_IN_HG = 33.863886
+MAX_VISIBILITY_M = 9999
+
+WIND_RE = re.compile(
+    r'(?P<dir>[0-9]{3}|VRB|///)(?P<speed>P?[0-9]{2,3}|//)(G(?P<gust>P?[0-9]{2,3}))?(?P<unit>KT|MPS|KMH)'
+)
+VIS_SM_RE = re.compile(r'(?P<prefix>[MP])?((?P<whole>[0-9]{1,2})|(?P<num>[0-9])/(?P<den>[0-9]{1,2}))SM')
+TEMP_RE = re.compile(r'(?P<temp>M?[0-9]{2})/(?P<dew>M?[0-9]{2})?')
+TIME_RE = re.compile(r'(?P<day>[0-9]{2})(?P<hour>[0-9]{2})(?P<minute>[0-9]{2})Z')
+CLOUD_RE = re.compile(r'(?P<cover>FEW|SCT|BKN|OVC|VV)(?P<base>[0-9]{3}|///)(?P<type>CB|TCU|///)?')
+WEATHER_RE = re.compile(
+    r'([-+]|VC)?((MI|PR|BC|DR|BL|SH|TS|FZ)(DZ|RA|SN|SG|IC|PL|GR|GS|UP|BR|FG|FU|VA|DU|SA|HZ|PY|PO|SQ|FC|SS|DS)*'
+    r'|(DZ|RA|SN|SG|IC|PL|GR|GS|UP|BR|FG|FU|VA|DU|SA|HZ|PY|PO|SQ|FC|SS|DS)+)'
+)
+WIND_UNIT_TUPLE = ('KT', 'MPS', 'KMH')
+FLAG_SET = frozenset(('AUTO', 'COR', 'CAVOK'))
+END_SET = frozenset(('RMK', 'NOSIG', 'BECMG', 'TEMPO'))
+
+# Kinds of the groups from classify_group.
+OTHER, CLOUD, WEATHER, VISIBILITY, VISIBILITY_FRACTION, NUMBER, WIND, WIND_VARIABLE, \
+    TEMPERATURE, ALTIMETER, TIME, FLAG, END = range(13)
+
+
+class DecodedMetar():
+    """Fields decoded from raw text of a METAR.
+
+    Missing fields are None. Wind speeds are in knots, visibility is in
+    meters (at most 9999), cloud bases are in feet.
+
+    Attributes:
+        metar_type (str): 'METAR' or 'SPECI'.
+        station_id (str): ICAO id of the station.
+        day (int), hour (int), minute (int): Observation time in UTC.
+        auto (bool): True if the report is from an automated station.
+        corrected (bool): True if the report is a correction (COR).
+        wind_dir_degrees (int): Wind direction. None if variable (VRB).
+        wind_speed_kt (int): Wind speed.
+        wind_gust_kt (int): Gust speed.
+        wind_var_from (int), wind_var_to (int): Range of variable direction.
+        visibility_m (int): Prevailing visibility.
+        cavok (bool): True if CAVOK is reported.
+        weather (list[str]): Present weather groups, like '-SHRA'.
+        clouds (list[tuple[str, Optional[int], Optional[str]]]): Cover, base
+            and type of the cloud layers.
+        vert_vis_ft (int): Vertical visibility.
+        cloud_ceiling (int): Base of the lowest BKN or OVC layer.
+        temp_c (float), dewpoint_c (float): Temperature and dewpoint.
+        altim_in_hg (float): Altimeter setting. Converted from QNH if needed.
+        remarks (str): Text after 'RMK'.
+    """
+    __slots__ = (
+        'metar_type', 'station_id', 'day', 'hour', 'minute', 'auto', 'corrected',
+        'wind_dir_degrees', 'wind_speed_kt', 'wind_gust_kt', 'wind_var_from', 'wind_var_to',
+        'visibility_m', 'cavok', 'weather', 'clouds', 'vert_vis_ft', 'cloud_ceiling',
+        'temp_c', 'dewpoint_c', 'altim_in_hg', 'remarks'
+    )
+
+    def __init__(self) -> None:
+        self.metar_type = 'METAR'
+        self.station_id = None
+        self.day = None
+        self.hour = None
+        self.minute = None
+        self.auto = False
+        self.corrected = False
+        self.wind_dir_degrees = None
+        self.wind_speed_kt = None
+        self.wind_gust_kt = None
+        self.wind_var_from = None
+        self.wind_var_to = None
+        self.visibility_m = None
+        self.cavok = False
+        self.weather = []
+        self.clouds = []
+        self.vert_vis_ft = None
+        self.cloud_ceiling = None
+        self.temp_c = None
+        self.dewpoint_c = None
+        self.altim_in_hg = None
+        self.remarks = ''
+
+    @property
+    def wx_string(self) -> str:
+        """Present weather groups joined by space, as 'wx_string' of AWC.
+        """
+        return ' '.join(self.weather)
+
+
+def decode(raw_text: str) -> DecodedMetar:
+    """Decode raw text of a METAR in one pass over the groups.
+
+    The station is the first group after the type and COR. The other groups
+    are classified by classify_group, whose results are cached because the
+    same groups appear in many reports. The decoding stops at 'RMK' or the
+    trend groups (NOSIG, BECMG, TEMPO). Unknown groups are skipped.
+
+    Args:
+        raw_text (str): Raw text of the METAR.
+
+    Returns:
+        DecodedMetar: Decoded fields.
+    """
+    decoded = DecodedMetar()
+    tokens = raw_text.split()
+    count = len(tokens)
+    i = 0
+    while i < count and decoded.station_id is None:
+        token = tokens[i]
+        i += 1
+        if token == 'METAR' or token == 'SPECI':
+            decoded.metar_type = token
+        elif token == 'COR':
+            decoded.corrected = True
+        else:
+            decoded.station_id = token
+    previous = None
+    while i < count:
+        kind, value = classify_group(tokens[i])
+        i += 1
+        if kind == CLOUD:
+            cover, base_ft, cloud_type = value
+            if cover == 'VV':
+                decoded.vert_vis_ft = base_ft
+            else:
+                decoded.clouds.append(value)
+                if decoded.cloud_ceiling is None and base_ft is not None and (cover == 'BKN' or cover == 'OVC'):
+                    decoded.cloud_ceiling = base_ft
+        elif kind == WEATHER:
+            decoded.weather.append(value)
+        elif kind == VISIBILITY:
+            if decoded.visibility_m is None:
+                decoded.visibility_m = value
+        elif kind == WIND:
+            if decoded.wind_speed_kt is None:
+                decoded.wind_dir_degrees, decoded.wind_speed_kt, decoded.wind_gust_kt = value
+        elif kind == TEMPERATURE:
+            if decoded.temp_c is None:
+                decoded.temp_c, decoded.dewpoint_c = value
+        elif kind == ALTIMETER:
+            if decoded.altim_in_hg is None:
+                decoded.altim_in_hg = value
+        elif kind == TIME:
+            if decoded.day is None:
+                decoded.day, decoded.hour, decoded.minute = value
+        elif kind == WIND_VARIABLE:
+            decoded.wind_var_from, decoded.wind_var_to = value
+        elif kind == VISIBILITY_FRACTION:
+            if decoded.visibility_m is None:
+                # Whole number of visibility like '1 1/2SM'.
+                statute_mile = value
+                if previous is not None and previous[0] == NUMBER:
+                    statute_mile += previous[1]
+                decoded.visibility_m = min(MAX_VISIBILITY_M, int(round(statute_mile * M_PER_SM)))
+        elif kind == FLAG:
+            if value == 'AUTO':
+                decoded.auto = True
+            elif value == 'COR':
+                decoded.corrected = True
+            elif value == 'CAVOK':
+                decoded.cavok = True
+                decoded.visibility_m = MAX_VISIBILITY_M
+        elif kind == END:
+            if value == 'RMK':
+                decoded.remarks = ' '.join(tokens[i:])
+            else:
+                remarks_index = raw_text.find(' RMK ')
+                if remarks_index >= 0:
+                    decoded.remarks = raw_text[remarks_index + 5:]
+            break
+        previous = (kind, value)
+    return decoded
+
+
+def decode_many(raw_texts: Iterable[str]) -> list[DecodedMetar]:
+    """Decode raw texts of METARs.
+
+    Args:
+        raw_texts (Iterable[str]): Raw texts of the METARs.
+
+    Returns:
+        list[DecodedMetar]: Decoded fields in the same order.
+    """
+    return list(map(decode, raw_texts))
+
+
+@lru_cache(maxsize=65536)
+def classify_group(token: str) -> tuple[int, Any]:
+    """Classify a group of METAR and get the decoded value.
+
+    The result depends only on the group, so it is cached.
+
+    Args:
+        token (str): A group of METAR separated by spaces.
+
+    Returns:
+        tuple[int, Any]: Kind of the group and the decoded value.
+    """
+    first = token[0]
+    length = len(token)
+    if first.isdigit():
+        if length == 4 and token.isdigit():
+            return VISIBILITY, int(token)
+        if length <= 2 and token.isdigit():
+            return NUMBER, int(token)
+        if length == 7 and token[3] == 'V' and token[:3].isdigit() and token[4:].isdigit():
+            return WIND_VARIABLE, (int(token[:3]), int(token[4:]))
+        match = TIME_RE.fullmatch(token)
+        if match is not None:
+            return TIME, (int(match.group('day')), int(match.group('hour')), int(match.group('minute')))
+    if token in FLAG_SET:
+        return FLAG, token
+    if token in END_SET:
+        return END, token
+    if token.endswith(WIND_UNIT_TUPLE):
+        match = WIND_RE.fullmatch(token)
+        if match is not None:
+            return WIND, _get_wind(match)
+    if token.endswith('SM'):
+        match = VIS_SM_RE.fullmatch(token)
+        if match is not None:
+            if match.group('prefix') == 'P':
+                return VISIBILITY, MAX_VISIBILITY_M
+            if match.group('whole') is not None:
+                return VISIBILITY, min(MAX_VISIBILITY_M, int(round(int(match.group('whole')) * M_PER_SM)))
+            return VISIBILITY_FRACTION, int(match.group('num')) / int(match.group('den'))
+    if '/' in token:
+        match = TEMP_RE.fullmatch(token)
+        if match is not None:
+            dewpoint = match.group('dew')
+            temperature = _temperature(match.group('temp'))
+            return TEMPERATURE, (temperature, None if dewpoint is None else _temperature(dewpoint))
+    if length == 5 and (first == 'Q' or first == 'A') and token[1:].isdigit():
+        value = int(token[1:])
+        if first == 'A':
+            return ALTIMETER, value / 100
+        return ALTIMETER, round(value / HPA_PER_IN_HG, 2)
+    match = CLOUD_RE.fullmatch(token)
+    if match is not None:
+        base = match.group('base')
+        cloud_type = match.group('type')
+        return CLOUD, (
+            match.group('cover'),
+            None if base == '///' else int(base) * 100,
+            None if cloud_type == '///' else cloud_type
+        )
+    if WEATHER_RE.fullmatch(token) is not None:
+        return WEATHER, token
+    return OTHER, None
+
+
+def _get_wind(match: re.Match) -> tuple[Optional[int], Optional[int], Optional[int]]:
+    unit = match.group('unit')
+    factor = 1 if unit == 'KT' else KT_PER_MPS if unit == 'MPS' else KT_PER_KMH
+    direction = match.group('dir')
+    speed = match.group('speed')
+    gust = match.group('gust')
+    return (
+        int(direction) if direction.isdigit() else None,
+        None if speed == '//' else round(int(speed.lstrip('P')) * factor),
+        None if gust is None else round(int(gust.lstrip('P')) * factor)
+    )
+
+
+def _temperature(text: str) -> float:
+    if text[0] == 'M':
+        return -float(text[1:])
+    return float(text)
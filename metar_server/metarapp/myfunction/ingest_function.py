@@ -0,0 +1,169 @@
+from __future__ import annotations
+import logging
+import math
+import threading
+from datetime import datetime, timedelta
+from django.db import close_old_connections
+from django.utils import timezone
+from typing import Callable, Optional
+from . import airport_function, metar_function
+
+logger = logging.getLogger(__name__)
+
+
+class IngestScheduler():
+    """Fetch new METARs continuously on the schedule of METAR issue times.
+
+    METARs are issued at 'issue_minutes' of every hour. The airports are
+    polled 'issue_delay' after each issue time, and every 'speci_interval'
+    between them to pick up SPECIs and late METARs.
+
+    The newest observation time of each airport (high-water mark) is kept
+    in memory, starting from StationStatus. The airports are grouped by the
+    hours since the mark, and each group is fetched with the minimal
+    'hoursBeforeNow', so a steady cycle reads only the last hour of each
+    airport. Airports without any METAR are fetched for 'max_hour' hours.
+
+    Attributes:
+        issue_minutes (tuple[int]): Minutes of the hour when METARs are
+            issued.
+        issue_delay (timedelta): Delay of the poll after the issue time.
+        speci_interval (timedelta): The maximum interval of the polls.
+        max_hour (int): hoursBeforeNow of the airports without METAR.
+        url (str): URL of the AWC data server.
+        chunk_size (Optional[int]): MetarInput.chunk_size if it is given.
+        max_workers (Optional[int]): MetarInput.max_workers if it is given.
+        high_water (dict[str: datetime]): station_id and the newest
+            observation_time.
+        failed_cycles (int): The number of the cycles which raised an
+            exception in run().
+        stop_event (threading.Event): Set by stop() to end run().
+    """
+    def __init__(
+        self,
+        issue_minutes: tuple[int] = (0, 30),
+        issue_delay: timedelta = timedelta(minutes=3),
+        speci_interval: timedelta = timedelta(minutes=5),
+        max_hour: int = 25
+    ) -> None:
+        self.issue_minutes = issue_minutes
+        self.issue_delay = issue_delay
+        self.speci_interval = speci_interval
+        self.max_hour = max_hour
+        self.url = metar_function.MetarInput.URL
+        self.chunk_size: Optional[int] = None
+        self.max_workers: Optional[int] = None
+        self.high_water: dict[str: datetime] = {}
+        self.failed_cycles = 0
+        self.stop_event = threading.Event()
+
+    def run(self, on_cycle: Optional[Callable[[dict], None]] = None) -> None:
+        """Poll until stop() is called.
+
+        A running cycle is finished before stopping. A cycle raising an
+        exception, like a lost database connection, is logged and counted,
+        and the next cycle is run on the schedule.
+
+        Args:
+            on_cycle (Optional[Callable[[dict], None]], optional): Called with
+                the result of each cycle. Defaults to None.
+        """
+        while not self.stop_event.is_set():
+            # A long running process should not keep broken connections.
+            close_old_connections()
+            try:
+                result = self.run_once()
+            except Exception:
+                self.failed_cycles += 1
+                logger.exception('The ingest cycle failed (%s failed cycles)', self.failed_cycles)
+            else:
+                if on_cycle is not None:
+                    on_cycle(result)
+            wait = (self.get_next_poll(timezone.now()) - timezone.now()).total_seconds()
+            if self.stop_event.wait(max(wait, 0)):
+                break
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+    def run_once(self) -> dict:
+        """Fetch the new METARs of the airports once.
+
+        Returns:
+            dict: 'fetched_time', 'hours' (hoursBeforeNow and the number of
+                the airports), 'inserted', 'duplicates' and 'errors'.
+        """
+        airport_list = airport_function.get_airport_list()
+        if not self.high_water:
+            self.high_water = dict(airport_function.AirportMetarNewest().newest_dict)
+        now = timezone.now()
+        result = {'fetched_time': now, 'hours': {}, 'inserted': 0, 'duplicates': 0, 'errors': {}}
+        for hour, stations in sorted(group_by_hours(airport_list, self.high_water, now, self.max_hour).items()):
+            metar_input = metar_function.MetarInput(stations, hour=hour)
+            metar_input.url = self.url
+            if self.chunk_size is not None:
+                metar_input.chunk_size = self.chunk_size
+            if self.max_workers is not None:
+                metar_input.max_workers = self.max_workers
+            metar_input.fetch_and_save()
+            for metar in metar_input.fetched_data:
+                newest = self.high_water.get(metar.station_id)
+                if newest is None or newest < metar.observation_time:
+                    self.high_water[metar.station_id] = metar.observation_time
+            result['hours'][hour] = len(stations)
+            result['inserted'] += metar_input.inserted_count
+            result['duplicates'] += metar_input.duplicate_count
+            result['errors'].update(metar_input.chunk_errors)
+        return result
+
+    def get_next_poll(self, now: datetime) -> datetime:
+        """Get the datetime of the next poll.
+
+        It is the next issue time with 'issue_delay', or 'speci_interval'
+        after now if it is earlier.
+
+        Args:
+            now (datetime): Current datetime.
+
+        Returns:
+            datetime: Datetime of the next poll.
+        """
+        hour_start = now.replace(minute=0, second=0, microsecond=0)
+        issue_times = [
+            hour_start + timedelta(hours=hours, minutes=minute) + self.issue_delay
+            for hours in (0, 1)
+            for minute in self.issue_minutes
+        ]
+        next_issue = min(issue_time for issue_time in issue_times if issue_time > now)
+        return min(next_issue, now + self.speci_interval)
+
+
+def group_by_hours(
+    airport_list: list[str],
+    high_water: dict[str: datetime],
+    now: datetime,
+    max_hour: int = 25
+) -> dict[int: list[str]]:
+    """Group the airports by hoursBeforeNow needed to get the METARs newer
+    than the high-water marks.
+
+    Args:
+        airport_list (list[str]): Airports to be fetched.
+        high_water (dict[str: datetime]): station_id and the newest
+            observation_time.
+        now (datetime): Current datetime.
+        max_hour (int, optional): hoursBeforeNow of the airports without
+            the mark, and the maximum of the others. Defaults to 25.
+
+    Returns:
+        dict[int: list[str]]: hoursBeforeNow and the airports.
+    """
+    hour_dict: dict[int: list[str]] = {}
+    for airport in airport_list:
+        newest = high_water.get(airport)
+        if newest is None:
+            hour = max_hour
+        else:
+            hour = min(max_hour, max(1, math.ceil((now - newest).total_seconds() / 3600)))
+        hour_dict.setdefault(hour, []).append(airport)
+    return hour_dict
@@ -0,0 +1,137 @@
+from __future__ import annotations
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.query import QuerySet
+from django.utils import timezone
+from typing import Optional
+from ..models import FetchJob
+from . import metar_function
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def enqueue_fetch_job(airport_list: list[str]) -> FetchJob:
+    """Save a fetch job of the airports and run it on the worker threads.
+
+    The job is submitted after the transaction is committed, so the worker
+    can read it.
+
+    Args:
+        airport_list (list[str]): Airports to be fetched.
+
+    Returns:
+        FetchJob: The queued job.
+    """
+    job = FetchJob.objects.create(airports=airport_list)
+    transaction.on_commit(lambda: _get_executor().submit(run_job, job.id))
+    return job
+
+
+def run_job(job_id: int) -> bool:
+    """Run the fetch job if it is still pending.
+
+    The job is claimed by a conditional update, so a job is run once even
+    if more than one worker picks it up.
+
+    Args:
+        job_id (int): id of FetchJob.
+
+    Returns:
+        bool: True if the job is run by this call.
+    """
+    try:
+        claimed = FetchJob.objects \
+            .filter(
+                id=job_id,
+                status=FetchJob.PENDING
+            ) \
+            .update(status=FetchJob.RUNNING, started_at=timezone.now())
+        if not claimed:
+            return False
+        job = FetchJob.objects.get(id=job_id)
+        try:
+            metar_input = metar_function.MetarInput(job.airports)
+            metar_input.fetch_and_save()
+        except Exception as e:
+            job.status = FetchJob.FAILED
+            job.error = '%s: %s' % (type(e).__name__, e)
+        else:
+            station_counts: dict[str: int] = {}
+            for metar in metar_input.fetched_data:
+                station_counts[metar.station_id] = station_counts.get(metar.station_id, 0) + 1
+            job.status = FetchJob.DONE
+            job.station_counts = station_counts
+            job.inserted_count = metar_input.inserted_count
+            job.duplicate_count = metar_input.duplicate_count
+            job.error = '\n'.join(
+                'Failed to fetch %s: %s' % (chunk, error) for chunk, error in metar_input.chunk_errors.items()
+            )
+        job.finished_at = timezone.now()
+        job.save()
+        return True
+    finally:
+        if not connection.in_atomic_block:
+            # Connections of the worker threads are not closed by requests.
+            connection.close()
+
+
+def requeue_stale_jobs() -> int:
+    """Set the running jobs started more than METAR_JOB_STALE_TIMEOUT
+    seconds ago back to pending.
+
+    Their worker is regarded as dead, e.g. by a restarted process. Running
+    a job again is safe because the saved METARs are skipped.
+
+    Returns:
+        int: The number of the requeued jobs.
+    """
+    stale_before = timezone.now() - timedelta(seconds=getattr(settings, 'METAR_JOB_STALE_TIMEOUT', 3600))
+    return FetchJob.objects \
+        .filter(
+            status=FetchJob.RUNNING,
+            started_at__lt=stale_before
+        ) \
+        .update(status=FetchJob.PENDING, started_at=None)
+
+
+def run_pending_jobs() -> int:
+    """Run the pending jobs in this thread, e.g. left by a stopped process.
+
+    The stale running jobs are requeued first by requeue_stale_jobs().
+
+    Returns:
+        int: The number of the jobs run.
+    """
+    requeue_stale_jobs()
+    job_query = FetchJob.objects \
+        .filter(
+            status=FetchJob.PENDING
+        ) \
+        .order_by('created_at') \
+        .values_list('id', flat=True)
+    job_ids = list(job_query)
+    return sum(run_job(job_id) for job_id in job_ids)
+
+
+def get_recent_jobs(count: int = 20) -> QuerySet:
+    """Get the recent fetch jobs, the newest first.
+    """
+    return FetchJob.objects.order_by('-created_at')[:count]
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Get the thread pool of the jobs, METAR_JOB_WORKERS threads in
+    settings.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'METAR_JOB_WORKERS', 2),
+                thread_name_prefix='metar-job'
+            )
+        return _executor
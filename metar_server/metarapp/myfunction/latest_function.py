@@ -0,0 +1,200 @@
+from __future__ import annotations
+import datetime
+import json
+import logging
+import threading
+import time
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DatabaseError
+from django.db.models import OuterRef, Subquery
+from typing import Iterable, Optional
+from ..models import Metar, StationStatus
+from . import search_function
+
+logger = logging.getLogger(__name__)
+FIELD_NAMES = tuple(search_function.get_csv_field_names())
+# Reports older than the newest in the store by this margin are not read
+# again by the refresh.
+REFRESH_MARGIN = datetime.timedelta(hours=3)
+
+_store: Optional[LatestStore] = None
+_store_lock = threading.Lock()
+
+
+class LatestMetar():
+    """The latest decoded report of a station, without the attributes of
+    a model instance.
+    """
+    __slots__ = FIELD_NAMES
+
+    def __init__(self, values: Iterable) -> None:
+        for name, value in zip(FIELD_NAMES, values):
+            setattr(self, name, value)
+
+    def as_tuple(self) -> tuple:
+        return tuple(getattr(self, name) for name in FIELD_NAMES)
+
+
+class LatestStore():
+    """The latest METAR of each station held in this process.
+
+    The store is loaded with one query from StationStatus, updated with the
+    written METARs of this process by metars_inserted, and refreshed with
+    the METARs written by the other processes after
+    METAR_LATEST_REFRESH_SECONDS in settings. The JSON of all stations is
+    kept until the store is changed.
+
+    Attributes:
+        newest (Optional[datetime.datetime]): The newest observation time in
+            the store.
+    """
+    def __init__(self) -> None:
+        self.__records: dict[str: LatestMetar] = {}
+        self.__json: Optional[bytes] = None
+        self.__lock = threading.Lock()
+        self.__refresh_time = 0.0
+        self.newest: Optional[datetime.datetime] = None
+
+    def __len__(self) -> int:
+        return len(self.__records)
+
+    def get(self, station_id: str) -> Optional[LatestMetar]:
+        return self.__records.get(station_id)
+
+    def load(self) -> None:
+        """Read the latest METAR of every station in StationStatus.
+        """
+        metar_query = Metar.objects \
+            .filter(
+                id__in=StationStatus.objects.values(
+                    metar_id=Subquery(
+                        Metar.objects
+                        .filter(
+                            station_id=OuterRef('station_id'),
+                            observation_time=OuterRef('newest_observation_time')
+                        )
+                        .values('id')[:1]
+                    )
+                )
+            ) \
+            .values_list(*FIELD_NAMES)
+        records = {record.station_id: record for record in map(LatestMetar, metar_query)}
+        with self.__lock:
+            self.__records = records
+            self.__json = None
+            self.__refresh_time = time.monotonic()
+            self.newest = max((record.observation_time for record in records.values()), default=None)
+
+    def refresh(self) -> int:
+        """Read the METARs written since the newest in the store, with
+        REFRESH_MARGIN for the late reports and the corrections.
+
+        Returns:
+            int: The number of the changed stations.
+        """
+        self.__refresh_time = time.monotonic()
+        if self.newest is None:
+            self.load()
+            return len(self)
+        metar_query = Metar.objects \
+            .filter(
+                observation_time__gte=self.newest - REFRESH_MARGIN
+            ) \
+            .values_list(*FIELD_NAMES)
+        return self.update(map(LatestMetar, metar_query))
+
+    def refresh_if_expired(self) -> None:
+        timeout = getattr(settings, 'METAR_LATEST_REFRESH_SECONDS', 60)
+        if time.monotonic() - self.__refresh_time > timeout:
+            self.refresh()
+
+    def update(self, records: Iterable[LatestMetar]) -> int:
+        """Replace the records of the stations by the newer or corrected
+        reports.
+
+        Returns:
+            int: The number of the changed stations.
+        """
+        count = 0
+        with self.__lock:
+            for record in records:
+                stored = self.__records.get(record.station_id)
+                if stored is not None and (
+                    stored.observation_time > record.observation_time or
+                    stored.observation_time == record.observation_time and stored.raw_text == record.raw_text
+                ):
+                    continue
+                self.__records[record.station_id] = record
+                count += 1
+                if self.newest is None or self.newest < record.observation_time:
+                    self.newest = record.observation_time
+            if count:
+                self.__json = None
+        return count
+
+    def update_metars(self, metars: list[Metar]) -> int:
+        return self.update(
+            LatestMetar(getattr(metar, name) for name in FIELD_NAMES) for metar in metars
+        )
+
+    def get_json(self, stations: Optional[list[str]] = None) -> bytes:
+        """Get the JSON of the latest METARs, {"metars": [...]}, ordered by
+        station_id. The JSON of all stations is cached.
+
+        Args:
+            stations (Optional[list[str]], optional): ICAO ids of the
+                stations. Defaults to None (all stations).
+        """
+        if stations is not None:
+            return self.__encode(self.__records.get(station_id) for station_id in sorted(set(stations)))
+        cached = self.__json
+        if cached is None:
+            with self.__lock:
+                records = [self.__records[station_id] for station_id in sorted(self.__records)]
+                cached = self.__encode(records)
+                self.__json = cached
+        return cached
+
+    def __encode(self, records: Iterable[Optional[LatestMetar]]) -> bytes:
+        metars = [dict(zip(FIELD_NAMES, record.as_tuple())) for record in records if record is not None]
+        return json.dumps({'metars': metars}, cls=DjangoJSONEncoder, separators=(',', ':')).encode()
+
+
+def get_store() -> LatestStore:
+    """Get the latest store of this process, loaded at the first call and
+    refreshed after METAR_LATEST_REFRESH_SECONDS in settings.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            store = LatestStore()
+            store.load()
+            _store = store
+    _store.refresh_if_expired()
+    return _store
+
+
+def update_store(metars: list[Metar]) -> None:
+    """Update the store with the written METARs if it is loaded.
+    """
+    if _store is not None:
+        _store.update_metars(metars)
+
+
+def warm_store() -> None:
+    """Load the store at the start of the server. The store is loaded at
+    the first request instead if the database is not ready.
+    """
+    try:
+        get_store()
+    except DatabaseError:
+        logger.warning('The latest METAR store is not loaded at startup', exc_info=True)
+
+
+def reset_store() -> None:
+    """Drop the store of this process.
+    """
+    global _store
+    with _store_lock:
+        _store = None
@@ -1,12 +1,25 @@
 from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from django.db import transaction
 from django.db.models.query import QuerySet
 from django.utils import dateparse, timezone
-from defusedxml.ElementTree import fromstring
+from defusedxml.ElementTree import iterparse
+import queue
 import re
 import requests
-from xml.etree.ElementTree import Element, ElementTree
+from requests.adapters import HTTPAdapter
+import threading
+from typing import Any, BinaryIO, Callable, Iterator, Optional
+from urllib3.util.retry import Retry
+from xml.etree.ElementTree import Element
 from ..models import Metar
+from ..signals import metars_inserted
+from . import decode_function, metrics_function, writer_function
+
+EMPTY_RE = re.compile(r'/{2,}')
+# Sky covers of the layers which make a ceiling.
+CEILING_COVERS = ('BKN', 'OVC')
 
 
 class MetarInput():
@@ -15,23 +28,96 @@ class MetarInput():
     If METAR data more/less 25 hours from fetched time is required,
     'hour' attribute should be set.
 
+    The airport list is split into chunks of 'chunk_size' airports, and the
+    chunks are fetched concurrently with a shared requests.Session. Each
+    request has 'timeout' seconds and is retried 'retries' times with
+    exponential backoff. A chunk which still fails is recorded in
+    'chunk_errors' and the other chunks are saved.
+
+    The responses are parsed while they are received, and the Metar models
+    are passed to the database by batches of 'batch_size'. fetch_and_save
+    writes all batches in one transaction.
+
+    Duplicates are removed against the reports already stored for the
+    fetched airports and time window, except the ones replacing the stored
+    reports by the correction policy of 'writer'. The batches are written
+    by 'writer', which also resolves the rows stored by a concurrent run
+    with the 'unique_metar' constraint.
+
+    The time of the fetch, parse, dedup and insert stages is observed in
+    metrics_function.stage_seconds.
+
+    fetched_time, fetched_data, the counts and chunk_errors are reset at
+    each fetch, so an instance can be reused.
+
     Attributes:
         airport_list (list[str]): List of airports to be fetched.
         hour (int): hoursBeforeNow for fetching URL.
+        writer (writer_function.MetarWriter): Writer of the batches, from
+            writer_function.get_writer by default.
+        url (str): URL of the AWC data server.
+        chunk_size (int): The number of airports in one request.
+        max_workers (int): The number of concurrent requests.
+        timeout (float): Seconds of connect and read timeout of a request.
+        retries (int): The maximum number of retries of a request.
+        backoff (float): Backoff factor of the retries in seconds.
+        batch_size (int): The number of Metar parsed and saved at once.
         fetched_time (datetime): Datetime when fetching the METAR data.
         fetched_data (list[Metar]): Metar models from get_models method.
+        inserted_count (int): The number of rows inserted by fetch_and_save.
+        updated_count (int): The number of rows replaced by corrected
+            reports in fetch_and_save.
+        duplicate_count (int): The number of fetched rows skipped as
+            duplicates.
+        chunk_errors (dict[str: str]): Joined airports of the failed chunk
+            and the error message.
     """
-    def __init__(self, airport_list: list[str], hour: int = 25) -> None:
+    URL = r'https://www.aviationweather.gov/adds/dataserver_current/httpparam'
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(
+        self,
+        airport_list: list[str],
+        hour: int = 25,
+        writer: Optional[writer_function.MetarWriter] = None
+    ) -> None:
         self.airport_list = airport_list
         self.hour = hour
+        self.writer = writer or writer_function.get_writer()
+        self.url = self.URL
+        self.chunk_size = 50
+        self.max_workers = 4
+        self.timeout = 30.0
+        self.retries = 3
+        self.backoff = 0.5
+        self.batch_size = 100
         self.fetched_time: datetime = None
         self.fetched_data: list[Metar] = []
+        self.inserted_count = 0
+        self.updated_count = 0
+        self.duplicate_count = 0
+        self.chunk_errors: dict[str: str] = {}
 
     def fetch_and_save(self):
         """Get METAR data and save to database.
+
+        The models are saved by batches while the responses are parsed, in
+        one transaction. If writing a batch fails, none of the batches are
+        saved. A failed chunk is recorded in 'chunk_errors' and does not
+        stop the others. 'metars_inserted' is sent with the inserted and the
+        updated models after the commit.
         """
-        self.get_models()
-        Metar.objects.bulk_create(self.fetched_data, 100)
+        written = []
+        with transaction.atomic():
+            for batch in self.iter_batches():
+                with metrics_function.time_stage('insert'):
+                    result = self.writer.write(batch)
+                self.fetched_data.extend(batch)
+                written.extend(result.written)
+                self.inserted_count += len(result.inserted)
+                self.updated_count += len(result.updated)
+                self.duplicate_count += len(batch) - len(result.written)
+        metars_inserted.send(sender=Metar, metars=written)
 
     def get_models(self) -> list[Metar]:
         """Get METAR data and convert to list of Metar instance(s).
@@ -39,140 +125,382 @@ class MetarInput():
         Returns:
             list[Metar]: List of Metar model instance(s) used for Django ORM.
         """
-        fetched_et = self.__fetch_metar()
-        metar_elements = fetched_et.findall('./data/METAR')
-        store_recent = self.__get_recent()
-        for element in metar_elements:
-            if self.__remove_auto(element.findtext('raw_text')) is True:
-                continue
-            metar_model = self.__get_single_model(element)
-            if self.__is_duplicate(metar_model, store_recent) is True:
-                continue
-            else:
-                self.fetched_data.append(metar_model)
+        for batch in self.iter_batches():
+            self.fetched_data.extend(batch)
         return self.fetched_data
 
-    def __fetch_metar(self) -> ElementTree:
-        """Fetched XML data of METAR. Returns as ElementTree of the XML.
+    def iter_batches(self) -> Iterator[list[Metar]]:
+        """Get METAR data as batches of Metar instances without duplicates.
 
-        The METAR data is fetched from Aviation Weather Center.
+        Batches are yielded while the responses are still being received.
+        The results of the previous fetch are reset.
 
-        Returns:
-            ElementTree: ElementTree of th fetched XML data.
+        Yields:
+            Iterator[list[Metar]]: Lists of at most 'batch_size' Metar.
         """
-        URL = r'https://www.aviationweather.gov/adds/dataserver_current/httpparam'
-        payload = {
-            'dataSource': 'metars',
-            'requestType': 'retrieve',
-            'format': 'xml',
-            'stationString': ','.join(self.airport_list),
-            'hoursBeforeNow': str(self.hour)
-        }
-        res = requests.get(URL, params=payload)
+        self.__reset()
+        with metrics_function.time_stage('dedup'):
+            stored_dict = self.__get_recent_texts()
+        batch = []
+        for fetched_batch in self.__fetch_metar():
+            with metrics_function.time_stage('dedup'):
+                for metar_model in fetched_batch:
+                    if self.__is_duplicate(metar_model, stored_dict) is True:
+                        self.duplicate_count += 1
+                        continue
+                    batch.append(metar_model)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def __reset(self) -> None:
         self.fetched_time = timezone.now()
-        et = fromstring(res.text, forbid_dtd=True)
-        return et
+        self.fetched_data = []
+        self.inserted_count = 0
+        self.updated_count = 0
+        self.duplicate_count = 0
+        self.chunk_errors = {}
 
-    def __remove_auto(self, raw_text: str) -> bool:
-        AUTO_RE = r'Z AUTO'
-        EMPTY_RE = r'/{2,}'
-        if re.search(AUTO_RE, raw_text) is not None and re.search(EMPTY_RE, raw_text) is not None:
-            return True
-        else:
-            return False
+    def __fetch_metar(self) -> Iterator[list[Metar]]:
+        """Fetch XML data of METAR by chunks of airports concurrently.
+        Yields Metar models parsed from all chunks as soon as they arrive.
 
-    def __get_single_model(self, element: Element) -> Metar:
-        """Create Metar instance from Element of XML data.
+        The METAR data is fetched from Aviation Weather Center. Workers put
+        the parsed batches to a bounded queue, so a slow consumer pauses the
+        downloads instead of buffering the responses.
 
-        Args:
-            element (Element): Element of 'METAR' section in the XML.
+        Yields:
+            Iterator[list[Metar]]: Lists of Metar parsed from the responses.
+        """
+        chunks = [
+            self.airport_list[i:i + self.chunk_size]
+            for i in range(0, len(self.airport_list), self.chunk_size)
+        ]
+        batch_queue = queue.Queue(maxsize=self.max_workers * 2)
+        stop_event = threading.Event()
+        # The record of the request is in this thread, not in the workers.
+        record = metrics_function.get_record()
+        with create_session(self.max_workers, self.retries, self.backoff) as session, \
+                ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for chunk in chunks:
+                executor.submit(self.__fetch_chunk, session, chunk, batch_queue, stop_event, record)
+            finished = 0
+            try:
+                while finished < len(chunks):
+                    item = batch_queue.get()
+                    if isinstance(item, list):
+                        yield item
+                        continue
+                    finished += 1
+                    chunk, error = item
+                    if error is not None:
+                        self.chunk_errors[','.join(chunk)] = error
+            finally:
+                stop_event.set()
 
-        Returns:
-            Metar: Metar model of Django ORM.
+    def __fetch_chunk(
+        self,
+        session: requests.Session,
+        chunk: list[str],
+        batch_queue: queue.Queue,
+        stop_event: threading.Event,
+        record: Optional[metrics_function.RequestRecord] = None
+    ) -> None:
+        """Fetch XML data of METAR of the airports in the chunk and put the
+        parsed Metar models to the queue. Nothing is fetched if the consumer
+        has stopped.
 
-        Raises:
-            re.error: if visibility_m is not found.
-        """
-        VIS_RE = r'KT ([0-9]{3}V[0-9]{3} )?(?P<vis>[0-9]{4})'
-        VIS_CAVOK_RE = r'KT ([0-9]{3}V[0-9]{3} )?CAVOK'
-        raw_text = element.findtext('raw_text')
-        station_id = element.findtext('station_id')
-        datetime_rawtext = element.findtext('observation_time')
-        observation_time = dateparse.parse_datetime(datetime_rawtext)
-        temp_c = float(element.findtext('temp_c'))
-        dewpoint_c = float(element.findtext('dewpoint_c'))
-        wind_dir_degrees = int(element.findtext('wind_dir_degrees'))
-        wind_speed_kt = int(element.findtext('wind_speed_kt'))
-        altim_in_hg = float(element.findtext('altim_in_hg'))
-        metar_type = element.findtext('metar_type')
-
-        metar = Metar(
-            raw_text=raw_text,
-            station_id=station_id,
-            observation_time=observation_time,
-            temp_c=temp_c,
-            dewpoint_c=dewpoint_c,
-            wind_dir_degrees=wind_dir_degrees,
-            wind_speed_kt=wind_speed_kt,
-            altim_in_hg=altim_in_hg,
-            metar_type=metar_type
-        )
+        The response body is parsed while it is received. After the last
+        batch, a tuple of the chunk and the error message (None if the chunk
+        succeeded) is put.
 
+        Args:
+            session (requests.Session): Session shared by the chunks.
+            chunk (list[str]): Airports to be fetched.
+            batch_queue (queue.Queue): Queue to the consumer.
+            stop_event (threading.Event): Set if the consumer stopped.
+            record (Optional[metrics_function.RequestRecord], optional):
+                Record of the request which the HTTP time is added to.
+                Defaults to None.
+        """
+        if stop_event.is_set():
+            return
+        payload = {
+            'dataSource': 'metars',
+            'requestType': 'retrieve',
+            'format': 'xml',
+            'stationString': ','.join(chunk),
+            'hoursBeforeNow': str(self.hour)
+        }
+        error = None
         try:
-            vis_match = re.search(VIS_RE, raw_text).group('vis')
-            visibility_m = int(vis_match)
-        except AttributeError:
-            if re.search(VIS_CAVOK_RE, raw_text) is not None:
-                visibility_m = 9999
-            else:
-                raise re.error('visibility is not found in raw text: %s' % raw_text)
-        metar.visibility_m = visibility_m
-
-        if element.findtext('wind_gust_kt') is not None:
-            wind_gust_kt = int(element.findtext('wind_gust_kt'))
-            metar.wind_gust_kt = wind_gust_kt
-
-        if element.findtext('wx_string') is not None:
-            wx_string = element.findtext('wx_string')
-            metar.wx_string = wx_string
-
-        for child in element.iter():
-            if 'sky_cover' in child.attrib and child.attrib['sky_cover'] == 'BKN':
-                cloud_ceiling = int(child.attrib['cloud_base_ft_agl'])
-                metar.cloud_ceiling = cloud_ceiling
-                break
-
-        if element.findtext('vert_vis_ft') is not None:
-            vert_vis_ft = int(element.findtext('vert_vis_ft'))
-            metar.vert_vis_ft = vert_vis_ft
-
-        return metar
-
-    def __is_duplicate(self, metar: Metar, store_recent: QuerySet) -> bool:
+            with metrics_function.time_http(record), metrics_function.time_stage('fetch'):
+                response = session.get(self.url, params=payload, timeout=self.timeout, stream=True)
+            with response as res:
+                res.raise_for_status()
+                res.raw.decode_content = True
+                batches = iter_metar_batches(res.raw, self.batch_size)
+                while True:
+                    # The body is received while it is parsed, so 'parse'
+                    # includes the download after the headers.
+                    with metrics_function.time_http(record, 0), metrics_function.time_stage('parse'):
+                        batch = next(batches, None)
+                    if batch is None:
+                        break
+                    if not put_until_stopped(batch_queue, batch, stop_event):
+                        return
+        except Exception as e:
+            # Any error is reported for the chunk, and the other chunks
+            # continue.
+            error = '%s: %s' % (type(e).__name__, e)
+        put_until_stopped(batch_queue, (chunk, error), stop_event)
+
+    def __is_duplicate(self, metar: Metar, stored_dict: dict[tuple[str, datetime]: str]) -> bool:
         """Check whether Metar object is in recent data.
 
+        The checked Metar object is added to stored_dict, so that the same
+        METAR fetched twice is also regarded as duplicated. A report which
+        replaces the stored one by the correction policy is not duplicated.
+
         Args:
             metar (Metar): Metar model for the check.
-            store_recent (QuerySet): recent data form __get_recent.
+            stored_dict (dict[tuple[str, datetime]: str]): Keys and raw texts
+                of recent data from __get_recent_texts.
 
         Returns:
-            bool: Returns True if metar is in store_recent.
+            bool: Returns True if metar is in stored_dict.
         """
-        for stored in store_recent.values():
-            if (stored['station_id'] == metar.station_id and
-                    stored['observation_time'] == metar.observation_time):
-                return True
+        key = (metar.station_id, metar.observation_time)
+        stored_raw_text = stored_dict.get(key)
+        if stored_raw_text is not None and \
+                not writer_function.replaces(self.writer.policy, stored_raw_text, metar.raw_text):
+            return True
+        stored_dict[key] = metar.raw_text
         return False
 
     def __get_recent(self) -> QuerySet:
-        """Get recent METAR records from database for checking duplicated.
+        """Get recent METAR records of the fetched airports from database.
+
+        The window has one hour margin before 'hour' because AWC returns
+        METARs observed slightly before hoursBeforeNow.
 
         Returns:
             QuerySet: Filtered QuerySet from database.
         """
-        recent_datetime = self.fetched_time - timedelta(hours=73)
+        recent_datetime = self.fetched_time - timedelta(hours=self.hour + 1)
         store_recent = Metar.objects \
             .filter(
+                station_id__in=self.airport_list,
                 observation_time__gte=recent_datetime
             )
         return store_recent
+
+    def __get_recent_texts(self) -> dict[tuple[str, datetime]: str]:
+        """Get keys and raw texts of recent METAR records for checking
+        duplicated.
+
+        Returns:
+            dict[tuple[str, datetime]: str]: (station_id, observation_time)
+                and raw_text.
+        """
+        store_recent = self.__get_recent().values_list('station_id', 'observation_time', 'raw_text')
+        return {(station_id, observation_time): raw_text for station_id, observation_time, raw_text in store_recent}
+
+
+def iter_metar_batches(
+    source: BinaryIO,
+    batch_size: int = 100,
+    on_error: Optional[Callable[[Exception], None]] = None
+) -> Iterator[list[Metar]]:
+    """Parse AWC XML data of METAR incrementally and yield Metar models.
+
+    Each 'METAR' element is removed from the tree after it is converted, so
+    the memory does not grow with the size of the data. METARs of automated
+    stations with missing fields are skipped.
+
+    Args:
+        source (BinaryIO): File-like object of the XML data.
+        batch_size (int, optional): The number of Metar in a batch.
+            Defaults to 100.
+        on_error (Optional[Callable[[Exception], None]], optional): If it is
+            given, an error of a METAR element is passed to it and the
+            element is skipped. Defaults to None.
+
+    Raises:
+        xml.etree.ElementTree.ParseError: Raises if the data is not XML.
+        re.error: Raises if visibility_m is not found and on_error is None.
+
+    Yields:
+        Iterator[list[Metar]]: Lists of at most batch_size Metar.
+    """
+    batch = []
+    parent = None
+    for event, element in iterparse(source, events=('start', 'end'), forbid_dtd=True):
+        if event == 'start':
+            if element.tag == 'data':
+                parent = element
+            continue
+        if element.tag != 'METAR':
+            continue
+        try:
+            metar_model = get_single_model(element)
+        except (KeyError, TypeError, ValueError, re.error) as e:
+            if on_error is None:
+                raise
+            on_error(e)
+            metar_model = None
+        if metar_model is not None:
+            batch.append(metar_model)
+        if parent is not None:
+            parent.remove(element)
+        else:
+            element.clear()
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def get_single_model(element: Element) -> Optional[Metar]:
+    """Create Metar instance from Element of XML data.
+
+    The children of the element are read in one pass.
+
+    Args:
+        element (Element): Element of 'METAR' section in the XML.
+
+    Returns:
+        Optional[Metar]: Metar model of Django ORM. None if the METAR is
+            from an automated station with missing fields.
+
+    Raises:
+        re.error: if visibility_m is not found.
+    """
+    texts: dict[str: str] = {'cloud_ceiling': None}
+    for child in element:
+        if child.tag == 'sky_condition':
+            if texts['cloud_ceiling'] is None and child.get('sky_cover') in CEILING_COVERS:
+                texts['cloud_ceiling'] = child.get('cloud_base_ft_agl')
+        else:
+            texts[child.tag] = child.text
+    return create_metar(texts)
+
+
+def create_metar(texts: dict[str: Optional[str]]) -> Optional[Metar]:
+    """Create Metar instance from texts of the fields.
+
+    The keys are the field names of AWC data. 'cloud_ceiling' is the base
+    of the lowest BKN or OVC layer. Missing values are None, and missing
+    keys are filled with the fields decoded from 'raw_text'. Visibility is
+    always decoded from 'raw_text'.
+
+    Args:
+        texts (dict[str: Optional[str]]): Field names and the texts.
+
+    Returns:
+        Optional[Metar]: Metar model of Django ORM. None if the METAR is
+            from an automated station with missing fields.
+
+    Raises:
+        re.error: if visibility_m is not found.
+    """
+    raw_text = texts['raw_text']
+    decoded = decode_function.decode(raw_text)
+    if decoded.auto and EMPTY_RE.search(raw_text) is not None:
+        return None
+
+    metar = Metar(
+        raw_text=raw_text,
+        station_id=texts.get('station_id') or decoded.station_id,
+        observation_time=dateparse.parse_datetime(texts['observation_time']),
+        temp_c=_get_value(texts, 'temp_c', float, decoded.temp_c),
+        dewpoint_c=_get_value(texts, 'dewpoint_c', float, decoded.dewpoint_c),
+        wind_dir_degrees=_get_value(texts, 'wind_dir_degrees', int, decoded.wind_dir_degrees or 0),
+        wind_speed_kt=_get_value(texts, 'wind_speed_kt', int, decoded.wind_speed_kt),
+        altim_in_hg=_get_value(texts, 'altim_in_hg', float, decoded.altim_in_hg),
+        metar_type=texts.get('metar_type') or decoded.metar_type
+    )
+
+    if decoded.visibility_m is None:
+        raise re.error('visibility is not found in raw text: %s' % raw_text)
+    metar.visibility_m = decoded.visibility_m
+
+    metar.wind_gust_kt = _get_value(texts, 'wind_gust_kt', int, decoded.wind_gust_kt)
+
+    if texts.get('wx_string') is not None:
+        metar.wx_string = texts['wx_string']
+    else:
+        metar.wx_string = _join_weather(decoded.weather)
+
+    if 'cloud_ceiling' in texts:
+        metar.cloud_ceiling = _get_value(texts, 'cloud_ceiling', int, None)
+    else:
+        metar.cloud_ceiling = decoded.cloud_ceiling
+
+    metar.vert_vis_ft = _get_value(texts, 'vert_vis_ft', int, decoded.vert_vis_ft)
+
+    return metar
+
+
+def create_session(max_workers: int, retries: int, backoff: float) -> requests.Session:
+    """Create Session sharing connections and retrying failed requests.
+
+    Args:
+        max_workers (int): The number of the threads sharing the session.
+        retries (int): The maximum number of retries of a request.
+        backoff (float): Backoff factor of the retries in seconds.
+
+    Returns:
+        requests.Session: Session for the fetching.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=MetarInput.RETRY_STATUS,
+        allowed_methods=['GET']
+    )
+    adapter = HTTPAdapter(pool_maxsize=max_workers, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _get_value(texts: dict[str: Optional[str]], name: str, convert: type, default: Any) -> Any:
+    """Convert the text of the field, or return default if it is missing.
+    """
+    text = texts.get(name)
+    if text is None:
+        return default
+    return convert(text)
+
+
+def _join_weather(weather: list[str]) -> str:
+    """Join weather groups by space within the length of wx_string field.
+    """
+    max_length = Metar._meta.get_field('wx_string').max_length
+    wx_string = ''
+    for group in weather:
+        joined = group if not wx_string else wx_string + ' ' + group
+        if len(joined) > max_length:
+            break
+        wx_string = joined
+    return wx_string
+
+
+def put_until_stopped(batch_queue: queue.Queue, item: Any, stop_event: threading.Event) -> bool:
+    """Put the item to the bounded queue unless the consumer stopped.
+
+    Returns:
+        bool: Returns False if the consumer stopped.
+    """
+    while not stop_event.is_set():
+        try:
+            batch_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
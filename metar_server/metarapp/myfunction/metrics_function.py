@@ -0,0 +1,211 @@
+from __future__ import annotations
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+# Upper bounds of the buckets of the histograms.
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Histogram():
+    """Cumulative histogram of observed values by labels, like Prometheus.
+
+    Attributes:
+        name (str): Metric name.
+        help_text (str): Description of the metric.
+        label_names (tuple[str]): Names of the labels.
+        buckets (tuple[float]): Upper bounds of the buckets.
+    """
+    def __init__(self, name: str, help_text: str, label_names: tuple[str], buckets: tuple[float]) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.__lock = threading.Lock()
+        # Labels and [bucket counts..., +Inf count, sum].
+        self.__values: dict[tuple[str]: list[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        """Add a value to the histogram of the labels.
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            values = self.__values.get(labels)
+            if values is None:
+                values = [0] * (len(self.buckets) + 2)
+                self.__values[labels] = values
+            values[index] += 1
+            values[-1] += value
+
+    def get(self, *labels: str) -> tuple[int, float]:
+        """Get the count and the sum of the labels.
+        """
+        with self.__lock:
+            values = self.__values.get(labels)
+            if values is None:
+                return 0, 0.0
+            return sum(values[:-1]), values[-1]
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__values.clear()
+
+    def render(self) -> list[str]:
+        """Render the histogram in Prometheus text format.
+        """
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s histogram' % self.name]
+        with self.__lock:
+            items = sorted((labels, list(values)) for labels, values in self.__values.items())
+        for labels, values in items:
+            label_text = ','.join('%s="%s"' % (name, _escape(value)) for name, value in zip(self.label_names, labels))
+            prefix = label_text + ',' if label_text else ''
+            count = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), values[:-1]):
+                count += bucket_count
+                lines.append('%s_bucket{%sle="%s"} %d' % (self.name, prefix, _format_bound(bound), count))
+            label_block = '{%s}' % label_text if label_text else ''
+            lines.append('%s_sum%s %r' % (self.name, label_block, float(values[-1])))
+            lines.append('%s_count%s %d' % (self.name, label_block, count))
+        return lines
+
+
+class RequestRecord():
+    """Queries and timings of a request in this thread.
+
+    Attributes:
+        query_count (int): The number of the SQL queries.
+        sql_time (float): Seconds of the SQL queries.
+        template_time (float): Seconds of rendering the templates.
+        http_count (int): The number of the external HTTP requests.
+        http_time (float): Seconds of the external HTTP requests until the
+            body is read, summed over the concurrent requests.
+        queries (Optional[list[tuple[str, float]]]): SQL and the seconds, if
+            the request is sampled for the slow request log.
+    """
+    def __init__(self, capture_sql: bool = False) -> None:
+        self.__lock = threading.Lock()
+        self.query_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.http_count = 0
+        self.http_time = 0.0
+        self.queries: Optional[list[tuple[str, float]]] = [] if capture_sql else None
+
+    def add_http(self, seconds: float, count: int = 1) -> None:
+        """Add the time of external HTTP requests. It may be called from the
+        worker threads of the request.
+        """
+        with self.__lock:
+            self.http_count += count
+            self.http_time += seconds
+
+
+request_seconds = Histogram(
+    'metar_request_duration_seconds', 'Latency of the views.', ('view',), SECONDS_BUCKETS
+)
+request_queries = Histogram(
+    'metar_request_queries', 'SQL queries per request.', ('view',), COUNT_BUCKETS
+)
+request_sql_seconds = Histogram(
+    'metar_request_sql_seconds', 'SQL time per request.', ('view',), SECONDS_BUCKETS
+)
+request_template_seconds = Histogram(
+    'metar_request_template_seconds', 'Template render time per request.', ('view',), SECONDS_BUCKETS
+)
+request_http_seconds = Histogram(
+    'metar_request_http_seconds', 'External HTTP time per request.', ('view',), SECONDS_BUCKETS
+)
+stage_seconds = Histogram(
+    'metar_ingest_stage_seconds', 'Time of the stages of fetching METARs.', ('stage',), SECONDS_BUCKETS
+)
+HISTOGRAMS = (
+    request_seconds, request_queries, request_sql_seconds, request_template_seconds, request_http_seconds,
+    stage_seconds
+)
+
+_local = threading.local()
+
+
+def start_record(capture_sql: bool = False) -> RequestRecord:
+    """Start recording the queries and timings of this thread.
+    """
+    _local.record = RequestRecord(capture_sql)
+    return _local.record
+
+
+def end_record() -> Optional[RequestRecord]:
+    """Stop recording in this thread and get the record.
+    """
+    record = getattr(_local, 'record', None)
+    _local.record = None
+    return record
+
+
+def get_record() -> Optional[RequestRecord]:
+    """Get the record of this thread, None if not recording.
+    """
+    return getattr(_local, 'record', None)
+
+
+def observe_request(view: str, seconds: float, record: RequestRecord) -> None:
+    request_seconds.observe(seconds, view)
+    request_queries.observe(record.query_count, view)
+    request_sql_seconds.observe(record.sql_time, view)
+    request_template_seconds.observe(record.template_time, view)
+    request_http_seconds.observe(record.http_time, view)
+
+
+@contextmanager
+def time_http(record: Optional[RequestRecord], count: int = 1) -> Iterator[None]:
+    """Add the time of the block to the record as external HTTP time.
+
+    The record is given because the block may run in a worker thread.
+    'count' is 0 for reading the body of a counted request.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if record is not None:
+            record.add_http(time.perf_counter() - start, count)
+
+
+@contextmanager
+def time_stage(stage: str) -> Iterator[None]:
+    """Observe the time of the block as the stage.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, stage)
+
+
+def render_prometheus(counters: Optional[dict[str: tuple[str, float]]] = None) -> str:
+    """Render the histograms and the counters in Prometheus text format.
+
+    Args:
+        counters (Optional[dict[str: tuple[str, float]]], optional): Names
+            of the counters and (help text, value). Defaults to None.
+
+    Returns:
+        str: Text of the metrics.
+    """
+    lines = []
+    for name, (help_text, value) in (counters or {}).items():
+        lines.extend(['# HELP %s %s' % (name, help_text), '# TYPE %s counter' % name, '%s %r' % (name, float(value))])
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    return '\n'.join(lines) + '\n'
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_bound(bound: float) -> str:
+    return '+Inf' if bound == math.inf else repr(float(bound))
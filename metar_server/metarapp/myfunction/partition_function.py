@@ -0,0 +1,196 @@
+from __future__ import annotations
+from datetime import date, datetime, timezone
+from django.db import connection, transaction
+from typing import Optional
+from ..models import Metar
+
+METAR_TABLE = Metar._meta.db_table
+PARTITION_FORMAT = METAR_TABLE + r'_p%Y%m'
+UNPARTITIONED_TABLE = METAR_TABLE + '_unpartitioned'
+
+
+class PartitionError(Exception):
+    """Raised if the partitioning is not available for the database.
+    """
+    pass
+
+
+def check_postgresql() -> None:
+    """Check that the database supports declarative partitioning.
+
+    Raises:
+        PartitionError: Raises if the database is not PostgreSQL.
+    """
+    if connection.vendor != 'postgresql':
+        raise PartitionError('Partitioning is supported only on PostgreSQL, but %s is used.'
+                             % connection.vendor)
+
+
+def is_partitioned() -> bool:
+    """Check whether the Metar table is partitioned.
+
+    Returns:
+        bool: Returns True if the Metar table is partitioned by range.
+    """
+    check_postgresql()
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT relkind FROM pg_class WHERE relname = %s', [METAR_TABLE])
+        row = cursor.fetchone()
+    return row is not None and row[0] == 'p'
+
+
+def get_partitions() -> dict[date, str]:
+    """Get partitions attached to the Metar table.
+
+    Returns:
+        dict[date, str]: The first day of the month and the partition name.
+    """
+    check_postgresql()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT child.relname FROM pg_inherits '
+            'JOIN pg_class parent ON pg_inherits.inhparent = parent.oid '
+            'JOIN pg_class child ON pg_inherits.inhrelid = child.oid '
+            'WHERE parent.relname = %s',
+            [METAR_TABLE]
+        )
+        names = [row[0] for row in cursor.fetchall()]
+    partitions = {}
+    for name in names:
+        month = parse_partition_name(name)
+        if month is not None:
+            partitions[month] = name
+    return partitions
+
+
+def get_partition_name(month: date) -> str:
+    """Get the name of the partition of the month.
+    """
+    return month.strftime(PARTITION_FORMAT)
+
+
+def parse_partition_name(name: str) -> Optional[date]:
+    """Get the first day of the month of the partition.
+
+    Returns:
+        Optional[date]: None if the name is not made by get_partition_name,
+            like a default partition.
+    """
+    try:
+        month = datetime.strptime(name, PARTITION_FORMAT).date()
+    except ValueError:
+        return None
+    if get_partition_name(month) != name:
+        return None
+    return month
+
+
+def convert_to_partitioned() -> int:
+    """Convert the Metar table to the table partitioned by month.
+
+    The constraints and the indexes are recreated on the partitioned table,
+    and the primary key becomes (id, observation_time) because PostgreSQL
+    requires the partition key in it. The partitions for the stored months
+    are created and all rows are copied in one transaction.
+
+    Returns:
+        int: The number of the copied rows.
+    """
+    if is_partitioned():
+        return 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' % METAR_TABLE)
+        cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [METAR_TABLE, 'id'])
+        sequence = cursor.fetchone()[0]
+        cursor.execute('ALTER TABLE %s RENAME TO %s' % (METAR_TABLE, UNPARTITIONED_TABLE))
+        cursor.execute('ALTER TABLE %s RENAME CONSTRAINT %s_pkey TO %s_pkey'
+                       % (UNPARTITIONED_TABLE, METAR_TABLE, UNPARTITIONED_TABLE))
+        cursor.execute('ALTER TABLE %s RENAME CONSTRAINT unique_metar TO unique_metar_unpartitioned'
+                       % UNPARTITIONED_TABLE)
+        for index in Metar._meta.indexes:
+            cursor.execute('ALTER INDEX %s RENAME TO %s_unpartitioned' % (index.name, index.name))
+        cursor.execute(
+            'CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS) '
+            'PARTITION BY RANGE (observation_time)'
+            % (METAR_TABLE, UNPARTITIONED_TABLE)
+        )
+        cursor.execute('ALTER TABLE %s ADD CONSTRAINT %s_pkey PRIMARY KEY (id, observation_time)'
+                       % (METAR_TABLE, METAR_TABLE))
+        cursor.execute('ALTER TABLE %s ADD CONSTRAINT unique_metar UNIQUE (station_id, observation_time)'
+                       % METAR_TABLE)
+        schema_editor = connection.schema_editor()
+        for index in Metar._meta.indexes:
+            cursor.execute(str(index.create_sql(Metar, schema_editor)))
+        cursor.execute('ALTER SEQUENCE %s OWNED BY %s.id' % (sequence, METAR_TABLE))
+        cursor.execute('SELECT MIN(observation_time), MAX(observation_time) FROM %s' % UNPARTITIONED_TABLE)
+        oldest, newest = cursor.fetchone()
+        if oldest is not None:
+            create_partitions(oldest.date(), newest.date())
+        cursor.execute('INSERT INTO %s SELECT * FROM %s' % (METAR_TABLE, UNPARTITIONED_TABLE))
+        copied = cursor.rowcount
+        cursor.execute('DROP TABLE %s' % UNPARTITIONED_TABLE)
+    return copied
+
+
+def create_partitions(start: date, end: date) -> list[str]:
+    """Create monthly partitions from the month of start to that of end.
+
+    Existing partitions are skipped.
+
+    Args:
+        start (date): A day in the first month.
+        end (date): A day in the last month.
+
+    Returns:
+        list[str]: Names of the created partitions.
+    """
+    partitions = get_partitions()
+    created = []
+    month = start.replace(day=1)
+    with connection.cursor() as cursor:
+        while month <= end:
+            next_month = add_months(month, 1)
+            if month not in partitions:
+                name = get_partition_name(month)
+                cursor.execute(
+                    'CREATE TABLE %s PARTITION OF %s FOR VALUES FROM (%%s) TO (%%s)' % (name, METAR_TABLE),
+                    [_utc_datetime(month), _utc_datetime(next_month)]
+                )
+                created.append(name)
+            month = next_month
+    return created
+
+
+def detach_partitions(before: date, drop: bool = False) -> list[str]:
+    """Detach the partitions of the months before the given day.
+
+    Detached partitions are left as plain tables unless 'drop' is True.
+
+    Args:
+        before (date): Partitions ending on or before this month are detached.
+        drop (bool, optional): Drop the detached tables. Defaults to False.
+
+    Returns:
+        list[str]: Names of the detached partitions.
+    """
+    detached = []
+    with transaction.atomic(), connection.cursor() as cursor:
+        for month, name in sorted(get_partitions().items()):
+            if month >= before.replace(day=1):
+                continue
+            cursor.execute('ALTER TABLE %s DETACH PARTITION %s' % (METAR_TABLE, name))
+            if drop:
+                cursor.execute('DROP TABLE %s' % name)
+            detached.append(name)
+    return detached
+
+
+def add_months(month: date, months: int) -> date:
+    """Get the first day of the month the given months after.
+    """
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _utc_datetime(day: date) -> datetime:
+    return datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
@@ -0,0 +1,356 @@
+from __future__ import annotations
+import io
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import django
+from concurrent.futures import Executor, ProcessPoolExecutor
+from datetime import datetime
+from django.utils import timezone
+from typing import Optional
+from ..models import Metar
+from ..signals import metars_inserted
+from . import metar_function, metrics_function, writer_function
+
+# Field names of Metar passed from the parse workers.
+FIELD_NAMES = tuple(field.attname for field in Metar._meta.concrete_fields if not field.primary_key)
+# Put to the queues by a producer when it is finished.
+_FINISHED = None
+
+
+class StageStats():
+    """Throughput and input queue depth of a stage of the pipeline.
+
+    Attributes:
+        name (str): Name of the stage.
+        items (int): The number of the processed items (responses or
+            batches).
+        rows (int): The number of the produced METARs.
+        size (int): Bytes of the downloaded responses.
+        busy_seconds (float): Total seconds the workers of the stage worked,
+            without waiting for the queues.
+        max_depth (int): The maximum depth of the input queue.
+    """
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.items = 0
+        self.rows = 0
+        self.size = 0
+        self.busy_seconds = 0.0
+        self.max_depth = 0
+        self.__depth_total = 0
+        self.__depth_count = 0
+        self.__lock = threading.Lock()
+
+    def add(self, rows: int, seconds: float, size: int = 0) -> None:
+        with self.__lock:
+            self.items += 1
+            self.rows += rows
+            self.size += size
+            self.busy_seconds += seconds
+
+    def observe_depth(self, depth: int) -> None:
+        """Record the depth of the input queue when an item is taken.
+        """
+        with self.__lock:
+            self.max_depth = max(self.max_depth, depth)
+            self.__depth_total += depth
+            self.__depth_count += 1
+
+    def as_dict(self, wall_seconds: float) -> dict[str: float]:
+        """Get the numbers of the stage. 'rows_per_s' is by the wall time of
+        the pipeline.
+        """
+        with self.__lock:
+            return {
+                'items': self.items,
+                'rows': self.rows,
+                'bytes': self.size,
+                'busy_seconds': round(self.busy_seconds, 3),
+                'rows_per_s': round(self.rows / wall_seconds, 1) if wall_seconds > 0 else 0.0,
+                'mean_depth': round(self.__depth_total / self.__depth_count, 2) if self.__depth_count else 0.0,
+                'max_depth': self.max_depth
+            }
+
+
+class MetarPipeline():
+    """Staged pipeline fetching METARs from AWC and saving to database.
+
+    The stages run concurrently and are connected by bounded queues, so a
+    slow stage pauses the stages before it and the memory is capped by the
+    queue sizes:
+
+    fetch: 'fetch_workers' threads download the chunks of 'chunk_size'
+        airports and put the response bodies to the parse queue.
+    parse: The bodies are parsed in a pool of 'parse_workers' processes,
+        and the METARs are put to the write queue. They are parsed in the
+        threads of the stage if 'parse_workers' is 0.
+    write: The calling thread writes the METARs by batches of 'batch_size'
+        with 'writer' and sends 'metars_inserted' for each batch.
+
+    Unlike MetarInput, the stored reports are not read in advance, so the
+    memory does not grow with the fetched time window. The writer skips or
+    replaces the stored rows by its correction policy, and they are counted
+    as duplicates.
+
+    Attributes:
+        airport_list (list[str]): List of airports to be fetched.
+        hour (int): hoursBeforeNow for fetching URL.
+        writer (writer_function.MetarWriter): Writer of the batches, from
+            writer_function.get_writer by default.
+        url (str): URL of the AWC data server.
+        chunk_size (int): The number of airports in one request.
+        fetch_workers (int): The number of concurrent requests.
+        parse_workers (int): The number of the parse processes, the number
+            of CPUs by default.
+        queue_size (int): The maximum number of the items in each queue.
+        timeout (float): Seconds of connect and read timeout of a request.
+        retries (int): The maximum number of retries of a request.
+        backoff (float): Backoff factor of the retries in seconds.
+        batch_size (int): The number of Metar written at once.
+        fetched_time (datetime): Datetime when fetching the METAR data.
+        fetched_count (int): The number of the parsed METARs.
+        inserted_count (int): The number of the inserted rows.
+        updated_count (int): The number of rows replaced by corrected
+            reports.
+        duplicate_count (int): The number of the rows skipped by the writer.
+        invalid_count (int): The number of the METAR elements which could
+            not be parsed.
+        chunk_errors (dict[str: str]): Joined airports of the failed chunk
+            and the error message.
+        stats (dict[str: StageStats]): Stats of 'fetch', 'parse' and
+            'write'.
+        wall_seconds (float): Seconds of the run.
+    """
+    def __init__(
+        self,
+        airport_list: list[str],
+        hour: int = 25,
+        writer: Optional[writer_function.MetarWriter] = None
+    ) -> None:
+        self.airport_list = airport_list
+        self.hour = hour
+        self.writer = writer or writer_function.get_writer()
+        self.url = metar_function.MetarInput.URL
+        self.chunk_size = 50
+        self.fetch_workers = 4
+        self.parse_workers = os.cpu_count() or 1
+        self.queue_size = 8
+        self.timeout = 30.0
+        self.retries = 3
+        self.backoff = 0.5
+        self.batch_size = 1000
+        self.fetched_time: datetime = None
+        self.fetched_count = 0
+        self.inserted_count = 0
+        self.updated_count = 0
+        self.duplicate_count = 0
+        self.invalid_count = 0
+        self.chunk_errors: dict[str: str] = {}
+        self.stats = {name: StageStats(name) for name in ('fetch', 'parse', 'write')}
+        self.wall_seconds = 0.0
+
+    def run(self) -> None:
+        """Fetch, parse and save the METARs of all chunks.
+
+        Raises:
+            Exception: Raises the error of writing, after the other stages
+                are stopped.
+        """
+        self.fetched_time = timezone.now()
+        start = time.perf_counter()
+        chunk_queue = queue.Queue()
+        for i in range(0, len(self.airport_list), self.chunk_size):
+            chunk_queue.put(self.airport_list[i:i + self.chunk_size])
+        body_queue = queue.Queue(maxsize=self.queue_size)
+        metar_queue = queue.Queue(maxsize=self.queue_size)
+        stop_event = threading.Event()
+        parse_thread_count = max(1, self.parse_workers)
+        # The last fetch thread tells the end to all parse threads.
+        fetch_running = [self.fetch_workers]
+        fetch_lock = threading.Lock()
+        executor = self.__create_executor()
+        try:
+            fetch_threads = [
+                threading.Thread(
+                    target=self.__fetch,
+                    args=(chunk_queue, body_queue, stop_event, fetch_running, fetch_lock, parse_thread_count),
+                    daemon=True
+                )
+                for _ in range(self.fetch_workers)
+            ]
+            parse_threads = [
+                threading.Thread(
+                    target=self.__parse,
+                    args=(executor, body_queue, metar_queue, stop_event),
+                    daemon=True
+                )
+                for _ in range(parse_thread_count)
+            ]
+            for thread in fetch_threads + parse_threads:
+                thread.start()
+            try:
+                self.__write(metar_queue, parse_thread_count)
+            finally:
+                stop_event.set()
+                for thread in fetch_threads + parse_threads:
+                    thread.join()
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            self.wall_seconds = time.perf_counter() - start
+
+    def get_stats(self) -> dict[str: dict[str: float]]:
+        """Get the throughput and the queue depth of the stages.
+        """
+        return {name: stats.as_dict(self.wall_seconds) for name, stats in self.stats.items()}
+
+    def __create_executor(self) -> Optional[Executor]:
+        """Create the pool of the parse processes. The processes are spawned
+        instead of forked, because the threads of this process may hold
+        locks, and Django is set up before this module is imported there.
+        """
+        if self.parse_workers <= 0:
+            return None
+        return ProcessPoolExecutor(
+            max_workers=self.parse_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=django.setup
+        )
+
+    def __fetch(
+        self,
+        chunk_queue: queue.Queue,
+        body_queue: queue.Queue,
+        stop_event: threading.Event,
+        fetch_running: list[int],
+        fetch_lock: threading.Lock,
+        parse_thread_count: int
+    ) -> None:
+        """Download the chunks until chunk_queue is empty. The last fetch
+        thread puts _FINISHED for each parse thread.
+        """
+        stats = self.stats['fetch']
+        with metar_function.create_session(self.fetch_workers, self.retries, self.backoff) as session:
+            while not stop_event.is_set():
+                try:
+                    chunk = chunk_queue.get_nowait()
+                except queue.Empty:
+                    break
+                payload = {
+                    'dataSource': 'metars',
+                    'requestType': 'retrieve',
+                    'format': 'xml',
+                    'stationString': ','.join(chunk),
+                    'hoursBeforeNow': str(self.hour)
+                }
+                start = time.perf_counter()
+                try:
+                    with metrics_function.time_stage('fetch'):
+                        response = session.get(self.url, params=payload, timeout=self.timeout)
+                        response.raise_for_status()
+                except Exception as e:
+                    # Any error is reported for the chunk, and the other
+                    # chunks continue.
+                    self.chunk_errors[','.join(chunk)] = '%s: %s' % (type(e).__name__, e)
+                    continue
+                stats.add(0, time.perf_counter() - start, len(response.content))
+                if not metar_function.put_until_stopped(body_queue, (chunk, response.content), stop_event):
+                    return
+        with fetch_lock:
+            fetch_running[0] -= 1
+            last = fetch_running[0] == 0
+        if last:
+            for _ in range(parse_thread_count):
+                metar_function.put_until_stopped(body_queue, _FINISHED, stop_event)
+
+    def __parse(
+        self,
+        executor: Optional[Executor],
+        body_queue: queue.Queue,
+        metar_queue: queue.Queue,
+        stop_event: threading.Event
+    ) -> None:
+        """Parse the bodies in the pool until the fetch stage is finished.
+        Each parse thread keeps one body in the pool.
+        """
+        stats = self.stats['parse']
+        while not stop_event.is_set():
+            try:
+                item = body_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _FINISHED:
+                break
+            stats.observe_depth(body_queue.qsize() + 1)
+            chunk, body = item
+            start = time.perf_counter()
+            try:
+                with metrics_function.time_stage('parse'):
+                    if executor is None:
+                        rows, invalid_count = parse_body(body)
+                    else:
+                        rows, invalid_count = executor.submit(parse_body, body).result()
+            except Exception as e:
+                self.chunk_errors[','.join(chunk)] = '%s: %s' % (type(e).__name__, e)
+                continue
+            stats.add(len(rows), time.perf_counter() - start)
+            if not metar_function.put_until_stopped(metar_queue, (rows, invalid_count), stop_event):
+                return
+        metar_function.put_until_stopped(metar_queue, _FINISHED, stop_event)
+
+    def __write(self, metar_queue: queue.Queue, parse_thread_count: int) -> None:
+        """Write the METARs by batches until all parse threads are finished.
+        """
+        stats = self.stats['write']
+        parse_finished = 0
+        batch: list[Metar] = []
+        while parse_finished < parse_thread_count:
+            item = metar_queue.get()
+            if item is _FINISHED:
+                parse_finished += 1
+                continue
+            stats.observe_depth(metar_queue.qsize() + 1)
+            rows, invalid_count = item
+            self.fetched_count += len(rows)
+            self.invalid_count += invalid_count
+            batch.extend(Metar(**dict(zip(FIELD_NAMES, row))) for row in rows)
+            while len(batch) >= self.batch_size:
+                self.__write_batch(batch[:self.batch_size])
+                batch = batch[self.batch_size:]
+        if batch:
+            self.__write_batch(batch)
+
+    def __write_batch(self, batch: list[Metar]) -> None:
+        start = time.perf_counter()
+        with metrics_function.time_stage('insert'):
+            result = self.writer.write(batch)
+        self.stats['write'].add(len(result.written), time.perf_counter() - start)
+        self.inserted_count += len(result.inserted)
+        self.updated_count += len(result.updated)
+        self.duplicate_count += len(batch) - len(result.written)
+        metars_inserted.send(sender=Metar, metars=result.written)
+
+
+def parse_body(body: bytes) -> tuple[list[tuple], int]:
+    """Parse AWC XML data of METAR in a parse process.
+
+    The METARs are returned as tuples of FIELD_NAMES, which are smaller to
+    pass between the processes than the models.
+
+    Args:
+        body (bytes): XML data.
+
+    Returns:
+        tuple[list[tuple], int]: Values of the METARs and the number of the
+            METAR elements which could not be parsed.
+    """
+    errors = []
+    rows = [
+        tuple(getattr(metar, name) for name in FIELD_NAMES)
+        for batch in metar_function.iter_metar_batches(io.BytesIO(body), 1000, errors.append)
+        for metar in batch
+    ]
+    return rows, len(errors)
@@ -0,0 +1,313 @@
+from __future__ import annotations
+import re
+from datetime import date, datetime, timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Max, Min, Q, Sum
+from django.db.models.functions import TruncHour, TruncMonth, TruncYear
+from django.utils import timezone
+from typing import Iterable, Optional
+from ..models import Metar, MetarDailyRollup, MetarHourlyRollup
+from . import archive_function, partition_function
+
+WX_CODE_RE = re.compile(r'[A-Z]{2}')
+PERIOD_TRUNC = {
+    'month': TruncMonth,
+    'year': TruncYear
+}
+# Fields of MetarRollup summed, minimized and maximized over periods.
+SUM_FIELDS = (
+    'count', 'temp_sum', 'dewpoint_sum', 'wind_speed_sum', 'altim_sum', 'visibility_sum',
+    'below_ceiling_count', 'below_visibility_count'
+)
+MIN_FIELDS = ('temp_min', 'altim_min', 'visibility_min')
+MAX_FIELDS = ('temp_max', 'wind_speed_max', 'wind_gust_max', 'altim_max')
+MEAN_FIELDS = {
+    'temp_mean': 'temp_sum',
+    'dewpoint_mean': 'dewpoint_sum',
+    'wind_speed_mean': 'wind_speed_sum',
+    'altim_mean': 'altim_sum',
+    'visibility_mean': 'visibility_sum'
+}
+
+
+def update_rollups(metars: list[Metar]) -> None:
+    """Rebuild the rollups of the local days of the inserted METARs.
+
+    Each station-day is aggregated again from Metar, so the rollups are
+    right even if the METARs are inserted out of order or twice.
+
+    Args:
+        metars (list[Metar]): Inserted Metar models.
+    """
+    day_dict: dict[date: set[str]] = {}
+    for metar in metars:
+        day = timezone.localtime(metar.observation_time).date()
+        day_dict.setdefault(day, set()).add(metar.station_id)
+    for day, stations in sorted(day_dict.items()):
+        rebuild_range(sorted(stations), day, day)
+
+
+def rebuild_rollups(stations: Optional[list[str]] = None, first_day: date = None, last_day: date = None) -> int:
+    """Rebuild the rollups by months.
+
+    Args:
+        stations (Optional[list[str]], optional): ICAO ids of the stations.
+            Defaults to None (all stations in Metar).
+        first_day (date, optional): The first local day. Defaults to None
+            (the day of the oldest METAR).
+        last_day (date, optional): The last local day. Defaults to None
+            (the day of the newest METAR).
+
+    Returns:
+        int: The number of the rebuilt hourly rollups.
+    """
+    metar_query = Metar.objects.all()
+    if stations is None:
+        stations = list(metar_query.order_by('station_id').values_list('station_id', flat=True).distinct())
+    else:
+        metar_query = metar_query.filter(station_id__in=stations)
+    if first_day is None or last_day is None:
+        time_range = metar_query.aggregate(oldest=Min('observation_time'), newest=Max('observation_time'))
+        if time_range['oldest'] is None:
+            return 0
+        first_day = first_day or timezone.localtime(time_range['oldest']).date()
+        last_day = last_day or timezone.localtime(time_range['newest']).date()
+    hourly_count = 0
+    month = first_day.replace(day=1)
+    while month <= last_day:
+        next_month = partition_function.add_months(month, 1)
+        hourly_count += rebuild_range(
+            stations,
+            max(month, first_day),
+            min(next_month - timedelta(days=1), last_day)
+        )
+        month = next_month
+    return hourly_count
+
+
+def rebuild_range(stations: list[str], first_day: date, last_day: date) -> int:
+    """Aggregate METARs of the stations between the local days and replace
+    the rollups.
+
+    The hours are in UTC and each hour belongs to the local day of its
+    start.
+
+    Args:
+        stations (list[str]): ICAO ids of the stations.
+        first_day (date): The first local day.
+        last_day (date): The last local day.
+
+    Returns:
+        int: The number of the hourly rollups.
+    """
+    start_time = _local_midnight(first_day)
+    end_time = _local_midnight(last_day + timedelta(days=1))
+    # Rollups of the archived months are kept because their METARs are not
+    # in Metar any more.
+    archived_stations = archive_function.get_archived_stations(stations, start_time, end_time)
+    stations = [station for station in stations if station not in archived_stations]
+    if not stations:
+        return 0
+    metar_query = Metar.objects \
+        .filter(
+            station_id__in=stations,
+            observation_time__gte=start_time,
+            observation_time__lt=end_time
+        )
+    hourly_list = aggregate_hours(metar_query)
+    daily_list = sum_days(hourly_list)
+    with transaction.atomic():
+        MetarHourlyRollup.objects \
+            .filter(
+                station_id__in=stations,
+                hour__gte=start_time,
+                hour__lt=end_time
+            ) \
+            .delete()
+        MetarHourlyRollup.objects.bulk_create(hourly_list, batch_size=1000)
+        MetarDailyRollup.objects \
+            .filter(
+                station_id__in=stations,
+                day__gte=first_day,
+                day__lte=last_day
+            ) \
+            .delete()
+        MetarDailyRollup.objects.bulk_create(daily_list, batch_size=1000)
+    return len(hourly_list)
+
+
+def aggregate_hours(metar_query) -> list[MetarHourlyRollup]:
+    """Aggregate the METARs by station and hour in one grouped query.
+
+    Weather phenomena are counted from 'wx_string' of the METARs which have
+    it.
+
+    Args:
+        metar_query (QuerySet): Metar QuerySet to be aggregated.
+
+    Returns:
+        list[MetarHourlyRollup]: Unsaved hourly rollups.
+    """
+    ceiling_minimum = getattr(settings, 'METAR_CEILING_MINIMUM_FT', 1000)
+    visibility_minimum = getattr(settings, 'METAR_VISIBILITY_MINIMUM_M', 5000)
+    hour_query = metar_query \
+        .annotate(hour=TruncHour('observation_time', tzinfo=timezone.utc)) \
+        .values('station_id', 'hour') \
+        .annotate(
+            count=Count('id'),
+            temp_sum=Sum('temp_c'),
+            temp_min=Min('temp_c'),
+            temp_max=Max('temp_c'),
+            dewpoint_sum=Sum('dewpoint_c'),
+            wind_speed_sum=Sum('wind_speed_kt'),
+            wind_speed_max=Max('wind_speed_kt'),
+            wind_gust_max=Max('wind_gust_kt'),
+            altim_sum=Sum('altim_in_hg'),
+            altim_min=Min('altim_in_hg'),
+            altim_max=Max('altim_in_hg'),
+            visibility_sum=Sum('visibility_m'),
+            visibility_min=Min('visibility_m'),
+            below_ceiling_count=Count('id', filter=Q(cloud_ceiling__lt=ceiling_minimum)),
+            below_visibility_count=Count('id', filter=Q(visibility_m__lt=visibility_minimum))
+        ) \
+        .order_by()
+    wx_dict: dict[tuple[str, datetime]: dict[str: int]] = {}
+    wx_query = metar_query \
+        .exclude(wx_string='') \
+        .values_list('station_id', 'observation_time', 'wx_string')
+    for station_id, observation_time, wx_string in wx_query:
+        hour = observation_time.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+        _add_counts(wx_dict.setdefault((station_id, hour), {}), count_weather(wx_string))
+    return [
+        MetarHourlyRollup(wx_counts=wx_dict.get((row['station_id'], row['hour']), {}), **row)
+        for row in hour_query
+    ]
+
+
+def sum_days(hourly_list: Iterable[MetarHourlyRollup]) -> list[MetarDailyRollup]:
+    """Sum the hourly rollups by station and local day.
+
+    Args:
+        hourly_list (Iterable[MetarHourlyRollup]): Hourly rollups.
+
+    Returns:
+        list[MetarDailyRollup]: Unsaved daily rollups.
+    """
+    daily_dict: dict[tuple[str, date]: MetarDailyRollup] = {}
+    for hourly in hourly_list:
+        key = (hourly.station_id, timezone.localtime(hourly.hour).date())
+        daily = daily_dict.get(key)
+        if daily is None:
+            daily = MetarDailyRollup(
+                station_id=hourly.station_id,
+                day=key[1],
+                below_ceiling_hours=0,
+                below_visibility_hours=0,
+                wx_counts={},
+                **{name: getattr(hourly, name) for name in SUM_FIELDS + MIN_FIELDS + MAX_FIELDS}
+            )
+            daily_dict[key] = daily
+        else:
+            _merge_rollup(daily, hourly)
+        daily.below_ceiling_hours += hourly.below_ceiling_count > 0
+        daily.below_visibility_hours += hourly.below_visibility_count > 0
+        _add_counts(daily.wx_counts, hourly.wx_counts)
+    return list(daily_dict.values())
+
+
+def summarize(stations: list[str], first_day: date, last_day: date, period: str = 'total') -> list[dict]:
+    """Get statistics of the stations between the local days from the daily
+    rollups.
+
+    Args:
+        stations (list[str]): ICAO ids of the stations.
+        first_day (date): The first local day.
+        last_day (date): The last local day.
+        period (str, optional): 'day', 'month', 'year' or 'total'. Defaults
+            to 'total'.
+
+    Returns:
+        list[dict]: Statistics ordered by station and period. 'period' is the
+            first day of the period, or None for 'total'.
+    """
+    daily_query = MetarDailyRollup.objects \
+        .filter(
+            station_id__in=stations,
+            day__gte=first_day,
+            day__lte=last_day
+        )
+    if period == 'day':
+        daily_query = daily_query.annotate(period=F('day'))
+    elif period in PERIOD_TRUNC:
+        daily_query = daily_query.annotate(period=PERIOD_TRUNC[period]('day'))
+    group_fields = ['station_id'] if period == 'total' else ['station_id', 'period']
+    aggregates = {name: Sum(name) for name in SUM_FIELDS + ('below_ceiling_hours', 'below_visibility_hours')}
+    aggregates.update({name: Min(name) for name in MIN_FIELDS})
+    aggregates.update({name: Max(name) for name in MAX_FIELDS})
+    summary_query = daily_query \
+        .values(*group_fields) \
+        .annotate(**aggregates) \
+        .order_by(*group_fields)
+    wx_dict: dict[tuple: dict[str: int]] = {}
+    for row in daily_query.values(*group_fields, 'wx_counts').order_by():
+        if row['wx_counts']:
+            key = (row['station_id'], row.get('period'))
+            _add_counts(wx_dict.setdefault(key, {}), row['wx_counts'])
+
+    summary_list = []
+    for row in summary_query:
+        summary = {'station_id': row['station_id'], 'period': row.get('period')}
+        for mean_name, sum_name in MEAN_FIELDS.items():
+            summary[mean_name] = round(row.pop(sum_name) / row['count'], 2)
+        summary.update(row)
+        summary['wx_counts'] = wx_dict.get((row['station_id'], row.get('period')), {})
+        summary_list.append(summary)
+    return summary_list
+
+
+def estimate_count(stations: list[str], first_day: date, last_day: date) -> Optional[int]:
+    """Estimate the number of METARs of the stations between the local days
+    from the daily rollups, without counting Metar.
+
+    Returns:
+        Optional[int]: The number of METARs, None if there is no rollup.
+    """
+    return MetarDailyRollup.objects \
+        .filter(
+            station_id__in=stations,
+            day__gte=first_day,
+            day__lte=last_day
+        ) \
+        .aggregate(count=Sum('count'))['count']
+
+
+def count_weather(wx_string: str) -> dict[str: int]:
+    """Count the weather phenomena of a METAR once each.
+
+    Args:
+        wx_string (str): Present weather like '-SHRA BR'.
+
+    Returns:
+        dict[str: int]: Two-letter codes, like {'SH': 1, 'RA': 1, 'BR': 1}.
+    """
+    return dict.fromkeys(WX_CODE_RE.findall(wx_string), 1)
+
+
+def _merge_rollup(rollup, other) -> None:
+    for name in SUM_FIELDS:
+        setattr(rollup, name, getattr(rollup, name) + getattr(other, name))
+    for name in MIN_FIELDS:
+        setattr(rollup, name, min(getattr(rollup, name), getattr(other, name)))
+    for name in MAX_FIELDS:
+        values = [value for value in (getattr(rollup, name), getattr(other, name)) if value is not None]
+        setattr(rollup, name, max(values) if values else None)
+
+
+def _add_counts(counts: dict[str: int], other: dict[str: int]) -> None:
+    for code, count in other.items():
+        counts[code] = counts.get(code, 0) + count
+
+
+def _local_midnight(day: date) -> datetime:
+    return timezone.make_aware(datetime.combine(day, datetime.min.time()))
@@ -0,0 +1,348 @@
+from __future__ import annotations
+import base64
+import bisect
+import heapq
+import re
+from datetime import datetime, timedelta
+from itertools import islice
+from operator import itemgetter
+from typing import Iterator, Optional, Union
+from django.db.models import Q
+from django.db.models.query import QuerySet
+from django.utils.dateparse import parse_datetime
+from ..models import Metar
+from . import archive_function
+
+ROW_CHUNK_SIZE = 2000
+# The first time window read backward by MetarRowSearch.read_before.
+PAGE_WINDOW = timedelta(days=1)
+
+
+def get_csv_field_names() -> list[str]:
+    """Get field names of Metar written to CSV files.
+
+    Returns:
+        list[str]: Concrete field names of Metar except the primary key and
+            Metar.CONDITION_FIELDS.
+    """
+    return [
+        field.name for field in Metar._meta.concrete_fields
+        if not field.primary_key and field.name not in Metar.CONDITION_FIELDS
+    ]
+
+
+def search_metar(stations: list[str], start_date: datetime, end_date: datetime) -> QuerySet:
+    """Get METARs of the stations observed between the two local days.
+
+    Both of start_date and end_date are included. They are expected to be
+    0:00 (local timezone) of the days, as the dates from MetarAppForm.
+
+    Args:
+        stations (list[str]): ICAO ids of the airports.
+        start_date (datetime): The first day of the search.
+        end_date (datetime): The last day of the search.
+
+    Returns:
+        QuerySet: Metar QuerySet ordered by observation_time.
+    """
+    metar_query = Metar.objects \
+        .filter(
+            station_id__in=stations,
+            observation_time__gte=start_date,
+            observation_time__lt=end_date + timedelta(days=1)
+        ) \
+        .order_by('observation_time', 'station_id')
+    return metar_query
+
+
+def search_metar_all(
+    stations: list[str],
+    start_date: datetime,
+    end_date: datetime
+) -> Union[QuerySet, MetarRowSearch]:
+    """Get METARs of the stations observed between the two local days,
+    including the archived months.
+
+    Args:
+        stations (list[str]): ICAO ids of the airports.
+        start_date (datetime): The first day of the search.
+        end_date (datetime): The last day of the search.
+
+    Returns:
+        Union[QuerySet, MetarRowSearch]: QuerySet from search_metar if no
+            month in the range is archived, otherwise MetarRowSearch of the
+            range.
+    """
+    end_time = end_date + timedelta(days=1)
+    if not archive_function.get_archived_months(stations, start_date, end_time):
+        return search_metar(stations, start_date, end_date)
+    return MetarRowSearch(stations, start_date, end_time)
+
+
+class MetarRowSearch():
+    """METARs of the stations in the time range, including the archived
+    months, read from iter_metar_rows.
+
+    Iterating it reads all METARs ordered by observation_time and
+    station_id. A page is read by read_after or read_before from the key
+    (observation_time, station_id), so only the rows around the page are
+    read. The Metar models have no id.
+
+    Attributes:
+        stations (list[str]): ICAO ids of the airports.
+        start_time (datetime): Start of the range (included).
+        end_time (datetime): End of the range (excluded).
+    """
+    def __init__(self, stations: list[str], start_time: datetime, end_time: datetime) -> None:
+        self.stations = stations
+        self.start_time = start_time
+        self.end_time = end_time
+        self.__field_names = get_csv_field_names()
+
+    def __iter__(self) -> Iterator[Metar]:
+        return self.__iter_metars(self.start_time, self.end_time)
+
+    def read_after(self, key: Optional[tuple[datetime, str]], count: int) -> list[Metar]:
+        """Read METARs after the key in ascending order.
+
+        Args:
+            key (Optional[tuple[datetime, str]]): Key of the last METAR of
+                the previous page (excluded). None reads from the start.
+            count (int): The maximum number of METARs.
+
+        Returns:
+            list[Metar]: Metar models in ascending order.
+        """
+        start_time = self.start_time if key is None else max(self.start_time, key[0])
+        metars = self.__iter_metars(start_time, self.end_time)
+        if key is not None:
+            metars = (metar for metar in metars if (metar.observation_time, metar.station_id) > key)
+        return list(islice(metars, count))
+
+    def read_before(self, key: Optional[tuple[datetime, str]], count: int) -> list[Metar]:
+        """Read METARs before the key in descending order.
+
+        The rows are read by time windows going back from the key, and a
+        window is twice as long as the previous one, starting from
+        PAGE_WINDOW.
+
+        Args:
+            key (Optional[tuple[datetime, str]]): Key of the first METAR of
+                the next page (excluded). None reads from the end.
+            count (int): The maximum number of METARs.
+
+        Returns:
+            list[Metar]: Metar models in descending order.
+        """
+        end_time = self.end_time if key is None else min(self.end_time, key[0] + timedelta(microseconds=1))
+        window = PAGE_WINDOW
+        metar_list = []
+        while end_time > self.start_time and len(metar_list) < count:
+            window_start = max(end_time - window, self.start_time)
+            metars = list(self.__iter_metars(window_start, end_time))
+            if key is not None:
+                metars = [metar for metar in metars if (metar.observation_time, metar.station_id) < key]
+            metar_list.extend(reversed(metars))
+            end_time = window_start
+            window *= 2
+        return metar_list[:count]
+
+    def __iter_metars(self, start_time: datetime, end_time: datetime) -> Iterator[Metar]:
+        for row in iter_metar_rows(self.stations, start_time, end_time, self.__field_names):
+            yield Metar(**dict(zip(self.__field_names, row)))
+
+
+def iter_metar_rows(
+    stations: list[str],
+    start_time: datetime,
+    end_time: datetime,
+    field_names: list[str],
+    by_station: bool = False
+) -> Iterator[tuple]:
+    """Read rows of the fields from Metar and the archive in the time range.
+
+    The rows of Metar are read with a server-side cursor and merged with the
+    archived rows in order. A row in both of them is read once.
+
+    Args:
+        stations (list[str]): ICAO ids of the airports.
+        start_time (datetime): Start of the range (included).
+        end_time (datetime): End of the range (excluded).
+        field_names (list[str]): Fields of Metar except 'id', including
+            'station_id' and 'observation_time'.
+        by_station (bool, optional): Order by station and observation_time
+            if True, otherwise observation_time and station. Defaults to
+            False.
+
+    Returns:
+        Iterator[tuple]: Rows of the fields.
+    """
+    order = ('station_id', 'observation_time') if by_station else ('observation_time', 'station_id')
+    stored_rows = Metar.objects \
+        .filter(
+            station_id__in=stations,
+            observation_time__gte=start_time,
+            observation_time__lt=end_time
+        ) \
+        .order_by(*order) \
+        .values_list(*field_names) \
+        .iterator(chunk_size=ROW_CHUNK_SIZE)
+    archived_months = archive_function.get_archived_months(stations, start_time, end_time)
+    if not archived_months:
+        return stored_rows
+    archived_rows = archive_function.iter_archive_rows(archived_months, start_time, end_time, field_names, by_station)
+    key = itemgetter(*(field_names.index(name) for name in order))
+    return _unique_rows(heapq.merge(stored_rows, archived_rows, key=key), key)
+
+
+def search_metar_range(
+    stations: list[str],
+    start_time: datetime,
+    end_time: datetime,
+    after: Optional[tuple[datetime, int]] = None
+) -> QuerySet:
+    """Get METARs of the stations observed in the time range, for keyset
+    pagination.
+
+    The METARs are ordered by (observation_time, id), and the ones after the
+    key 'after' are returned, so a page does not need OFFSET.
+
+    Args:
+        stations (list[str]): ICAO ids of the airports.
+        start_time (datetime): Start of the range (included).
+        end_time (datetime): End of the range (excluded).
+        after (Optional[tuple[datetime, int]]): observation_time and id of
+            the last METAR of the previous page.
+
+    Returns:
+        QuerySet: Metar QuerySet ordered by observation_time and id.
+    """
+    metar_query = Metar.objects \
+        .filter(
+            station_id__in=stations,
+            observation_time__gte=start_time,
+            observation_time__lt=end_time
+        )
+    if after is not None:
+        after_time, after_id = after
+        metar_query = metar_query.filter(
+            Q(observation_time__gt=after_time) | Q(observation_time=after_time, id__gt=after_id)
+        )
+    return metar_query.order_by('observation_time', 'id')
+
+
+def encode_cursor(observation_time: datetime, id: int) -> str:
+    """Encode the key of a METAR to the cursor of the next page.
+    """
+    text = '%s|%d' % (observation_time.isoformat(), id)
+    return base64.urlsafe_b64encode(text.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """Decode the cursor from encode_cursor.
+
+    Raises:
+        ValueError: If the cursor is broken.
+    """
+    observation_time, id_text = _decode_cursor_text(cursor)
+    if not id_text.isdigit():
+        raise ValueError('Invalid cursor: %s' % cursor)
+    return observation_time, int(id_text)
+
+
+def get_metar_page(
+    metars: Union[QuerySet, MetarRowSearch, list[Metar]],
+    page_size: int,
+    key: Optional[tuple[datetime, str]] = None,
+    descending: bool = False,
+    backward: bool = False
+) -> tuple[list[Metar], bool]:
+    """Get a page of METARs next to the key by keyset pagination.
+
+    The key is (observation_time, station_id), which is unique by the
+    'unique_metar' constraint, so the archived METARs without id can be
+    paged too. A QuerySet and MetarRowSearch read only the rows of the
+    page, and a list from the cache is searched by bisection.
+
+    Args:
+        metars (Union[QuerySet, MetarRowSearch, list[Metar]]): METARs
+            ordered by observation_time and station_id, from
+            search_metar_all or the cache.
+        page_size (int): The number of METARs in a page.
+        key (Optional[tuple[datetime, str]], optional): Key of the last
+            METAR of the previous page, or the first METAR of the next page
+            if 'backward'. Defaults to None (the first page).
+        descending (bool, optional): Pages are in descending order of the
+            key. Defaults to False.
+        backward (bool, optional): Read the page before the key. Defaults to
+            False.
+
+    Returns:
+        tuple[list[Metar], bool]: The page in the display order, and whether
+            more METARs are beyond the page in the direction of reading.
+    """
+    reverse = descending != backward
+    if isinstance(metars, QuerySet):
+        if key is not None:
+            lookup = 'lt' if reverse else 'gt'
+            metars = metars.filter(
+                Q(**{'observation_time__' + lookup: key[0]}) |
+                Q(observation_time=key[0], **{'station_id__' + lookup: key[1]})
+            )
+        order = ('-observation_time', '-station_id') if reverse else ('observation_time', 'station_id')
+        page = list(metars.order_by(*order)[:page_size + 1])
+    elif isinstance(metars, MetarRowSearch):
+        page = metars.read_before(key, page_size + 1) if reverse else metars.read_after(key, page_size + 1)
+    else:
+        keys = [(metar.observation_time, metar.station_id) for metar in metars]
+        if reverse:
+            end = len(keys) if key is None else bisect.bisect_left(keys, key)
+            page = metars[max(end - page_size - 1, 0):end][::-1]
+        else:
+            start = 0 if key is None else bisect.bisect_right(keys, key)
+            page = metars[start:start + page_size + 1]
+    has_more = len(page) > page_size
+    page = page[:page_size]
+    if backward:
+        page.reverse()
+    return page, has_more
+
+
+def encode_page_cursor(metar: Metar) -> str:
+    """Encode the key of a METAR to the cursor of get_metar_page.
+    """
+    text = '%s|%s' % (metar.observation_time.isoformat(), metar.station_id)
+    return base64.urlsafe_b64encode(text.encode()).decode().rstrip('=')
+
+
+def decode_page_cursor(cursor: str) -> tuple[datetime, str]:
+    """Decode the cursor from encode_page_cursor.
+
+    Raises:
+        ValueError: If the cursor is broken.
+    """
+    observation_time, station_id = _decode_cursor_text(cursor)
+    if not re.fullmatch(Metar.STATION_ID_RE, station_id):
+        raise ValueError('Invalid cursor: %s' % cursor)
+    return observation_time, station_id
+
+
+def _decode_cursor_text(cursor: str) -> tuple[datetime, str]:
+    try:
+        text = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        time_text, key_text = text.split('|')
+        observation_time = parse_datetime(time_text)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError('Invalid cursor: %s' % cursor) from e
+    if observation_time is None or observation_time.tzinfo is None:
+        raise ValueError('Invalid cursor: %s' % cursor)
+    return observation_time, key_text
+
+
+def _unique_rows(rows: Iterator[tuple], key) -> Iterator[tuple]:
+    previous_key = None
+    for row in rows:
+        row_key = key(row)
+        if row_key != previous_key:
+            yield row
+        previous_key = row_key
@@ -0,0 +1,289 @@
+from __future__ import annotations
+import asyncio
+import json
+import logging
+import weakref
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.db.models import Max
+from typing import Iterable, Optional
+from ..models import Metar
+from . import search_function
+
+logger = logging.getLogger(__name__)
+# NOTIFY payloads must be shorter than 8000 bytes.
+MAX_PAYLOAD_LENGTH = 7000
+# The maximum number of the rows read at once by polling.
+ROW_LIMIT = 1000
+
+
+class Subscription():
+    """Queue of the new METARs of the stations for a subscriber.
+
+    If the subscriber is too slow and the queue is full, 'overflowed' is
+    set and the subscriber should reconnect with the last event id.
+
+    Attributes:
+        stations (frozenset[str]): ICAO ids of the subscribed stations.
+        overflowed (bool): True if a METAR could not be queued.
+    """
+    def __init__(self, stations: Iterable[str], queue_size: int) -> None:
+        self.stations = frozenset(stations)
+        self.overflowed = False
+        self.__queue: asyncio.Queue = asyncio.Queue(queue_size)
+
+    def put(self, row: dict) -> None:
+        try:
+            self.__queue.put_nowait(row)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def get(self) -> dict:
+        return await self.__queue.get()
+
+
+class MetarBroker():
+    """In-process fan-out of new METARs to the subscriptions of an event loop.
+
+    New METARs are read by a feeder task, from LISTEN on PostgreSQL (sent by
+    notify_metars) or by polling new ids on the other databases or if the
+    listening connection fails. The feeder starts with the first
+    subscription and stops after the last one is removed. The subscriptions
+    are only queues, so idle subscribers do not need threads.
+
+    Attributes:
+        queue_size (int): The maximum number of queued METARs of a
+            subscription.
+        poll_seconds (float): Interval of the polling.
+    """
+    def __init__(self, queue_size: int = 100, poll_seconds: float = 5.0) -> None:
+        self.queue_size = queue_size
+        self.poll_seconds = poll_seconds
+        self.__subscriptions: dict[str: set[Subscription]] = {}
+        self.__feeder: Optional[asyncio.Task] = None
+
+    @property
+    def stations(self) -> list[str]:
+        return list(self.__subscriptions)
+
+    @property
+    def feeding(self) -> bool:
+        return self.__feeder is not None and not self.__feeder.done()
+
+    @property
+    def subscriber_count(self) -> int:
+        return len({subscription for subscriptions in self.__subscriptions.values() for subscription in subscriptions})
+
+    def subscribe(self, stations: Iterable[str]) -> Subscription:
+        """Add a subscription of the stations. Called in the event loop.
+        """
+        subscription = Subscription(stations, self.queue_size)
+        for station_id in subscription.stations:
+            self.__subscriptions.setdefault(station_id, set()).add(subscription)
+        if self.__feeder is None or self.__feeder.done():
+            self.__feeder = asyncio.get_running_loop().create_task(self.__feed())
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        for station_id in subscription.stations:
+            subscriptions = self.__subscriptions.get(station_id)
+            if subscriptions is None:
+                continue
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.__subscriptions[station_id]
+        if not self.__subscriptions:
+            self.close()
+
+    def publish(self, rows: Iterable[dict]) -> int:
+        """Put the METAR rows to the subscriptions of their stations.
+
+        Returns:
+            int: The number of the queued rows.
+        """
+        count = 0
+        for row in rows:
+            for subscription in self.__subscriptions.get(row['station_id'], ()):
+                subscription.put(row)
+                count += 1
+        return count
+
+    def close(self) -> None:
+        """Stop the feeder task.
+        """
+        if self.__feeder is not None:
+            self.__feeder.cancel()
+            self.__feeder = None
+
+    async def __feed(self) -> None:
+        if connection.vendor == 'postgresql':
+            try:
+                await self.__listen()
+            except Exception:
+                logger.exception('Listening to new METARs failed, polling instead')
+        await self.__poll()
+
+    async def __listen(self) -> None:
+        """Read the keys from the notifications and publish the rows.
+        """
+        listener = await sync_to_async(_connect_listener)()
+        loop = asyncio.get_running_loop()
+        readable = asyncio.Event()
+        loop.add_reader(listener.fileno(), readable.set)
+        try:
+            while True:
+                await readable.wait()
+                readable.clear()
+                listener.poll()
+                keys = []
+                while listener.notifies:
+                    keys.extend(json.loads(listener.notifies.pop(0).payload))
+                stations = set(self.stations)
+                keys = [key for key in keys if key[0] in stations]
+                if keys:
+                    self.publish(await sync_to_async(load_rows)(keys))
+        finally:
+            loop.remove_reader(listener.fileno())
+            listener.close()
+
+    async def __poll(self) -> None:
+        """Read the rows with new ids and publish them. Corrections updating
+        the stored rows are not read.
+        """
+        last_id = None
+        while True:
+            try:
+                rows, last_id = await sync_to_async(load_new_rows)(self.stations, last_id)
+                self.publish(rows)
+            except Exception:
+                logger.exception('Polling new METARs failed')
+            await asyncio.sleep(self.poll_seconds)
+
+
+_brokers: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop: MetarBroker] = weakref.WeakKeyDictionary()
+
+
+def get_broker() -> MetarBroker:
+    """Get the broker of the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    broker = _brokers.get(loop)
+    if broker is None:
+        broker = MetarBroker(
+            getattr(settings, 'METAR_STREAM_QUEUE_SIZE', 100),
+            getattr(settings, 'METAR_STREAM_POLL_SECONDS', 5.0)
+        )
+        _brokers[loop] = broker
+    return broker
+
+
+def notify_metars(metars: list[Metar]) -> None:
+    """Send the keys of the written METARs to the listening brokers with
+    NOTIFY, delivered when the transaction is committed. Only on PostgreSQL.
+
+    Args:
+        metars (list[Metar]): Inserted or updated Metar models.
+    """
+    if connection.vendor != 'postgresql' or not metars:
+        return
+    channel = _get_channel()
+    payloads = []
+    keys = []
+    length = 2
+    for metar in metars:
+        key = [metar.station_id, metar.observation_time.isoformat()]
+        key_length = len(json.dumps(key)) + 1
+        if keys and length + key_length > MAX_PAYLOAD_LENGTH:
+            payloads.append(json.dumps(keys))
+            keys = []
+            length = 2
+        keys.append(key)
+        length += key_length
+    payloads.append(json.dumps(keys))
+    with connection.cursor() as cursor:
+        for payload in payloads:
+            cursor.execute('SELECT pg_notify(%s, %s)', [channel, payload])
+
+
+def load_rows(keys: list[list[str]]) -> list[dict]:
+    """Read the rows of the keys, [station_id, ISO observation_time].
+    """
+    key_set = {(station_id, time) for station_id, time in keys}
+    metar_query = Metar.objects \
+        .filter(
+            station_id__in={station_id for station_id, _ in key_set},
+            observation_time__in={time for _, time in key_set}
+        ) \
+        .order_by('observation_time', 'station_id') \
+        .values('id', *search_function.get_csv_field_names())
+    return [row for row in metar_query if (row['station_id'], row['observation_time'].isoformat()) in key_set]
+
+
+def load_new_rows(
+    stations: list[str], last_id: Optional[int], limit: int = ROW_LIMIT
+) -> tuple[list[dict], Optional[int]]:
+    """Read the rows of the stations with ids larger than last_id.
+
+    At most 'limit' rows are read. If there are more, the returned id is
+    that of the last read row, so the next call reads the rest.
+
+    Args:
+        stations (list[str]): ICAO ids of the stations.
+        last_id (Optional[int]): The id returned last time. None for the
+            first time, when no row is read.
+        limit (int, optional): The maximum number of the rows. Defaults to
+            ROW_LIMIT.
+
+    Returns:
+        tuple[list[dict], Optional[int]]: The rows and the id to be given
+            as last_id next time.
+    """
+    newest_id = Metar.objects.aggregate(newest=Max('id'))['newest']
+    if last_id is None or newest_id is None or newest_id <= last_id or not stations:
+        return [], newest_id if newest_id is not None else last_id
+    rows = load_rows_after(stations, last_id, newest_id, limit)
+    if len(rows) >= limit:
+        return rows, rows[-1]['id']
+    return rows, newest_id
+
+
+def load_rows_after(
+    stations: list[str], after_id: int, until_id: Optional[int] = None, limit: int = ROW_LIMIT
+) -> list[dict]:
+    """Read the rows of the stations with ids after 'after_id', for polling
+    and replaying the events after Last-Event-ID.
+    """
+    metar_query = Metar.objects \
+        .filter(
+            station_id__in=stations,
+            id__gt=after_id
+        )
+    if until_id is not None:
+        metar_query = metar_query.filter(id__lte=until_id)
+    return list(metar_query.order_by('id').values('id', *search_function.get_csv_field_names())[:limit])
+
+
+def format_event(row: dict) -> bytes:
+    """Format the row as a 'metar' event of Server-Sent Events.
+    """
+    event_type = 'speci' if row.get('metar_type') == Metar.SPECI else 'metar'
+    data = json.dumps(row, cls=DjangoJSONEncoder, separators=(',', ':'))
+    return ('event: %s\nid: %s\ndata: %s\n\n' % (event_type, row['id'], data)).encode()
+
+
+def _connect_listener():
+    """Open a psycopg2 connection listening to the channel, separated from
+    the connections of Django.
+    """
+    import psycopg2
+    listener = psycopg2.connect(**connection.get_connection_params())
+    listener.set_session(autocommit=True)
+    with listener.cursor() as cursor:
+        cursor.execute('LISTEN %s' % _get_channel())
+    return listener
+
+
+def _get_channel() -> str:
+    return getattr(settings, 'METAR_STREAM_CHANNEL', 'metar_inserted')
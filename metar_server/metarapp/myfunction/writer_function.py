@@ -0,0 +1,265 @@
+from __future__ import annotations
+import csv
+import io
+import re
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.utils.module_loading import import_string
+from typing import Optional
+from ..models import Metar
+from . import condition_function
+
+METAR_TABLE = Metar._meta.db_table
+STAGING_TABLE = 'metar_staging'
+COPY_NULL = r'\N'
+# Policies for a METAR whose (station_id, observation_time) is stored.
+# 'keep': the stored row is kept.
+# 'correction': a corrected report (COR) replaces the stored row.
+# 'replace': any different report replaces the stored row.
+KEEP = 'keep'
+CORRECTION = 'correction'
+REPLACE = 'replace'
+CORRECTION_POLICIES = (KEEP, CORRECTION, REPLACE)
+CORRECTION_RE = re.compile(r'(?:^|\s)COR(?:\s|$)')
+# The same pattern in PostgreSQL regular expressions.
+CORRECTION_SQL_RE = r'(^|\s)COR(\s|$)'
+
+
+class WriteResult():
+    """Rows written by a writer.
+
+    Attributes:
+        inserted (list[Metar]): Metar models inserted as new rows.
+        updated (list[Metar]): Metar models which replaced stored rows.
+    """
+    def __init__(self, inserted: list[Metar] = None, updated: list[Metar] = None) -> None:
+        self.inserted = inserted or []
+        self.updated = updated or []
+
+    @property
+    def written(self) -> list[Metar]:
+        return self.inserted + self.updated
+
+
+class MetarWriter():
+    """Base class of the writers of Metar.
+
+    A writer inserts new rows and resolves the rows colliding with the
+    'unique_metar' constraint by 'policy', without failing the batch. The
+    class is selected by METAR_WRITER in settings (see get_writer).
+
+    Attributes:
+        policy (str): One of CORRECTION_POLICIES.
+    """
+    def __init__(self, policy: Optional[str] = None) -> None:
+        self.policy = policy or get_correction_policy()
+        if self.policy not in CORRECTION_POLICIES:
+            raise ImproperlyConfigured('Unknown correction policy: %s' % self.policy)
+
+    def write(self, metars: list[Metar]) -> WriteResult:
+        """Write the METARs.
+
+        Args:
+            metars (list[Metar]): Metar models to be written.
+
+        Returns:
+            WriteResult: The inserted and the updated models.
+        """
+        raise NotImplementedError
+
+
+class BulkCreateWriter(MetarWriter):
+    """Writer for any database with bulk_create(ignore_conflicts=True).
+
+    The stored keys in the range of the batch are searched first, so the
+    new rows are known without RETURNING. The replaced rows are updated
+    with bulk_update.
+    """
+    batch_size = 500
+
+    def write(self, metars: list[Metar]) -> WriteResult:
+        metars = unique_metars(metars, self.policy)
+        if not metars:
+            return WriteResult()
+        condition_function.set_conditions(metars)
+        observation_list = [metar.observation_time for metar in metars]
+        stored_query = Metar.objects \
+            .filter(
+                station_id__in={metar.station_id for metar in metars},
+                observation_time__range=(min(observation_list), max(observation_list))
+            ) \
+            .values_list('station_id', 'observation_time', 'id', 'raw_text')
+        stored_dict = {(station_id, time): (id, raw_text) for station_id, time, id, raw_text in stored_query}
+        inserted = []
+        updated = []
+        for metar in metars:
+            stored = stored_dict.get((metar.station_id, metar.observation_time))
+            if stored is None:
+                inserted.append(metar)
+            elif replaces(self.policy, stored[1], metar.raw_text):
+                metar.id = stored[0]
+                updated.append(metar)
+        with transaction.atomic():
+            Metar.objects.bulk_create(inserted, self.batch_size, ignore_conflicts=True)
+            Metar.objects.bulk_update(updated, get_update_fields(), self.batch_size)
+        return WriteResult(inserted, updated)
+
+
+class CopyWriter(MetarWriter):
+    """Writer for PostgreSQL streaming the rows with COPY.
+
+    The rows are copied to a temporary staging table and merged with
+    INSERT ... ON CONFLICT (station_id, observation_time), DO NOTHING for
+    'keep' and DO UPDATE with the condition of the policy for the others.
+    """
+    def write(self, metars: list[Metar]) -> WriteResult:
+        metars = unique_metars(metars, self.policy)
+        if not metars:
+            return WriteResult()
+        condition_function.set_conditions(metars)
+        columns = ', '.join(get_insert_fields())
+        if self.policy == KEEP:
+            conflict = 'DO NOTHING'
+        else:
+            conflict = 'DO UPDATE SET %s WHERE %s.raw_text <> EXCLUDED.raw_text' % (
+                ', '.join('%s = EXCLUDED.%s' % (column, column) for column in get_insert_fields()),
+                METAR_TABLE
+            )
+            if self.policy == CORRECTION:
+                # COR in the remarks is ignored as in is_correction.
+                conflict += " AND split_part(EXCLUDED.raw_text, ' RMK ', 1) ~ '%s'" % CORRECTION_SQL_RE
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE TEMPORARY TABLE IF NOT EXISTS %s AS SELECT %s FROM %s WITH NO DATA'
+                % (STAGING_TABLE, columns, METAR_TABLE)
+            )
+            cursor.execute('TRUNCATE %s' % STAGING_TABLE)
+            cursor.copy_expert(
+                "COPY %s (%s) FROM STDIN WITH (FORMAT csv, NULL '%s')" % (STAGING_TABLE, columns, COPY_NULL),
+                _to_csv(metars)
+            )
+            # xmax is 0 for the inserted rows and not 0 for the updated rows.
+            cursor.execute(
+                'INSERT INTO %s (%s) SELECT %s FROM %s '
+                'ON CONFLICT (station_id, observation_time) %s '
+                'RETURNING station_id, observation_time, xmax = 0'
+                % (METAR_TABLE, columns, columns, STAGING_TABLE, conflict)
+            )
+            written_dict = {(station_id, time): inserted for station_id, time, inserted in cursor.fetchall()}
+        result = WriteResult()
+        for metar in metars:
+            inserted = written_dict.get((metar.station_id, metar.observation_time))
+            if inserted is True:
+                result.inserted.append(metar)
+            elif inserted is False:
+                result.updated.append(metar)
+        return result
+
+
+def get_writer(policy: Optional[str] = None) -> MetarWriter:
+    """Get the writer of METAR_WRITER in settings, the dotted path of a
+    MetarWriter class. If it is not set, CopyWriter is used on PostgreSQL
+    and BulkCreateWriter on the others.
+
+    Args:
+        policy (Optional[str], optional): Correction policy. Defaults to
+            None (METAR_CORRECTION_POLICY in settings).
+
+    Returns:
+        MetarWriter: The writer.
+    """
+    path = getattr(settings, 'METAR_WRITER', None)
+    if path:
+        writer_class = import_string(path)
+    elif connection.vendor == 'postgresql':
+        writer_class = CopyWriter
+    else:
+        writer_class = BulkCreateWriter
+    return writer_class(policy)
+
+
+def get_correction_policy() -> str:
+    """Get METAR_CORRECTION_POLICY in settings, 'correction' by default.
+    """
+    return getattr(settings, 'METAR_CORRECTION_POLICY', CORRECTION)
+
+
+def is_correction(raw_text: str) -> bool:
+    """Check whether the report is a correction (COR).
+    """
+    return CORRECTION_RE.search(raw_text.split(' RMK ')[0]) is not None
+
+
+def replaces(policy: str, stored_raw_text: str, raw_text: str) -> bool:
+    """Check whether the report replaces the stored report of the same
+    station and observation time by the policy.
+    """
+    if raw_text == stored_raw_text or policy == KEEP:
+        return False
+    return policy == REPLACE or is_correction(raw_text)
+
+
+def unique_metars(metars: list[Metar], policy: str) -> list[Metar]:
+    """Remove the METARs with the same key in the batch, keeping the first
+    one unless a later one replaces it by the policy.
+    """
+    unique_dict: dict[tuple: Metar] = {}
+    for metar in metars:
+        key = (metar.station_id, metar.observation_time)
+        kept = unique_dict.get(key)
+        if kept is None or replaces(policy, kept.raw_text, metar.raw_text):
+            unique_dict[key] = metar
+    return list(unique_dict.values())
+
+
+def get_insert_fields() -> list[str]:
+    """Get column names of Metar written by the writer.
+
+    Returns:
+        list[str]: Concrete column names of Metar except the primary key.
+    """
+    return [field.column for field in Metar._meta.concrete_fields if not field.primary_key]
+
+
+def get_update_fields() -> list[str]:
+    """Get field names of Metar replaced by a corrected report.
+    """
+    return [
+        field.name for field in Metar._meta.concrete_fields
+        if not field.primary_key and field.name not in ('station_id', 'observation_time')
+    ]
+
+
+def insert_metars(metars: list[Metar]) -> list[Metar]:
+    """Insert the METARs skipping the rows already stored.
+
+    Args:
+        metars (list[Metar]): Metar models to be inserted.
+
+    Returns:
+        list[Metar]: Metar models which were inserted.
+    """
+    return get_writer(KEEP).write(metars).inserted
+
+
+def _to_csv(metars: list[Metar]) -> io.StringIO:
+    """Write the METARs in CSV for COPY.
+
+    Args:
+        metars (list[Metar]): Metar models to be written.
+
+    Returns:
+        io.StringIO: CSV data at the head.
+    """
+    fields = [field for field in Metar._meta.concrete_fields if not field.primary_key]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for metar in metars:
+        row = []
+        for field in fields:
+            value = field.get_db_prep_save(field.pre_save(metar, True), connection)
+            row.append(COPY_NULL if value is None else value)
+        writer.writerow(row)
+    buffer.seek(0)
+    return buffer
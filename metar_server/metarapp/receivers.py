@@ -0,0 +1,36 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .models import Airport, Metar
+from .myfunction import airport_function, cache_function, latest_function, rollup_function, stream_function
+from .signals import metars_inserted
+
+
+@receiver(metars_inserted, sender=Metar)
+def update_station_status(sender, metars, **kwargs):
+    airport_function.update_station_status(metars)
+
+
+@receiver(metars_inserted, sender=Metar)
+def invalidate_cache(sender, metars, **kwargs):
+    cache_function.invalidate_metars(metars)
+
+
+@receiver(metars_inserted, sender=Metar)
+def update_rollups(sender, metars, **kwargs):
+    rollup_function.update_rollups(metars)
+
+
+@receiver(metars_inserted, sender=Metar)
+def update_latest_store(sender, metars, **kwargs):
+    latest_function.update_store(metars)
+
+
+@receiver(metars_inserted, sender=Metar)
+def notify_stream(sender, metars, **kwargs):
+    stream_function.notify_metars(metars)
+
+
+@receiver(post_save, sender=Airport)
+@receiver(post_delete, sender=Airport)
+def invalidate_airport_registry(sender, **kwargs):
+    airport_function.invalidate_registry()
@@ -0,0 +1,4 @@
+from django.dispatch import Signal
+
+# Sent with 'metars' (list[Metar]) after the METARs are saved to database.
+metars_inserted = Signal()
@@ -0,0 +1,193 @@
+from __future__ import annotations
+import asyncio
+import re
+from datetime import datetime
+from http.cookies import SimpleCookie
+from importlib import import_module
+from types import SimpleNamespace
+from typing import Awaitable, Callable, Iterable, Optional
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import auth
+from .models import Metar
+from .myfunction import stream_function
+
+STREAM_PATH = '/metarapp/stream/'
+STATION_SEPARATOR_RE = r'[\s,]+'
+MAX_STREAM_STATIONS = 100
+
+
+class MetarStreamApp():
+    """ASGI application pushing the new METARs of the stations as
+    Server-Sent Events, e.g. GET /metarapp/stream/?stations=RJTT,RJAA.
+
+    The client should be logged in with the session of Django. Each
+    METAR is sent as an event 'metar' or 'speci' with the row as JSON data
+    and the Metar id as the event id. If 'Last-Event-ID' is given by the
+    reconnecting client, all METARs of the stations with larger ids are sent
+    first, by pages, and the same METARs received live during the replay
+    are not sent again. A comment is sent every METAR_STREAM_HEARTBEAT_SECONDS
+    to keep the connection. The connection is closed if the client is too
+    slow to receive the METARs.
+    """
+    def __init__(self) -> None:
+        self.heartbeat_seconds = getattr(settings, 'METAR_STREAM_HEARTBEAT_SECONDS', 15.0)
+
+    async def __call__(self, scope: dict, receive: Callable[[], Awaitable[dict]], send: Callable[[dict], Awaitable]):
+        if scope['method'] != 'GET':
+            await self.__send_error(send, 405, 'Method not allowed')
+            return
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        if not await sync_to_async(self.__is_authenticated)(headers.get('cookie', '')):
+            await self.__send_error(send, 401, 'Login required')
+            return
+        stations = self.__get_stations(scope['query_string'].decode('latin-1'))
+        if not stations:
+            await self.__send_error(send, 400, 'Give 1 to %d ICAO ids by stations' % MAX_STREAM_STATIONS)
+            return
+        last_event_id = headers.get('last-event-id', '')
+
+        broker = stream_function.get_broker()
+        subscription = broker.subscribe(stations)
+        disconnected = asyncio.ensure_future(self.__wait_disconnect(receive))
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [
+                    (b'content-type', b'text/event-stream'),
+                    (b'cache-control', b'no-cache'),
+                    (b'x-accel-buffering', b'no')
+                ]
+            })
+            await send({'type': 'http.response.body', 'body': b'retry: 5000\n\n', 'more_body': True})
+            replayed = {}
+            if last_event_id.isdigit():
+                replayed = await self.__replay(send, stations, int(last_event_id), disconnected)
+            while not disconnected.done() and not subscription.overflowed:
+                received = asyncio.ensure_future(subscription.get())
+                await asyncio.wait({received, disconnected}, timeout=self.heartbeat_seconds,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if received.done():
+                    row = received.result()
+                    # Corrections of the replayed METARs have other raw texts.
+                    if replayed.pop((row['station_id'], row['observation_time']), None) == row['raw_text']:
+                        continue
+                    body = stream_function.format_event(row)
+                else:
+                    received.cancel()
+                    if disconnected.done():
+                        break
+                    body = b': keepalive\n\n'
+                await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+            if not disconnected.done():
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            broker.unsubscribe(subscription)
+            disconnected.cancel()
+
+    async def send_not_found(self, send: Callable[[dict], Awaitable]) -> None:
+        await self.__send_error(send, 404, 'Not found')
+
+    async def __wait_disconnect(self, receive: Callable[[], Awaitable[dict]]) -> None:
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    async def __send_error(self, send: Callable[[dict], Awaitable], status: int, message: str) -> None:
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'text/plain; charset=utf-8')]
+        })
+        await send({'type': 'http.response.body', 'body': message.encode()})
+
+    def __get_stations(self, query_string: str) -> Optional[list[str]]:
+        text = ','.join(parse_qs(query_string).get('stations', []))
+        stations = sorted({icao for icao in re.split(STATION_SEPARATOR_RE, text.upper()) if icao})
+        if not stations or len(stations) > MAX_STREAM_STATIONS:
+            return None
+        if not all(re.fullmatch(Metar.STATION_ID_RE, icao) for icao in stations):
+            return None
+        return stations
+
+    def __is_authenticated(self, cookie_text: str) -> bool:
+        cookie = SimpleCookie()
+        cookie.load(cookie_text)
+        morsel = cookie.get(settings.SESSION_COOKIE_NAME)
+        if morsel is None:
+            return False
+        session = import_module(settings.SESSION_ENGINE).SessionStore(morsel.value)
+        user = auth.get_user(SimpleNamespace(session=session))
+        return user.is_authenticated and user.is_active
+
+    async def __replay(
+        self,
+        send: Callable[[dict], Awaitable],
+        stations: list[str],
+        after_id: int,
+        disconnected: asyncio.Future
+    ) -> dict[tuple[str, datetime]: str]:
+        """Send the METARs of the stations with ids after 'after_id', by
+        pages of METAR_STREAM_QUEUE_SIZE until all of them are sent.
+
+        Returns:
+            dict[tuple[str, datetime]: str]: Raw texts of the sent METARs
+                by station_id and observation_time.
+        """
+        page_size = getattr(settings, 'METAR_STREAM_QUEUE_SIZE', 100)
+        replayed = {}
+        while not disconnected.done():
+            rows = await sync_to_async(stream_function.load_rows_after)(stations, after_id, limit=page_size)
+            for row in rows:
+                replayed[(row['station_id'], row['observation_time'])] = row['raw_text']
+            if rows:
+                await send({
+                    'type': 'http.response.body',
+                    'body': b''.join(stream_function.format_event(row) for row in rows),
+                    'more_body': True
+                })
+            if len(rows) < page_size:
+                break
+            after_id = rows[-1]['id']
+        return replayed
+
+
+def route(django_application: Optional[Callable] = None) -> Callable:
+    """Get the ASGI application serving STREAM_PATH with MetarStreamApp.
+
+    The other HTTP requests are passed to django_application, or answered
+    with 404 if it is None. The views of Django 3.2 should be served by WSGI
+    through a WSGI middleware of the ASGI server, because its ASGI handler
+    iterates StreamingHttpResponse in the event loop, where the queries of
+    the CSV and NDJSON responses fail. The other scopes, like lifespan, are
+    not supported.
+    """
+    stream_application = MetarStreamApp()
+
+    async def application(scope: dict, receive: Callable[[], Awaitable[dict]], send: Callable[[dict], Awaitable]):
+        if scope['type'] != 'http':
+            return
+        if scope['path'] == STREAM_PATH:
+            await stream_application(scope, receive, send)
+        elif django_application is not None:
+            await django_application(scope, receive, send)
+        else:
+            await stream_application.send_not_found(send)
+    return application
+
+
+def close_response(wsgi_application: Callable) -> Callable:
+    """Wrap the WSGI application to close its responses after they are
+    iterated, because the WSGI middleware of uvicorn does not. Django sends
+    request_finished and closes the database connections when the response
+    is closed.
+    """
+    def application(environ: dict, start_response: Callable) -> Iterable[bytes]:
+        response = wsgi_application(environ, start_response)
+        try:
+            yield from response
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+    return application
@@ -0,0 +1,35 @@
+from __future__ import annotations
+import time
+from django.template.backends.django import DjangoTemplates
+from .myfunction import metrics_function
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """Django template backend adding the render time to the record of the
+    request (MetricsMiddleware).
+    """
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
+
+
+class TimedTemplate():
+    """Wrapper of the template of the backend timing render().
+    """
+    def __init__(self, template) -> None:
+        self.template = template
+
+    @property
+    def origin(self):
+        return self.template.origin
+
+    def render(self, context=None, request=None) -> str:
+        start = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            record = metrics_function.get_record()
+            if record is not None:
+                record.template_time += time.perf_counter() - start
@@ -1,3 +1,1450 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+from datetime import date, datetime, timedelta
+from importlib import import_module
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+from asgiref.sync import async_to_sync
+from defusedxml import DTDForbidden, ElementTree
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test import Client, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from .models import Airport, ArchivedMonth, FetchJob, Metar, MetarDailyRollup, MetarHourlyRollup, StationStatus
+from .myfunction import (
+    airport_function, analytics_function, archive_function, backfill_function, benchmark_function, cache_function,
+    chart_function, condition_function, decode_function, ingest_function, job_function, latest_function,
+    metar_function, metrics_function, partition_function, pipeline_function, rollup_function, search_function,
+    stream_function, writer_function
+)
+from . import streaming
+from .signals import metars_inserted
+from .views import CSV_DERIVED_FIELDS
 
-# Create your tests here.
+METAR_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<response>
+  <data num_results="{num}">
+{metars}
+  </data>
+</response>'''
+
+METAR_ELEMENT = '''    <METAR>
+      <raw_text>{station_id} {day:02d}{hour:02d}00Z 36010KT 9999 FEW030 20/10 Q1013</raw_text>
+      <station_id>{station_id}</station_id>
+      <observation_time>{observation_time}</observation_time>
+      <temp_c>20.0</temp_c>
+      <dewpoint_c>10.0</dewpoint_c>
+      <wind_dir_degrees>360</wind_dir_degrees>
+      <wind_speed_kt>10</wind_speed_kt>
+      <altim_in_hg>29.91</altim_in_hg>
+      <sky_condition sky_cover="FEW" cloud_base_ft_agl="3000" />
+      <metar_type>METAR</metar_type>
+    </METAR>'''
+
+
+def create_metar_xml(station_list, observation_list):
+    """Create AWC style XML of METARs of the stations at the datetimes.
+    """
+    metars = [
+        METAR_ELEMENT.format(
+            station_id=station_id,
+            day=observation_time.day,
+            hour=observation_time.hour,
+            observation_time=observation_time.strftime(r'%Y-%m-%dT%H:%M:%SZ')
+        )
+        for station_id in station_list
+        for observation_time in observation_list
+    ]
+    return METAR_XML.format(num=len(metars), metars='\n'.join(metars))
+
+
+def assert_metar_pages(test_case, metars, page_size):
+    """Check that the pages of get_metar_page read all of the METARs in
+    both orders, and a page is read backward.
+    """
+    expected = [(metar.observation_time, metar.station_id) for metar in metars]
+    for descending in (False, True):
+        keys = []
+        key = None
+        while True:
+            page, has_more = search_function.get_metar_page(metars, page_size, key, descending)
+            keys.extend((metar.observation_time, metar.station_id) for metar in page)
+            if not has_more:
+                break
+            key = (page[-1].observation_time, page[-1].station_id)
+        test_case.assertEqual(keys, expected[::-1] if descending else expected)
+        page, has_more = search_function.get_metar_page(metars, page_size, keys[-2], descending, backward=True)
+        test_case.assertEqual(
+            [(metar.observation_time, metar.station_id) for metar in page],
+            keys[-2 - page_size:-2]
+        )
+        test_case.assertTrue(has_more)
+
+
+class StubAWCHandler(BaseHTTPRequestHandler):
+    """Stub of the AWC data server.
+
+    Stations in 'failing_stations' of the server make the response 500.
+    """
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        station_list = query['stationString'][0].split(',')
+        self.server.requested.append(station_list)
+        self.server.requested_hours.append(int(query['hoursBeforeNow'][0]))
+        if set(station_list) & self.server.failing_stations:
+            self.send_response(500)
+            self.end_headers()
+            return
+        body = create_metar_xml(station_list, self.server.observation_list).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubAWCTestCase(TestCase):
+    """Test case with the stub AWC server.
+    """
+    def setUp(self):
+        now = timezone.now().replace(minute=0, second=0, microsecond=0)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubAWCHandler)
+        self.server.requested = []
+        self.server.requested_hours = []
+        self.server.failing_stations = set()
+        self.server.observation_list = [now - timedelta(hours=2), now - timedelta(hours=1)]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def create_input(self, airport_list):
+        metar_input = metar_function.MetarInput(airport_list)
+        metar_input.url = 'http://127.0.0.1:%s/' % self.server.server_port
+        metar_input.chunk_size = 2
+        metar_input.retries = 1
+        metar_input.backoff = 0
+        return metar_input
+
+
+class MetarInputTests(StubAWCTestCase):
+    def test_fetch_by_chunks(self):
+        metar_input = self.create_input(['RJTT', 'RJAA', 'RJBB', 'RJCC', 'RJFF'])
+        # The HTTP time of the worker threads is added to the record of the
+        # request thread.
+        record = metrics_function.start_record()
+        try:
+            metar_input.fetch_and_save()
+        finally:
+            metrics_function.end_record()
+        self.assertEqual(sorted(len(chunk) for chunk in self.server.requested), [1, 2, 2])
+        self.assertEqual(record.http_count, 3)
+        self.assertEqual(metar_input.inserted_count, 10)
+        self.assertEqual(Metar.objects.count(), 10)
+
+    def test_skip_duplicates(self):
+        self.create_input(['RJTT', 'RJAA']).fetch_and_save()
+        metar_input = self.create_input(['RJTT', 'RJAA'])
+        metar_input.fetch_and_save()
+        self.assertEqual(metar_input.inserted_count, 0)
+        self.assertEqual(metar_input.duplicate_count, 4)
+
+    def test_partial_failure(self):
+        self.server.failing_stations = {'RJBB'}
+        metar_input = self.create_input(['RJTT', 'RJAA', 'RJBB', 'RJCC'])
+        metar_input.fetch_and_save()
+        self.assertEqual(list(metar_input.chunk_errors), ['RJBB,RJCC'])
+        self.assertEqual(len([chunk for chunk in self.server.requested if 'RJBB' in chunk]), 2)
+        self.assertEqual(sorted(set(Metar.objects.values_list('station_id', flat=True))), ['RJAA', 'RJTT'])
+
+    def test_reuse(self):
+        metar_input = self.create_input(['RJTT', 'RJAA'])
+        metar_input.fetch_and_save()
+        fetched_time = metar_input.fetched_time
+        self.assertEqual((metar_input.inserted_count, len(metar_input.fetched_data)), (4, 4))
+        metar_input.fetch_and_save()
+        self.assertGreater(metar_input.fetched_time, fetched_time)
+        self.assertEqual((metar_input.inserted_count, metar_input.duplicate_count), (0, 4))
+        self.assertEqual(metar_input.fetched_data, [])
+
+    def test_rollback(self):
+        class FailingWriter(writer_function.BulkCreateWriter):
+            def write(self, metars):
+                if Metar.objects.exists():
+                    raise RuntimeError('write failed')
+                return super().write(metars)
+
+        received = []
+
+        def receive(sender, metars, **kwargs):
+            received.append(metars)
+
+        metars_inserted.connect(receive)
+        self.addCleanup(metars_inserted.disconnect, receive)
+        metar_input = self.create_input(['RJTT', 'RJAA', 'RJBB'])
+        metar_input.writer = FailingWriter(writer_function.KEEP)
+        metar_input.batch_size = 2
+        with self.assertRaises(RuntimeError):
+            metar_input.fetch_and_save()
+        self.assertFalse(Metar.objects.exists())
+        self.assertEqual(received, [])
+
+    def test_stop_consumer(self):
+        metar_input = self.create_input(['RJTT', 'RJAA', 'RJBB', 'RJCC', 'RJFF', 'RJOO'])
+        metar_input.max_workers = 1
+        metar_input.batch_size = 1
+        batches = metar_input.iter_batches()
+        self.assertEqual(len(next(batches)), 1)
+        # The worker waits for the bounded queue and stops with the consumer.
+        batches.close()
+        self.assertEqual(len(self.server.requested), 1)
+
+    def test_iter_metar_batches(self):
+        last = timezone.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=1)
+        xml = create_metar_xml(['RJTT', 'RJAA', 'RJBB'], [last - timedelta(hours=1), last])
+        # The visibility of the last METAR of RJAA is removed.
+        broken = xml.replace('RJAA %02d%02d00Z 36010KT 9999' % (last.day, last.hour), 'RJAA')
+        batches = list(metar_function.iter_metar_batches(io.BytesIO(xml.encode()), 4))
+        self.assertEqual([len(batch) for batch in batches], [4, 2])
+        self.assertEqual(batches[1][1].station_id, 'RJBB')
+        errors = []
+        batches = list(metar_function.iter_metar_batches(io.BytesIO(broken.encode()), 4, errors.append))
+        self.assertEqual(([len(batch) for batch in batches], len(errors)), ([4, 1], 1))
+        with self.assertRaises(re.error):
+            list(metar_function.iter_metar_batches(io.BytesIO(broken.encode()), 4))
+        # ParseError of the ElementTree copy of defusedxml 0.6 is another
+        # class, but both are SyntaxError.
+        with self.assertRaises(SyntaxError):
+            list(metar_function.iter_metar_batches(io.BytesIO(b'not xml')))
+        with self.assertRaises(DTDForbidden):
+            list(metar_function.iter_metar_batches(io.BytesIO(b'<!DOCTYPE response []><response></response>')))
+
+
+class BackfillFunctionTests(TestCase):
+    AWC_CSV = (
+        'No errors\n'
+        '2 results\n'
+        'raw_text,station_id,observation_time,temp_c,dewpoint_c,sky_cover,cloud_base_ft_agl,'
+        'sky_cover,cloud_base_ft_agl,metar_type\n'
+        'RJTT 010000Z 36010KT 9999 FEW010 BKN020 20/10 Q1013,RJTT,2021-01-01T00:00:00Z,20.0,10.0,'
+        'FEW,1000,BKN,2000,METAR\n'
+        'RJTT 010030Z 36010KT 20/10 Q1013,RJTT,2021-01-01T00:30:00Z,20.0,10.0,,,,,METAR\n'
+    )
+
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.archive_dir)
+        observation_list = [datetime(2021, 1, 2, hour, tzinfo=timezone.utc) for hour in range(3)]
+        os.makedirs(os.path.join(self.archive_dir, '2021'))
+        with gzip.open(os.path.join(self.archive_dir, '2021', 'metars.xml.gz'), 'wt') as f:
+            f.write(create_metar_xml(['RJAA', 'RJBB'], observation_list))
+        with open(os.path.join(self.archive_dir, 'awc.csv'), 'w') as f:
+            f.write(self.AWC_CSV)
+        with open(os.path.join(self.archive_dir, 'notes.txt'), 'w') as f:
+            f.write('not an archive')
+
+    def test_iter_csv_batches(self):
+        errors = []
+        batches = list(backfill_function.iter_csv_batches(io.StringIO(self.AWC_CSV), 10, errors.append))
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(batches[0][0].cloud_ceiling, 2000)
+        # The CSV files exported by this app.
+        field_names = search_function.get_csv_field_names()
+        exported = io.StringIO()
+        writer = csv.writer(exported)
+        writer.writerow(field_names)
+        writer.writerow(getattr(batches[0][0], name) for name in field_names)
+        exported.seek(0)
+        metar = next(backfill_function.iter_csv_batches(exported))[0]
+        self.assertEqual([getattr(metar, name) for name in field_names],
+                         [getattr(batches[0][0], name) for name in field_names])
+
+    def test_load_archive_file(self):
+        file_list = backfill_function.find_archive_files([os.path.relpath(self.archive_dir)])
+        self.assertEqual(file_list, [
+            os.path.join(self.archive_dir, '2021', 'metars.xml.gz'),
+            os.path.join(self.archive_dir, 'awc.csv')
+        ])
+        result = backfill_function.load_archive_file(file_list[0], batch_size=4)
+        self.assertEqual(result, {'parsed': 6, 'inserted': 6, 'invalid': 0})
+        self.assertEqual(backfill_function.load_archive_file(file_list[0])['inserted'], 0)
+        result = backfill_function.load_archive_file(file_list[1])
+        self.assertEqual(result, {'parsed': 1, 'inserted': 1, 'invalid': 1})
+        self.assertEqual(Metar.objects.count(), 7)
+
+    def test_deferred_receivers(self):
+        path = os.path.join(self.archive_dir, '2021', 'metars.xml.gz')
+        with mock.patch.object(metars_inserted, 'send', wraps=metars_inserted.send) as send:
+            result = backfill_function.load_archive_file(path, batch_size=1)
+        self.assertEqual(result['inserted'], 6)
+        send.assert_called_once()
+        sent = send.call_args[1]['metars']
+        self.assertEqual(sorted((metar.station_id, metar.observation_time.hour) for metar in sent),
+                         [('RJAA', 2), ('RJBB', 2)])
+        self.assertEqual(
+            dict(StationStatus.objects.values_list('station_id', 'newest_observation_time')),
+            {metar.station_id: metar.observation_time for metar in sent}
+        )
+
+        def get_rollups(model, period):
+            names = [field.name for field in model._meta.fields if not field.primary_key]
+            return list(model.objects.order_by('station_id', period).values(*names))
+        hourly = get_rollups(MetarHourlyRollup, 'hour')
+        daily = get_rollups(MetarDailyRollup, 'day')
+        self.assertEqual([rollup['count'] for rollup in hourly], [1] * 6)
+        self.assertEqual([rollup['count'] for rollup in daily], [3, 3])
+        # The same as the rollups rebuilt from all METARs.
+        rollup_function.rebuild_rollups()
+        self.assertEqual(get_rollups(MetarHourlyRollup, 'hour'), hourly)
+        self.assertEqual(get_rollups(MetarDailyRollup, 'day'), daily)
+
+    def test_checkpoint(self):
+        checkpoint_path = os.path.join(self.archive_dir, 'checkpoint.json')
+        out = io.StringIO()
+        call_command('loadMetarArchive', os.path.relpath(self.archive_dir), checkpoint=checkpoint_path, stdout=out)
+        self.assertIn('The number of the inserted data is 7', out.getvalue())
+        checkpoint = backfill_function.load_checkpoint(checkpoint_path)
+        self.assertEqual(sorted(checkpoint), backfill_function.find_archive_files([self.archive_dir]))
+        # Resumed with the absolute path, and with the relative keys of an
+        # older checkpoint.
+        out = io.StringIO()
+        call_command('loadMetarArchive', self.archive_dir, checkpoint=checkpoint_path, stdout=out)
+        self.assertIn('The number of the files to be loaded is 0', out.getvalue())
+        backfill_function.save_checkpoint(
+            checkpoint_path,
+            {os.path.relpath(path): result for path, result in checkpoint.items()}
+        )
+        self.assertEqual(backfill_function.load_checkpoint(checkpoint_path), checkpoint)
+
+
+class PipelineFunctionTests(StubAWCTestCase):
+    def create_pipeline(self, airport_list, parse_workers):
+        pipeline = pipeline_function.MetarPipeline(airport_list)
+        pipeline.url = 'http://127.0.0.1:%s/' % self.server.server_port
+        pipeline.chunk_size = 2
+        pipeline.fetch_workers = 2
+        pipeline.parse_workers = parse_workers
+        pipeline.queue_size = 1
+        pipeline.batch_size = 3
+        pipeline.retries = 1
+        pipeline.backoff = 0
+        return pipeline
+
+    def test_run(self):
+        self.server.failing_stations = {'RJBB'}
+        pipeline = self.create_pipeline(['RJTT', 'RJAA', 'RJBB', 'RJCC', 'RJFF'], 0)
+        pipeline.run()
+        self.assertEqual(list(pipeline.chunk_errors), ['RJBB,RJCC'])
+        self.assertEqual(pipeline.inserted_count, 6)
+        self.assertEqual(Metar.objects.count(), 6)
+        stats = pipeline.get_stats()
+        self.assertEqual(stats['fetch']['items'], 2)
+        self.assertEqual(stats['parse']['rows'], 6)
+        self.assertEqual(stats['write']['items'], 2)
+        self.assertLessEqual(stats['write']['max_depth'], 1)
+
+    def test_parse_processes(self):
+        self.create_pipeline(['RJTT', 'RJAA'], 0).run()
+        pipeline = self.create_pipeline(['RJTT', 'RJAA', 'RJCC'], 2)
+        pipeline.run()
+        self.assertEqual(pipeline.fetched_count, 6)
+        self.assertEqual(pipeline.inserted_count, 2)
+        self.assertEqual(pipeline.duplicate_count, 4)
+        self.assertEqual(Metar.objects.filter(station_id='RJCC').count(), 2)
+
+
+class WriterFunctionTests(TestCase):
+    def setUp(self):
+        self.time = timezone.now().replace(minute=0, second=0, microsecond=0)
+        writer_function.get_writer().write([self.create_metar('RJTT 010000Z 36010KT 9999 FEW030 20/10 Q1013')])
+
+    def create_metar(self, raw_text, station_id='RJTT'):
+        return Metar(
+            raw_text=raw_text,
+            station_id=station_id,
+            observation_time=self.time,
+            temp_c=20.0,
+            dewpoint_c=10.0,
+            altim_in_hg=29.91
+        )
+
+    def test_correction_policies(self):
+        corrected = 'RJTT 010000Z COR 36010KT 9999 FEW030 21/10 Q1013'
+        different = 'RJTT 010000Z 36012KT 9999 FEW030 20/10 Q1013'
+        remarks = 'RJTT 010000Z 36012KT 9999 FEW030 20/10 Q1013 RMK COR'
+        cases = [
+            ('keep', corrected, 0),
+            ('correction', different, 0),
+            ('correction', remarks, 0),
+            ('correction', corrected, 1),
+            ('replace', different, 1)
+        ]
+        stored_raw_text = Metar.objects.get(station_id='RJTT').raw_text
+        for policy, raw_text, updated_count in cases:
+            result = writer_function.get_writer(policy).write([
+                self.create_metar(raw_text),
+                self.create_metar('RJAA 010000Z 36010KT 9999 FEW030 20/10 Q1013', 'RJAA')
+            ])
+            self.assertEqual(len(result.updated), updated_count, policy)
+            if updated_count:
+                stored_raw_text = raw_text
+            self.assertEqual(Metar.objects.get(station_id='RJTT').raw_text, stored_raw_text, policy)
+        self.assertEqual(Metar.objects.count(), 2)
+
+    def test_duplicates_in_batch(self):
+        metars = [
+            self.create_metar('RJAA 010000Z 36010KT 9999 FEW030 20/10 Q1013', 'RJAA'),
+            self.create_metar('RJAA 010000Z COR 36010KT 9999 FEW030 21/10 Q1013', 'RJAA')
+        ]
+        result = writer_function.get_writer('correction').write(metars)
+        self.assertEqual([metar.raw_text for metar in result.inserted], [metars[1].raw_text])
+        self.assertTrue(writer_function.is_correction(metars[1].raw_text))
+        self.assertFalse(writer_function.is_correction('RJTT 010000Z 36010KT 9999 RMK COR'))
+
+
+class CacheFunctionTests(StubAWCTestCase):
+    def setUp(self):
+        super().setUp()
+        cache_function.get_metar_cache().clear()
+
+    def test_invalidate_on_insert(self):
+        observation_list = self.server.observation_list
+        self.server.observation_list = observation_list[:1]
+        self.create_input(['RJTT']).fetch_and_save()
+        today = timezone.localtime(observation_list[0]).replace(hour=0)
+        end_day = timezone.localtime(observation_list[1]).replace(hour=0)
+        before = cache_function.stats.as_dict()
+        self.assertEqual(len(cache_function.get_cached_metars(['RJTT'], today, end_day)), 1)
+        with CaptureQueriesContext(connection) as context:
+            cache_function.get_cached_metars(['RJTT'], today, end_day)
+        self.assertFalse([query for query in context.captured_queries if Metar._meta.db_table in query['sql']])
+        self.server.observation_list = observation_list
+        self.create_input(['RJTT']).fetch_and_save()
+        self.assertEqual(len(cache_function.get_cached_metars(['RJTT'], today, end_day)), 2)
+        after = cache_function.stats.as_dict()
+        self.assertEqual(after['hits'] - before['hits'], (end_day - today).days + 1)
+        self.assertGreater(after['invalidations'], before['invalidations'])
+
+
+class IngestFunctionTests(StubAWCTestCase):
+    def test_group_by_hours(self):
+        now = timezone.now()
+        high_water = {'RJTT': now - timedelta(minutes=20), 'RJAA': now - timedelta(minutes=150)}
+        self.assertEqual(
+            ingest_function.group_by_hours(['RJTT', 'RJAA', 'RJBB'], high_water, now),
+            {1: ['RJTT'], 3: ['RJAA'], 25: ['RJBB']}
+        )
+
+    def test_run_once(self):
+        Airport.objects.bulk_create([
+            Airport(station_id=station_id, register_date=timezone.localdate(), is_fetched=True)
+            for station_id in ['RJTT', 'RJAA']
+        ])
+        airport_function.invalidate_registry()
+        self.addCleanup(airport_function.invalidate_registry)
+        scheduler = ingest_function.IngestScheduler()
+        scheduler.url = 'http://127.0.0.1:%s/' % self.server.server_port
+        self.assertEqual(scheduler.run_once()['inserted'], 4)
+        self.assertEqual(self.server.requested_hours, [25])
+        self.server.observation_list.append(self.server.observation_list[-1] + timedelta(minutes=30))
+        result = scheduler.run_once()
+        self.assertEqual(result['inserted'], 2)
+        self.assertLessEqual(self.server.requested_hours[-1], 2)
+
+    def test_run_continues_after_failure(self):
+        scheduler = ingest_function.IngestScheduler(speci_interval=timedelta(0))
+        results = []
+
+        def on_cycle(result):
+            results.append(result)
+            scheduler.stop()
+        # close_old_connections would close the connection of the test case.
+        with mock.patch.object(scheduler, 'run_once', side_effect=[OperationalError('lost'), {'inserted': 1}]), \
+                mock.patch.object(ingest_function, 'close_old_connections'), \
+                self.assertLogs('metarapp.myfunction.ingest_function', 'ERROR'):
+            scheduler.run(on_cycle)
+        self.assertEqual(results, [{'inserted': 1}])
+        self.assertEqual(scheduler.failed_cycles, 1)
+
+    def test_next_poll(self):
+        scheduler = ingest_function.IngestScheduler()
+        now = timezone.now().replace(minute=28, second=0, microsecond=0)
+        self.assertEqual(scheduler.get_next_poll(now), now + timedelta(minutes=5))
+        self.assertEqual(scheduler.get_next_poll(now + timedelta(minutes=4)), now + timedelta(minutes=5))
+
+
+class AirportFunctionTests(TestCase):
+    AIRPORTS_CSV = (
+        'id,ident,type,name,latitude_deg,longitude_deg,elevation_ft,gps_code\n'
+        '1,RJTT,large_airport,Tokyo Haneda,35.5523,139.78,35,RJTT\n'
+        '2,RJAA,large_airport,Narita,35.7647,140.386,141,RJAA\n'
+        '3,RJBB,large_airport,Kansai,34.4273,135.244,26,RJBB\n'
+        '4,JP-0001,heliport,Heliport,35.0,139.0,0,\n'
+        '5,NZCH,large_airport,Christchurch,-43.4894,172.532,123,NZCH\n'
+    )
+    RUNWAYS_CSV = (
+        'airport_ident,closed,le_ident,le_heading_degT,he_ident,he_heading_degT\n'
+        'RJTT,0,16R,157.8,34L,337.8\n'
+        'RJTT,0,05,,23,\n'
+        'RJAA,1,16L,,34R,\n'
+    )
+
+    def setUp(self):
+        self.addCleanup(airport_function.invalidate_registry)
+        Airport.objects.create(station_id='RJTT', register_date=timezone.localdate(), is_fetched=True)
+        airport_function.import_airports(io.StringIO(self.AIRPORTS_CSV), io.StringIO(self.RUNWAYS_CSV))
+
+    def test_import_airports(self):
+        self.assertEqual(Airport.objects.count(), 4)
+        haneda = Airport.objects.get(station_id='RJTT')
+        self.assertTrue(haneda.is_fetched)
+        self.assertEqual((haneda.name, haneda.elevation_ft), ('Tokyo Haneda', 35))
+        self.assertEqual(haneda.runway_headings, [158, 338, 50, 230])
+        self.assertEqual(Airport.objects.get(station_id='RJAA').runway_headings, [])
+        self.assertEqual(airport_function.import_airports(io.StringIO(self.AIRPORTS_CSV)), (0, 4))
+
+    def test_registry(self):
+        registry = airport_function.get_registry()
+        self.assertEqual(registry.fetched_list, ['RJTT'])
+        Airport.objects.filter(station_id='RJAA').update(is_fetched=True)
+        self.assertIs(airport_function.get_registry(), registry)
+        Airport.objects.get(station_id='RJBB').save()
+        self.assertEqual(airport_function.get_airport_list(), ['RJAA', 'RJTT'])
+
+    def test_newest_dict(self):
+        Airport.objects.update(is_fetched=True)
+        airport_function.invalidate_registry()
+        time = timezone.now().replace(minute=0, second=0, microsecond=0)
+        metars = [
+            Metar(
+                raw_text='%s 010000Z 36010KT 9999 FEW030 20/10 Q1013' % station_id,
+                station_id=station_id,
+                observation_time=time - timedelta(hours=hours),
+                temp_c=20.0,
+                dewpoint_c=10.0,
+                altim_in_hg=29.91
+            )
+            for station_id in ('RJTT', 'RJAA', 'RJBB', 'NZCH')
+            for hours in (1, 2)
+        ]
+        Metar.objects.bulk_create(metars[:6])
+        # Backfilled by the migration for the stored METARs.
+        import_module('metarapp.migrations.0003_stationstatus').fill_station_status(apps, None)
+        self.assertEqual(StationStatus.objects.count(), 3)
+        newest_dict = airport_function.AirportMetarNewest().newest_dict
+        self.assertEqual(newest_dict, dict.fromkeys(['RJTT', 'RJAA', 'RJBB'], time - timedelta(hours=1)))
+        # NZCH has no StationStatus until its METARs are inserted.
+        written = writer_function.get_writer().write(metars[6:] + [
+            Metar(
+                raw_text='RJAA 010000Z 36010KT 9999 FEW030 20/10 Q1013',
+                station_id='RJAA',
+                observation_time=time,
+                temp_c=20.0,
+                dewpoint_c=10.0,
+                altim_in_hg=29.91
+            )
+        ]).written
+        metars_inserted.send(sender=Metar, metars=written)
+        newest_dict = airport_function.AirportMetarNewest().newest_dict
+        self.assertEqual(sorted(newest_dict), ['NZCH', 'RJAA', 'RJBB', 'RJTT'])
+        self.assertEqual(newest_dict['RJAA'], time)
+        self.assertEqual(newest_dict['NZCH'], time - timedelta(hours=1))
+        self.assertEqual(newest_dict['RJTT'], time - timedelta(hours=1))
+
+    def test_spatial_lookups(self):
+        registry = airport_function.get_registry()
+        within = registry.within(35.6, 139.8, 100)
+        self.assertEqual([airport.station_id for _, airport in within], ['RJTT', 'RJAA'])
+        self.assertAlmostEqual(within[0][0], 5.4, delta=0.5)
+        nearest = registry.nearest(34.0, 135.0, 2)
+        self.assertEqual([airport.station_id for _, airport in nearest], ['RJBB', 'RJTT'])
+        self.assertEqual(registry.nearest(-40.0, -175.0)[0][1].station_id, 'NZCH')
+        in_bbox = registry.in_bbox(-50, 170, 36, 140)
+        self.assertEqual([airport.station_id for airport in in_bbox], ['NZCH', 'RJBB', 'RJTT'])
+        self.assertEqual(registry.within(0.0, 0.0, 100), [])
+
+
+class JobFunctionTests(StubAWCTestCase):
+    def test_run_job(self):
+        job = FetchJob.objects.create(airports=['RJTT', 'RJAA', 'RJBB'])
+        url = 'http://127.0.0.1:%s/' % self.server.server_port
+        with mock.patch.object(metar_function.MetarInput, 'URL', url):
+            self.assertTrue(job_function.run_job(job.id))
+            self.assertFalse(job_function.run_job(job.id))
+        job.refresh_from_db()
+        self.assertEqual(job.status, FetchJob.DONE)
+        self.assertEqual(job.station_counts, {'RJTT': 2, 'RJAA': 2, 'RJBB': 2})
+        self.assertEqual(job.inserted_count, 6)
+        self.assertIsNotNone(job.duration)
+
+    def test_requeue_stale_jobs(self):
+        now = timezone.now()
+        stale = FetchJob.objects.create(airports=['RJTT'], status=FetchJob.RUNNING,
+                                        started_at=now - timedelta(hours=2))
+        running = FetchJob.objects.create(airports=['RJAA'], status=FetchJob.RUNNING,
+                                          started_at=now - timedelta(minutes=5))
+        url = 'http://127.0.0.1:%s/' % self.server.server_port
+        with mock.patch.object(metar_function.MetarInput, 'URL', url), \
+                self.settings(METAR_JOB_STALE_TIMEOUT=3600):
+            self.assertEqual(job_function.run_pending_jobs(), 1)
+        stale.refresh_from_db()
+        running.refresh_from_db()
+        self.assertEqual(stale.status, FetchJob.DONE)
+        self.assertEqual(stale.inserted_count, 2)
+        self.assertEqual(running.status, FetchJob.RUNNING)
+
+    def test_manage_view(self):
+        self.addCleanup(airport_function.invalidate_registry)
+        Airport.objects.create(station_id='RJTT', register_date=timezone.localdate(), is_fetched=True)
+        Airport.objects.create(station_id='RJAA', register_date=timezone.localdate(), is_fetched=False)
+        User.objects.create_superuser('admin', password='password')
+        self.client.login(username='admin', password='password')
+        url = '/admin/metarapp/metar/metar_manage_view'
+        # Only the fetched airports of the registry are queued.
+        response = self.client.post(url, {'airport': ['RJTT', 'RJAA']})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(FetchJob.objects.exists())
+        response = self.client.post(url, {'airport': ['RJTT']})
+        self.assertRedirects(response, url, fetch_redirect_response=False)
+        job = FetchJob.objects.get()
+        self.assertEqual(job.airports, ['RJTT'])
+        self.assertContains(self.client.get(url), 'The fetch job %d is queued.' % job.id)
+
+
+class RollupFunctionTests(StubAWCTestCase):
+    def test_update_on_insert(self):
+        self.server.observation_list = self.server.observation_list[:1]
+        self.create_input(['RJTT']).fetch_and_save()
+        self.assertEqual(MetarHourlyRollup.objects.get().count, 1)
+        self.server.observation_list.append(self.server.observation_list[0] + timedelta(minutes=30))
+        self.create_input(['RJTT']).fetch_and_save()
+        hourly = MetarHourlyRollup.objects.get()
+        self.assertEqual((hourly.count, hourly.temp_sum, hourly.below_ceiling_count), (2, 40.0, 0))
+        self.assertEqual(MetarDailyRollup.objects.get().count, 2)
+        self.assertEqual(rollup_function.rebuild_rollups(), 1)
+
+    def test_count_weather(self):
+        self.assertEqual(rollup_function.count_weather('-SHRA BR'), {'SH': 1, 'RA': 1, 'BR': 1})
+
+
+class AnalyticsFunctionTests(SimpleTestCase):
+    def test_flight_category(self):
+        nan = float('nan')
+        codes = analytics_function.flight_category(
+            np.array([nan, 3000, 2900, 800, 300, nan]),
+            np.array([nan, nan, nan, nan, nan, 200]),
+            np.array([9999, 9999, 9999, 9999, 9999, 9999])
+        )
+        self.assertEqual(
+            analytics_function.FLIGHT_CATEGORIES[codes].tolist(),
+            ['VFR', 'MVFR', 'MVFR', 'IFR', 'LIFR', 'LIFR']
+        )
+        codes = analytics_function.flight_category(np.full(3, nan), np.full(3, nan), np.array([8047, 4000, 1000]))
+        self.assertEqual(codes.tolist(), [1, 2, 3])
+
+    def test_overcast_ceiling(self):
+        texts = {'raw_text': 'RJTT 100000Z 36010KT 9999 FEW002 OVC003 20/10 Q1013',
+                 'observation_time': '2021-01-10T00:00:00Z'}
+        from_text = metar_function.create_metar(texts)
+        element = ElementTree.fromstring(
+            '<METAR><raw_text>%s</raw_text><observation_time>%s</observation_time>'
+            '<sky_condition sky_cover="FEW" cloud_base_ft_agl="200" />'
+            '<sky_condition sky_cover="OVC" cloud_base_ft_agl="300" /></METAR>'
+            % (texts['raw_text'], texts['observation_time'])
+        )
+        from_xml = metar_function.get_single_model(element)
+        self.assertEqual((from_text.cloud_ceiling, from_xml.cloud_ceiling), (300, 300))
+        codes = analytics_function.flight_category(np.array([300.0]), np.array([float('nan')]), np.array([9999]))
+        self.assertEqual(analytics_function.FLIGHT_CATEGORIES[codes].tolist(), ['LIFR'])
+
+    def test_to_columns(self):
+        columns = analytics_function.to_columns(
+            [('RJTT', None, 20.0), ('RJAA', 3, 21.0)],
+            ['station_id', 'wind_gust_kt', 'temp_c']
+        )
+        self.assertTrue(np.isnan(columns['wind_gust_kt'][0]))
+        self.assertEqual(columns['temp_c'].dtype, np.float64)
+
+
+class ChartFunctionTests(TestCase):
+    def setUp(self):
+        self.start = datetime(2021, 1, 1, tzinfo=timezone.utc)
+        metars = [
+            Metar(
+                raw_text='RJTT %02d%02d%02dZ 36010KT 9999 FEW030 %02d/10 Q1013' % (
+                    (self.start + timedelta(minutes=30 * i)).day,
+                    (self.start + timedelta(minutes=30 * i)).hour,
+                    (self.start + timedelta(minutes=30 * i)).minute,
+                    i % 48
+                ),
+                station_id='RJTT',
+                observation_time=self.start + timedelta(minutes=30 * i),
+                temp_c=float(i % 48),
+                dewpoint_c=10.0,
+                wind_speed_kt=10,
+                visibility_m=9999,
+                altim_in_hg=29.91
+            )
+            for i in range(48 * 4)
+        ]
+        writer_function.insert_metars(metars)
+        rollup_function.update_rollups(metars)
+
+    def test_lttb(self):
+        x = np.arange(100)
+        y = np.zeros(100)
+        y[37] = 5.0
+        indexes = chart_function.lttb(x, y, 10)
+        self.assertEqual(len(indexes), 10)
+        self.assertEqual((indexes[0], indexes[-1]), (0, 99))
+        self.assertIn(37, indexes)
+        self.assertTrue(np.all(np.diff(indexes) > 0))
+
+    def test_minmax(self):
+        chart = chart_function.get_chart('RJTT', self.start, self.start + timedelta(hours=2), ['temp_c'], 3)
+        self.assertEqual(chart['source'], 'metar')
+        self.assertEqual(chart['bucket_seconds'], 2400)
+        self.assertEqual(chart['series']['temp_c'], {
+            'min': [0.0, 2.0, 3.0],
+            'max': [1.0, 2.0, 3.0],
+            'mean': [0.5, 2.0, 3.0]
+        })
+        # The hourly rollups if a bucket is at least an hour.
+        chart = chart_function.get_chart('RJTT', self.start, self.start + timedelta(days=1), ['temp_c'], 6)
+        self.assertEqual(chart['source'], 'hourly')
+        self.assertEqual(chart['bucket_seconds'], 4 * 3600)
+        self.assertEqual(len(chart['time']), 6)
+        self.assertEqual(chart['series']['temp_c']['min'][:2], [0.0, 8.0])
+        self.assertEqual(chart['series']['temp_c']['max'][:2], [7.0, 15.0])
+        self.assertEqual(chart['series']['temp_c']['mean'][0], 3.5)
+        chart = chart_function.get_chart('RJTT', self.start, self.start + timedelta(days=4), ['wind_gust_kt'], 4)
+        self.assertEqual(chart['series']['wind_gust_kt'], {'max': [None] * 4})
+
+    def test_api_chart(self):
+        User.objects.create_user('user', password='password')
+        self.client.login(username='user', password='password')
+        response = self.client.get('/metarapp/api/chart/', {
+            'station': 'rjtt',
+            'start': '2021-01-01T00:00:00Z',
+            'end': '2021-01-03T00:00:00Z',
+            'fields': 'temp_c,altim_in_hg',
+            'points': 20,
+            'method': 'lttb'
+        })
+        self.assertEqual(response.status_code, 200)
+        series = response.json()['series']
+        self.assertEqual(sorted(series), ['altim_in_hg', 'temp_c'])
+        self.assertEqual(len(series['temp_c']['time']), 20)
+        self.assertEqual(series['altim_in_hg']['value'][0], 29.91)
+        response = self.client.get('/metarapp/api/chart/', {'station': 'RJTT', 'fields': 'raw_text'})
+        self.assertEqual(response.status_code, 400)
+
+
+class ConditionFunctionTests(TestCase):
+    def setUp(self):
+        self.start = datetime(2021, 1, 1, tzinfo=timezone.utc)
+        # The ceilings are decoded from the reports, as create_metar does.
+        reports = [
+            ('RJTT', '36010KT 9999 FEW030', None, 9999, ''),
+            ('RJTT', '36015G30KT 3000 +TSRA BKN008', 30, 3000, '+TSRA'),
+            ('RJAA', '00000KT 0200 FG VV001', None, 200, 'FG'),
+            ('RJAA', '36020G26KT 9999 -SHSN BKN020', 26, 9999, '-SHSN'),
+            ('RJAA', '36005KT 4000 BR FEW002 OVC004 BKN010', None, 4000, 'BR')
+        ]
+        self.metars = []
+        for i, (station_id, body, gust, visibility, wx_string) in enumerate(reports):
+            raw_text = '%s 01%02d00Z %s 01/M01 Q1013' % (station_id, i, body)
+            decoded = decode_function.decode(raw_text)
+            self.metars.append(Metar(
+                raw_text=raw_text,
+                station_id=station_id,
+                observation_time=self.start + timedelta(hours=i),
+                temp_c=1.0,
+                dewpoint_c=-1.0,
+                wind_dir_degrees=360,
+                wind_speed_kt=10,
+                wind_gust_kt=gust,
+                visibility_m=visibility,
+                cloud_ceiling=decoded.cloud_ceiling,
+                vert_vis_ft=decoded.vert_vis_ft,
+                altim_in_hg=29.91,
+                wx_string=wx_string
+            ))
+        writer_function.insert_metars(self.metars)
+
+    def search(self, ranges={}, wx_codes=[], category=0, after=None):
+        return list(
+            condition_function
+            .search_conditions([], self.start, self.start + timedelta(days=1), ranges, wx_codes, category, after)
+            .values_list('station_id', 'observation_time')
+        )
+
+    def test_set_conditions(self):
+        stored = list(Metar.objects.order_by('observation_time').values_list('flight_category', 'wx_flags'))
+        self.assertEqual([category for category, _ in stored], [0, 2, 3, 1, 3])
+        self.assertEqual(stored[1][1], condition_function.get_wx_mask(['TS', 'RA']))
+        self.assertEqual(stored[3][1], condition_function.get_wx_mask(['SH', 'SN']))
+        self.assertEqual(condition_function.get_wx_flags(None), 0)
+        with self.assertRaises(ValueError):
+            condition_function.get_wx_mask(['XX'])
+
+    def test_fill_conditions_migration(self):
+        stored = list(Metar.objects.order_by('observation_time').values_list('flight_category', 'wx_flags'))
+        Metar.objects.update(flight_category=0, wx_flags=0)
+        import_module('metarapp.migrations.0008_metar_conditions').fill_conditions(apps, None)
+        filled = list(Metar.objects.order_by('observation_time').values_list('flight_category', 'wx_flags'))
+        self.assertEqual(filled, stored)
+
+    def test_overcast_ceiling_migration(self):
+        stored = list(Metar.objects.order_by('observation_time').values_list('cloud_ceiling', 'flight_category'))
+        self.assertEqual(stored[4], (400, 3))
+        # The ceiling of the rows written before was the first BKN layer.
+        Metar.objects.filter(observation_time=self.metars[4].observation_time) \
+            .update(cloud_ceiling=1000, flight_category=1)
+        import_module('metarapp.migrations.0010_metar_overcast_ceiling').fill_overcast_ceiling(apps, None)
+        filled = list(Metar.objects.order_by('observation_time').values_list('cloud_ceiling', 'flight_category'))
+        self.assertEqual(filled, stored)
+
+    def test_search_conditions(self):
+        times = [metar.observation_time for metar in self.metars]
+        ranges = {'cloud_ceiling': (None, 1000), 'wind_gust_kt': (25, None)}
+        self.assertEqual(self.search(ranges), [('RJTT', times[1])])
+        self.assertEqual(self.search(wx_codes=['TS', 'SN']), [('RJTT', times[1]), ('RJAA', times[3])])
+        self.assertEqual(self.search(category=2), [('RJTT', times[1]), ('RJAA', times[2]), ('RJAA', times[4])])
+        self.assertEqual(self.search({'cloud_ceiling': (None, 499)}), [('RJAA', times[4])])
+        self.assertEqual(self.search(wx_codes=['FG'], category=3), [('RJAA', times[2])])
+        last_id = Metar.objects.get(observation_time=times[3]).id
+        self.assertEqual(self.search(wx_codes=['SN'], after=(times[3], last_id)), [])
+        self.assertEqual(condition_function.get_implied_category({'visibility_m': (None, 1000)}), 3)
+        self.assertEqual(condition_function.get_implied_category({'cloud_ceiling': (None, 3000)}), 1)
+
+    def test_api_conditions(self):
+        User.objects.create_user('user', password='password')
+        self.client.login(username='user', password='password')
+        params = {
+            'start': '2021-01-01T00:00:00Z',
+            'end': '2021-01-02T00:00:00Z',
+            'wind_gust_kt_min': 25,
+            'limit': 1
+        }
+        response = self.client.get('/metarapp/api/conditions/', params)
+        self.assertEqual(response.status_code, 200)
+        page = response.json()
+        self.assertEqual([metar['station_id'] for metar in page['metars']], ['RJTT'])
+        self.assertEqual(page['metars'][0]['flight_category'], 'IFR')
+        self.assertNotIn('wx_flags', page['metars'][0])
+        response = self.client.get('/metarapp/api/conditions/', dict(params, after=page['next']))
+        page = response.json()
+        self.assertEqual([metar['station_id'] for metar in page['metars']], ['RJAA'])
+        self.assertIsNone(page['next'])
+        response = self.client.get('/metarapp/api/conditions/', {'wx': 'TS,XX'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/metarapp/api/conditions/', {'stations': 'RJTT'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/metarapp/conditions/', {'wx': 'fg', 'start': '2021-01-01', 'end': '2021-01-02'})
+        self.assertContains(response, 'RJAA 010200Z')
+
+
+class PartitionFunctionTests(SimpleTestCase):
+    def test_add_months(self):
+        self.assertEqual(partition_function.add_months(date(2021, 1, 15), 1), date(2021, 2, 1))
+        self.assertEqual(partition_function.add_months(date(2021, 12, 1), 1), date(2022, 1, 1))
+        self.assertEqual(partition_function.add_months(date(2021, 1, 31), -1), date(2020, 12, 1))
+        self.assertEqual(partition_function.add_months(date(2021, 3, 1), -27), date(2018, 12, 1))
+        self.assertEqual(partition_function.add_months(date(2021, 3, 1), 0), date(2021, 3, 1))
+
+    def test_partition_name(self):
+        name = partition_function.get_partition_name(date(2021, 3, 1))
+        self.assertEqual(name, 'metarapp_metar_p202103')
+        self.assertEqual(partition_function.parse_partition_name(name), date(2021, 3, 1))
+        for name in ('metarapp_metar_default', 'metarapp_metar_p20213', 'metarapp_metar_p202113', 'other_p202103'):
+            self.assertIsNone(partition_function.parse_partition_name(name))
+
+
+class ArchiveFunctionTests(TestCase):
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.archive_dir)
+        settings_override = self.settings(METAR_ARCHIVE_DIR=self.archive_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.old_month = partition_function.add_months(timezone.now().date().replace(day=1), -6)
+        old_time = datetime(self.old_month.year, self.old_month.month, 3, tzinfo=timezone.utc)
+        self.time_list = [old_time + timedelta(minutes=30 * i) for i in range(600)] + [timezone.now()]
+        Metar.objects.bulk_create([
+            Metar(
+                raw_text='RJTT %02d%02d%02dZ 36010G25KT 9999 -RA BKN030 20/10 Q1013' % (
+                    observation_time.day, observation_time.hour, observation_time.minute
+                ),
+                station_id='RJTT',
+                observation_time=observation_time,
+                temp_c=20.5,
+                dewpoint_c=10.0,
+                wind_speed_kt=10,
+                wind_gust_kt=25 if i % 2 else None,
+                altim_in_hg=29.91,
+                wx_string='-RA',
+                cloud_ceiling=3000,
+                metar_type=Metar.SPECI if i % 3 else Metar.METAR
+            )
+            for i, observation_time in enumerate(self.time_list)
+        ])
+
+    def test_archive_and_search(self):
+        field_names = search_function.get_csv_field_names()
+        start_time = self.time_list[0] - timedelta(days=1)
+        end_time = timezone.now() + timedelta(days=1)
+        stored_rows = list(search_function.iter_metar_rows(['RJTT'], start_time, end_time, field_names))
+        self.assertEqual(archive_function.find_closed_months(3), [('RJTT', self.old_month)])
+        self.assertEqual(archive_function.archive_month('RJTT', self.old_month), 600)
+        self.assertEqual(Metar.objects.count(), 1)
+        archived_rows = search_function.iter_metar_rows(['RJTT'], start_time, end_time, field_names)
+        self.assertEqual(list(archived_rows), stored_rows)
+
+        # A late METAR of the archived month is merged by archiving again.
+        Metar.objects.create(
+            raw_text='RJTT 031015Z 36010KT 9999 FEW030 20/10 Q1013',
+            station_id='RJTT',
+            observation_time=self.time_list[0] + timedelta(minutes=15),
+            temp_c=20.0,
+            dewpoint_c=10.0,
+            altim_in_hg=29.91
+        )
+        self.assertEqual(archive_function.archive_month('RJTT', self.old_month), 1)
+        self.assertEqual(ArchivedMonth.objects.get().count, 601)
+        columns = analytics_function.load_series(['RJTT'], start_time, end_time)
+        self.assertEqual(len(columns['temp_c']), 602)
+        self.assertTrue(np.all(np.diff(columns['observation_time'].astype(np.int64)) > 0))
+
+        day = timezone.localtime(self.time_list[0]).replace(hour=0, minute=0)
+        metars = search_function.search_metar_all(['RJTT'], day, day)
+        self.assertEqual(
+            [metar.raw_text for metar in metars][:2],
+            [stored_rows[0][0], 'RJTT 031015Z 36010KT 9999 FEW030 20/10 Q1013']
+        )
+        assert_metar_pages(self, metars, 10)
+
+
+class BenchmarkFunctionTests(SimpleTestCase):
+    def test_synthetic_xml(self):
+        observation_times = [datetime(2021, 1, 1, hour, tzinfo=timezone.utc) for hour in range(3)]
+        element_dict = benchmark_function.create_metar_elements(['Z000', 'Z001'], observation_times, 0)
+        xml = benchmark_function.create_awc_xml(element_dict['Z001'])
+        metars = [metar for batch in metar_function.iter_metar_batches(io.BytesIO(xml)) for metar in batch]
+        self.assertEqual([metar.station_id for metar in metars], ['Z001'] * 3)
+        self.assertEqual([metar.observation_time for metar in metars], observation_times)
+        self.assertEqual(
+            element_dict,
+            benchmark_function.create_metar_elements(['Z000', 'Z001'], observation_times, 0)
+        )
+
+    def test_compare_results(self):
+        baseline = {'10000': {'insert': {'rows': 100, 'rows_per_s': 1000.0}, 'index_day': {'warm_median_ms': 10.0}}}
+        current = {'10000': {'insert': {'rows': 10, 'rows_per_s': 900.0}, 'index_day': {'warm_median_ms': 13.0}}}
+        regressions = benchmark_function.compare_results(current, baseline, 0.2)
+        self.assertEqual(len(regressions), 1)
+        self.assertIn('index_day.warm_median_ms', regressions[0])
+        self.assertEqual(benchmark_function.compare_results(current, {}, 0.2), [])
+
+
+class MetarApiTests(TestCase):
+    def setUp(self):
+        self.start = timezone.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=10)
+        Metar.objects.bulk_create([
+            Metar(
+                raw_text='%s %02d%02d00Z 36010KT 9999 FEW030 20/10 Q1013' % (station_id, 1, i),
+                station_id=station_id,
+                observation_time=self.start + timedelta(hours=i),
+                temp_c=20.0,
+                dewpoint_c=10.0,
+                wind_speed_kt=10,
+                altim_in_hg=29.91
+            )
+            for station_id in ['RJTT', 'RJAA']
+            for i in range(5)
+        ])
+        User.objects.create_user('api', password='password')
+
+    def test_login_required(self):
+        response = self.client.get('/metarapp/api/metars/', {'stations': 'RJTT'})
+        self.assertEqual(response.status_code, 401)
+
+    def test_keyset_pages(self):
+        self.client.login(username='api', password='password')
+        params = {
+            'stations': 'RJTT,RJAA',
+            'start': self.start.isoformat(),
+            'limit': 3,
+            'fields': 'station_id,observation_time'
+        }
+        ids = []
+        while True:
+            page = self.client.get('/metarapp/api/metars/', params).json()
+            self.assertTrue(all(set(metar) == {'id', 'station_id', 'observation_time'} for metar in page['metars']))
+            ids.extend(metar['id'] for metar in page['metars'])
+            if page['next'] is None:
+                break
+            params['after'] = page['next']
+        self.assertEqual(ids, list(Metar.objects.order_by('observation_time', 'id').values_list('id', flat=True)))
+
+    def test_ndjson(self):
+        self.client.login(username='api', password='password')
+        response = self.client.get('/metarapp/api/metars/', {'stations': 'RJTT', 'format': 'ndjson'})
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(json.loads(lines[0])['station_id'], 'RJTT')
+
+    def test_summary(self):
+        self.client.login(username='api', password='password')
+        day = timezone.localtime(self.start).date()
+        response = self.client.get('/metarapp/api/summary/', {'stations': 'RJTT', 'start': day - timedelta(days=1)})
+        self.assertEqual(response.json(), {'summaries': []})
+        rollup_function.rebuild_rollups()
+        response = self.client.get(
+            '/metarapp/api/summary/',
+            {'stations': 'RJTT', 'start': day - timedelta(days=1), 'end': day + timedelta(days=1)}
+        )
+        summary = response.json()['summaries'][0]
+        self.assertEqual(summary['count'], 5)
+        self.assertEqual(summary['temp_mean'], 20.0)
+        self.assertEqual(summary['visibility_min'], 9999)
+
+    def test_derived(self):
+        self.client.login(username='api', password='password')
+        params = {
+            'stations': 'RJTT',
+            'fields': 'station_id',
+            'derived': 'relative_humidity,crosswind_kt',
+            'runway': 340
+        }
+        metar = self.client.get('/metarapp/api/metars/', params).json()['metars'][0]
+        self.assertEqual(set(metar), {'id', 'station_id', 'relative_humidity', 'crosswind_kt'})
+        self.assertEqual(metar['relative_humidity'], 52.5)
+        self.assertEqual(metar['crosswind_kt'], 3.4)
+        del params['runway']
+        self.assertEqual(self.client.get('/metarapp/api/metars/', params).status_code, 400)
+
+    def test_invalid_fields(self):
+        self.client.login(username='api', password='password')
+        response = self.client.get('/metarapp/api/metars/', {'stations': 'RJTT', 'fields': 'password'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_near(self):
+        self.addCleanup(airport_function.invalidate_registry)
+        for station_id, latitude, longitude in [('RJTT', 35.55, 139.78), ('RJAA', 35.76, 140.39)]:
+            Airport.objects.create(
+                station_id=station_id,
+                register_date=timezone.localdate(),
+                is_fetched=True,
+                latitude=latitude,
+                longitude=longitude
+            )
+        self.client.login(username='api', password='password')
+        params = {'near': '35.6,139.8', 'radius_km': 20, 'start': self.start.isoformat(), 'fields': 'station_id'}
+        metars = self.client.get('/metarapp/api/metars/', params).json()['metars']
+        self.assertEqual({metar['station_id'] for metar in metars}, {'RJTT'})
+        params['radius_km'] = 100
+        metars = self.client.get('/metarapp/api/metars/', params).json()['metars']
+        self.assertEqual(len(metars), 10)
+        self.assertEqual(self.client.get('/metarapp/api/metars/', {'near': '95,0'}).status_code, 400)
+        self.assertEqual(self.client.get('/metarapp/api/metars/').status_code, 400)
+
+
+class IndexPageTests(TestCase):
+    def setUp(self):
+        self.day = timezone.localtime(timezone.now() - timedelta(days=30)) \
+            .replace(hour=0, minute=0, second=0, microsecond=0)
+        Metar.objects.bulk_create([
+            Metar(
+                raw_text='%s %02d%02d00Z 36010KT 9999 FEW030 20/10 Q1013' % (station_id, 1, i),
+                station_id=station_id,
+                observation_time=self.day + timedelta(hours=i),
+                temp_c=20.0,
+                dewpoint_c=10.0,
+                altim_in_hg=29.91
+            )
+            for station_id in ['RJTT', 'RJAA']
+            for i in range(4)
+        ])
+        User.objects.create_user('index', password='password')
+
+    def test_get_metar_page(self):
+        query = search_function.search_metar(['RJTT', 'RJAA'], self.day, self.day)
+        row_search = search_function.MetarRowSearch(['RJTT', 'RJAA'], self.day, self.day + timedelta(days=1))
+        for metars in (query, list(query), row_search):
+            assert_metar_pages(self, metars, 3)
+
+    @mock.patch('metarapp.views.INDEX_PAGE_SIZE', 3)
+    def test_index_pages(self):
+        self.client.login(username='index', password='password')
+        data = {'icao': 'RJTT,RJAA', 'search_date': self.day.strftime(r'%Y-%m-%d'), 'metar_order': 'asc'}
+        response = self.client.post('/metarapp/', data)
+        page = response.context['page']
+        self.assertEqual(len(response.context['outmetar']), 3)
+        self.assertEqual((page['number'], page['count'], page['total'], page['previous_url']), (1, 3, 8, None))
+        raw_texts = [metar.raw_text for metar in response.context['outmetar']]
+        while page['next_url']:
+            response = self.client.get('/metarapp/' + page['next_url'])
+            page = response.context['page']
+            raw_texts.extend(metar.raw_text for metar in response.context['outmetar'])
+        self.assertEqual(page['number'], 3)
+        self.assertEqual(len(set(raw_texts)), 8)
+        response = self.client.get('/metarapp/' + page['previous_url'])
+        self.assertEqual(response.context['page']['number'], 2)
+        self.assertEqual([metar.raw_text for metar in response.context['outmetar']], raw_texts[3:6])
+
+    @mock.patch('metarapp.views.CACHE_MAX_STATION_DAYS', 0)
+    def test_estimated_count(self):
+        rollup_function.rebuild_rollups(['RJTT', 'RJAA'])
+        self.client.login(username='index', password='password')
+        data = {'icao': 'RJTT,RJAA', 'search_date': self.day.strftime(r'%Y-%m-%d'), 'metar_order': 'desc'}
+        page = self.client.post('/metarapp/', data).context['page']
+        self.assertEqual((page['total'], page['is_estimated']), (8, True))
+
+    def test_csv_export(self):
+        self.client.login(username='index', password='password')
+        data = {
+            'icao': 'RJTT,RJAA',
+            'search_date': self.day.strftime(r'%Y-%m-%d'),
+            'metar_order': 'asc',
+            'submit_csv': '1'
+        }
+        # From the cache, and from the database with a server-side cursor.
+        for max_station_days in (93, 0):
+            with mock.patch('metarapp.views.CACHE_MAX_STATION_DAYS', max_station_days):
+                response = self.client.post('/metarapp/', data)
+            self.assertTrue(response.streaming)
+            self.assertEqual(response['Content-Type'], 'text/csv')
+            lines = b''.join(response.streaming_content).decode().splitlines()
+            self.assertEqual(lines[0].split(','), search_function.get_csv_field_names() + CSV_DERIVED_FIELDS)
+            self.assertEqual(len(lines), 9)
+            self.assertTrue(all(line.endswith(',52.5,VFR') for line in lines[1:]))
+
+    def test_csv_export_empty(self):
+        self.client.login(username='index', password='password')
+        for max_station_days in (93, 0):
+            with mock.patch('metarapp.views.CACHE_MAX_STATION_DAYS', max_station_days):
+                response = self.client.post('/metarapp/', {
+                    'icao': 'RJCC',
+                    'search_date': self.day.strftime(r'%Y-%m-%d'),
+                    'metar_order': 'asc',
+                    'submit_csv': '1'
+                })
+            lines = b''.join(response.streaming_content).decode().splitlines()
+            self.assertEqual(lines, [','.join(search_function.get_csv_field_names() + CSV_DERIVED_FIELDS)])
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('staff', password='password', is_staff=True)
+
+    def test_histogram(self):
+        histogram = metrics_function.Histogram('test_seconds', 'Test.', ('view',), (0.1, 1.0))
+        histogram.observe(0.1, 'a')
+        histogram.observe(0.5, 'a')
+        histogram.observe(2.0, 'a')
+        self.assertEqual(histogram.get('a'), (3, 2.6))
+        lines = histogram.render()
+        self.assertIn('test_seconds_bucket{view="a",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{view="a",le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_count{view="a"} 3', lines)
+
+    def test_metrics_staff_only(self):
+        User.objects.create_user('user', password='password')
+        self.client.login(username='user', password='password')
+        self.assertEqual(self.client.get('/metarapp/metrics/').status_code, 302)
+        self.client.login(username='staff', password='password')
+        self.client.get('/metarapp/api/summary/', {'stations': 'RJTT', 'start': '2021-01-01', 'end': '2021-01-01'})
+        response = self.client.get('/metarapp/metrics/')
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn('metar_request_duration_seconds_bucket{view="metarapp:api_summary",le="+Inf"}', text)
+        self.assertIn('metar_request_queries_count{view="metarapp:api_summary"}', text)
+        self.assertIn('metar_cache_hits_total', text)
+
+    @override_settings(METAR_SLOW_REQUEST_SECONDS=0, METAR_SLOW_REQUEST_SAMPLE_RATE=1)
+    def test_slow_request_log(self):
+        client = Client()
+        client.force_login(self.user)
+        with self.assertLogs('metarapp.middleware', 'WARNING') as logs:
+            client.get('/metarapp/api/summary/', {'stations': 'RJTT', 'start': '2021-01-01', 'end': '2021-01-01'})
+        self.assertIn('metarapp:api_summary', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+    def test_http_time(self):
+        record = metrics_function.start_record()
+        try:
+            with self.assertRaises(ValueError), metrics_function.time_http(record):
+                raise ValueError
+            with metrics_function.time_http(record, 0):
+                pass
+        finally:
+            metrics_function.end_record()
+        self.assertEqual(record.http_count, 1)
+        self.assertGreater(record.http_time, 0)
+
+    def test_stage_seconds(self):
+        count, _ = metrics_function.stage_seconds.get('insert')
+        with metrics_function.time_stage('insert'):
+            pass
+        self.assertEqual(metrics_function.stage_seconds.get('insert')[0], count + 1)
+
+
+class DecodeFunctionTests(SimpleTestCase):
+    def test_decode(self):
+        decoded = decode_function.decode(
+            'RJTT 180030Z 34012G25KT 300V020 9999 -SHRA FEW020 BKN030CB 18/M02 Q1013 NOSIG RMK 1CU020'
+        )
+        self.assertEqual(decoded.station_id, 'RJTT')
+        self.assertEqual((decoded.day, decoded.hour, decoded.minute), (18, 0, 30))
+        self.assertEqual((decoded.wind_dir_degrees, decoded.wind_speed_kt, decoded.wind_gust_kt), (340, 12, 25))
+        self.assertEqual((decoded.wind_var_from, decoded.wind_var_to), (300, 20))
+        self.assertEqual(decoded.visibility_m, 9999)
+        self.assertEqual(decoded.weather, ['-SHRA'])
+        self.assertEqual(decoded.clouds, [('FEW', 2000, None), ('BKN', 3000, 'CB')])
+        self.assertEqual(decoded.cloud_ceiling, 3000)
+        self.assertEqual((decoded.temp_c, decoded.dewpoint_c), (18.0, -2.0))
+        self.assertEqual(decoded.altim_in_hg, 29.91)
+        self.assertEqual(decoded.remarks, '1CU020')
+
+    def test_decode_statute_mile(self):
+        decoded = decode_function.decode('SPECI KJFK 180051Z AUTO VRB03KT 1 1/2SM BR VV004 M02/M03 A2992 RMK AO2')
+        self.assertEqual(decoded.metar_type, 'SPECI')
+        self.assertTrue(decoded.auto)
+        self.assertIsNone(decoded.wind_dir_degrees)
+        self.assertEqual(decoded.visibility_m, 2414)
+        self.assertEqual(decoded.vert_vis_ft, 400)
+        self.assertEqual(decoded.altim_in_hg, 29.92)
+        # The fraction right after the station id.
+        self.assertEqual(decode_function.decode('KJFK 1/2SM').visibility_m, 805)
+
+    def test_decode_many(self):
+        decoded_list = decode_function.decode_many([
+            'RJBB 180000Z 00000KT CAVOK 22/10 Q1020',
+            'RJAA 180000Z 05020MPS 0800 FG'
+        ])
+        self.assertTrue(decoded_list[0].cavok)
+        self.assertEqual(decoded_list[0].visibility_m, 9999)
+        self.assertEqual(decoded_list[1].wind_speed_kt, 39)
+        self.assertEqual(decoded_list[1].wx_string, 'FG')
+
+
+class StreamTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('user', password='password')
+        time = timezone.now().replace(minute=0, second=0, microsecond=0)
+        writer_function.insert_metars([
+            Metar(
+                raw_text='%s 010000Z 36010KT 9999 FEW030 20/10 Q1013' % station_id,
+                station_id=station_id,
+                observation_time=time,
+                temp_c=20.0,
+                dewpoint_c=10.0,
+                altim_in_hg=29.91
+            )
+            for station_id in ('RJTT', 'RJAA')
+        ])
+
+    def request(self, query_string, headers, live_rows=None):
+        """Request the stream app until the client disconnects after 0.1 s.
+
+        If live_rows is given, the replayed rows are also published to the
+        broker with the rows which live_rows returns for them.
+        """
+        messages = []
+
+        async def receive():
+            await asyncio.sleep(0.1)
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            broker = stream_function.get_broker()
+            load_rows_after = stream_function.load_rows_after
+
+            def load_and_publish(*args, **kwargs):
+                rows = load_rows_after(*args, **kwargs)
+                loop.call_soon_threadsafe(broker.publish, live_rows(rows))
+                return rows
+            scope = {
+                'type': 'http',
+                'method': 'GET',
+                'path': streaming.STREAM_PATH,
+                'query_string': query_string.encode(),
+                'headers': [(name.encode(), value.encode()) for name, value in headers.items()]
+            }
+            try:
+                if live_rows is None:
+                    await streaming.route(None)(scope, receive, send)
+                else:
+                    with mock.patch.object(stream_function, 'load_rows_after', load_and_publish):
+                        await streaming.route(None)(scope, receive, send)
+            finally:
+                broker.close()
+
+        async_to_sync(run)()
+        body = b''.join(message.get('body', b'') for message in messages).decode()
+        return messages[0]['status'], body
+
+    def test_broker(self):
+        async def run():
+            broker = stream_function.MetarBroker(queue_size=1, poll_seconds=60)
+            subscription = broker.subscribe(['RJTT'])
+            try:
+                self.assertTrue(broker.feeding)
+                self.assertEqual(broker.publish([{'station_id': 'RJTT', 'id': 1}, {'station_id': 'RJAA', 'id': 2}]), 1)
+                self.assertEqual(await subscription.get(), {'station_id': 'RJTT', 'id': 1})
+                broker.publish([{'station_id': 'RJTT', 'id': 3}, {'station_id': 'RJTT', 'id': 4}])
+                self.assertTrue(subscription.overflowed)
+                broker.unsubscribe(subscription)
+                self.assertEqual(broker.subscriber_count, 0)
+                self.assertFalse(broker.feeding)
+            finally:
+                broker.close()
+        async_to_sync(run)()
+
+    def test_stream(self):
+        self.assertEqual(self.request('stations=RJTT', {})[0], 401)
+        self.client.login(username='user', password='password')
+        cookie = '%s=%s' % (settings.SESSION_COOKIE_NAME, self.client.session.session_key)
+        self.assertEqual(self.request('stations=RJ', {'cookie': cookie})[0], 400)
+        status, body = self.request('stations=rjtt', {'cookie': cookie, 'last-event-id': '0'})
+        self.assertEqual(status, 200)
+        metar = Metar.objects.get(station_id='RJTT')
+        self.assertIn('event: metar\nid: %d\ndata: ' % metar.id, body)
+        self.assertNotIn('RJAA', body)
+
+    @override_settings(METAR_STREAM_QUEUE_SIZE=1)
+    def test_replay_pages(self):
+        self.client.login(username='user', password='password')
+        cookie = '%s=%s' % (settings.SESSION_COOKIE_NAME, self.client.session.session_key)
+        status, body = self.request('stations=RJTT,RJAA', {'cookie': cookie, 'last-event-id': '0'})
+        self.assertEqual(status, 200)
+        for metar in Metar.objects.all():
+            self.assertIn('id: %d\n' % metar.id, body)
+
+    def test_replay_deduplicates_live_rows(self):
+        self.client.login(username='user', password='password')
+        cookie = '%s=%s' % (settings.SESSION_COOKIE_NAME, self.client.session.session_key)
+        corrected = []
+
+        def live_rows(rows):
+            # The same rows, and a correction of the first row.
+            if rows and not corrected:
+                corrected.append(dict(rows[0], raw_text=rows[0]['raw_text'] + ' RMK COR'))
+                return rows + corrected
+            return rows
+        status, body = self.request('stations=RJTT,RJAA', {'cookie': cookie, 'last-event-id': '0'}, live_rows)
+        self.assertEqual(status, 200)
+        for metar in Metar.objects.all():
+            self.assertEqual(body.count('id: %d\n' % metar.id), 2 if metar.id == corrected[0]['id'] else 1)
+        self.assertEqual(body.count('RMK COR'), 1)
+
+    def test_load_new_rows(self):
+        ids = sorted(Metar.objects.values_list('id', flat=True))
+        self.assertEqual(stream_function.load_new_rows(['RJTT', 'RJAA'], None), ([], ids[-1]))
+        rows, last_id = stream_function.load_new_rows(['RJTT', 'RJAA'], 0, limit=1)
+        self.assertEqual(([row['id'] for row in rows], last_id), ([ids[0]], ids[0]))
+        rows, last_id = stream_function.load_new_rows(['RJTT', 'RJAA'], last_id, limit=1)
+        self.assertEqual(([row['id'] for row in rows], last_id), ([ids[1]], ids[1]))
+        self.assertEqual(stream_function.load_new_rows(['RJTT', 'RJAA'], last_id, limit=1), ([], ids[1]))
+
+    def test_asgi_routes(self):
+        application = import_module('metar_server.asgi').application
+
+        def request(scope):
+            messages = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b''}
+
+            async def send(message):
+                messages.append(message)
+            async_to_sync(application)(scope, receive, send)
+            return messages
+        self.assertEqual(request({'type': 'lifespan'}), [])
+        scope = {
+            'type': 'http', 'http_version': '1.1', 'method': 'GET', 'path': streaming.STREAM_PATH,
+            'query_string': b'stations=RJTT', 'headers': [(b'host', b'testserver')]
+        }
+        self.assertEqual(request(scope)[0]['status'], 401)
+        messages = request(dict(scope, path='/metarapp/', query_string=b''))
+        self.assertEqual(messages[0]['status'], 302)
+        self.assertIn((b'Location', b'/metarapp/login?next=/metarapp/'), messages[0]['headers'])
+
+
+class LatestFunctionTests(TestCase):
+    def setUp(self):
+        self.time = timezone.now().replace(minute=0, second=0, microsecond=0)
+        self.user = User.objects.create_user('user', password='password')
+        writer_function.insert_metars([
+            self.create_metar('RJTT', self.time - timedelta(hours=1)),
+            self.create_metar('RJTT', self.time),
+            self.create_metar('RJAA', self.time)
+        ])
+        airport_function.update_station_status(list(Metar.objects.all()))
+        latest_function.reset_store()
+        self.addCleanup(latest_function.reset_store)
+
+    def create_metar(self, station_id, observation_time, raw_text=None):
+        return Metar(
+            raw_text=raw_text or '%s %02d%02d00Z 36010KT 9999 FEW030 20/10 Q1013' % (
+                station_id, observation_time.day, observation_time.hour
+            ),
+            station_id=station_id,
+            observation_time=observation_time,
+            temp_c=20.0,
+            dewpoint_c=10.0,
+            altim_in_hg=29.91
+        )
+
+    def test_store(self):
+        with self.assertNumQueries(1):
+            store = latest_function.get_store()
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.get('RJTT').observation_time, self.time)
+        with self.assertRaises(AttributeError):
+            store.get('RJTT').extra = 1
+        corrected = self.create_metar('RJTT', self.time, 'RJTT 010000Z COR 36010KT 9999 FEW030 21/10 Q1013')
+        writer_function.get_writer('correction').write([corrected])
+        stale = self.create_metar('RJAA', self.time - timedelta(hours=1))
+        self.assertEqual(store.update_metars([corrected, stale]), 1)
+        self.assertEqual(store.get('RJTT').raw_text, corrected.raw_text)
+        # Written by another process without the signal.
+        self.create_metar('RJAA', self.time + timedelta(hours=1), 'RJAA NEW').save()
+        self.assertEqual(store.refresh(), 1)
+        self.assertEqual(store.get('RJAA').raw_text, 'RJAA NEW')
+
+    def test_api_latest(self):
+        self.assertEqual(self.client.get('/metarapp/api/latest/').status_code, 401)
+        self.client.login(username='user', password='password')
+        metars = self.client.get('/metarapp/api/latest/').json()['metars']
+        self.assertEqual([metar['station_id'] for metar in metars], ['RJAA', 'RJTT'])
+        result = writer_function.get_writer().write([self.create_metar('RJTT', self.time + timedelta(hours=1))])
+        metars_inserted.send(sender=Metar, metars=result.written)
+        with CaptureQueriesContext(connection) as context:
+            metars = self.client.get('/metarapp/api/latest/', {'stations': 'RJTT'}).json()['metars']
+        self.assertFalse([query for query in context.captured_queries if 'metarapp_' in query['sql']])
+        self.assertEqual(metars[0]['observation_time'], (self.time + timedelta(hours=1)).isoformat()[:-6] + 'Z')
+        self.assertEqual(self.client.get('/metarapp/api/latest/', {'stations': 'RJ'}).status_code, 400)
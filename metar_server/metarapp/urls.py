@@ -6,4 +6,11 @@ urlpatterns = [
     path('', views.index, name='index'),
     path('login/', views.Login.as_view(), name='login'),
     path('logout/', views.logout, name='logout'),
+    path('conditions/', views.conditions, name='conditions'),
+    path('api/metars/', views.api_metars, name='api_metars'),
+    path('api/summary/', views.api_summary, name='api_summary'),
+    path('api/latest/', views.api_latest, name='api_latest'),
+    path('api/chart/', views.api_chart, name='api_chart'),
+    path('api/conditions/', views.api_conditions, name='api_conditions'),
+    path('metrics/', views.metrics, name='metrics'),
 ]
@@ -1,51 +1,295 @@
 import csv
+import math
+from datetime import date, timedelta
+from functools import wraps
+from operator import attrgetter
+from typing import Iterable, Iterator, List, Tuple
+from urllib.parse import urlencode
 from django.shortcuts import render
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.views import LoginView, logout_then_login
-from django.http import HttpRequest, HttpResponse
-from django.db.models.query import QuerySet
-from datetime import timedelta
-from .forms import MyLoginForm, MetarAppForm
-from .models import Metar
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpRequest, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET
+from .forms import (
+    MyLoginForm, MetarAppForm, MetarApiForm, MetarChartForm, MetarConditionForm, MetarLatestForm, MetarSummaryForm
+)
+from .myfunction import (
+    analytics_function, cache_function, chart_function, condition_function, latest_function, metrics_function,
+    rollup_function, search_function
+)
+
+CSV_CHUNK_SIZE = 2000
+# Derived quantities added to the CSV files.
+CSV_DERIVED_FIELDS = ['relative_humidity', 'flight_category']
+NDJSON_CHUNK_SIZE = 2000
+# Searches over more station-days than this are not cached.
+CACHE_MAX_STATION_DAYS = 93
+INDEX_PAGE_SIZE = 200
 
 
 @login_required(login_url='/metarapp/login')
 def index(request: HttpRequest):
+    """Search METARs of the stations between the local days.
+
+    The form is posted, and the other pages are read by GET with the same
+    inputs and the cursor 'after' or 'before'. A page has INDEX_PAGE_SIZE
+    METARs, and the total is estimated from the daily rollups unless the
+    METARs are read from the cache.
+    """
     params = {
         'user_name': request.user.username,
         'icao': '',
         'getdate': '',
         'form': MetarAppForm(),
-        'outmetar': ''
+        'outmetar': '',
+        'page': None
     }
-    if (request.method == 'POST'):
-        form_post = MetarAppForm(request.POST)
-        if not form_post.is_valid():
-            params['form'] = form_post
-            return render(request, 'metarapp/index.html', params)
-        # POST data is "YYYY-MM-DD" format (no time string).
-        # Therefore, time of start_datetime is 0:00 (local timezone).
-        start_datetime = form_post.cleaned_data['search_date']
-        end_datetime = start_datetime + timedelta(hours=23, minutes=59)
-        params['icao'] = request.POST['icao']
-        params['getdate'] = request.POST['search_date']
+    if request.method == 'POST':
+        data = request.POST
+    elif 'icao' in request.GET:
+        data = request.GET
+    else:
+        return render(request, 'metarapp/index.html', params)
+    form_post = MetarAppForm(data)
+    if not form_post.is_valid():
         params['form'] = form_post
-        metar_return = Metar.objects \
-            .filter(
-                station_id=request.POST['icao'],
-                observation_time__range=(start_datetime, end_datetime),
-            ) \
-            .order_by('observation_time')
-        if request.POST['metar_order'] == 'desc':
-            params['outmetar'] = metar_return.reverse()
-        else:
-            params['outmetar'] = metar_return
+        return render(request, 'metarapp/index.html', params)
+    # The dates are "YYYY-MM-DD" format (no time string).
+    # Therefore, time of start_date and end_date is 0:00 (local timezone).
+    stations = form_post.cleaned_data['stations']
+    start_date = form_post.cleaned_data['search_date']
+    end_date = form_post.cleaned_data['end_date']
+    params['icao'] = ', '.join(stations)
+    params['getdate'] = start_date.strftime(r'%Y-%m-%d')
+    if end_date != start_date:
+        params['getdate'] += ' - ' + end_date.strftime(r'%Y-%m-%d')
+    params['form'] = form_post
+    station_days = len(stations) * ((end_date - start_date).days + 1)
+    metar_return = None
+    if station_days <= CACHE_MAX_STATION_DAYS:
+        metar_return = cache_function.get_cached_metars(stations, start_date, end_date)
 
-        if 'submit_csv' in request.POST:
-            return _create_csv_response(metar_return)
+    if request.method == 'POST' and 'submit_csv' in request.POST:
+        field_names = search_function.get_csv_field_names()
+        if metar_return is not None:
+            rows = map(attrgetter(*field_names), metar_return)
+        else:
+            end_time = end_date + timedelta(days=1)
+            rows = search_function.iter_metar_rows(stations, start_date, end_time, field_names)
+        return _create_csv_response(field_names, rows)
+    if metar_return is None:
+        metar_return = search_function.search_metar_all(stations, start_date, end_date)
+    params['outmetar'], params['page'] = _get_index_page(
+        data,
+        form_post.cleaned_data,
+        metar_return,
+        start_date.date(),
+        end_date.date()
+    )
     return render(request, 'metarapp/index.html', params)
 
 
+@login_required(login_url='/metarapp/login')
+def conditions(request: HttpRequest):
+    """Search METARs of all stations or the given stations by the
+    conditions of the decoded fields, the weather and the flight category.
+    The next page is read with the same inputs and the cursor 'after'. The
+    archived months are not searched.
+    """
+    params = {
+        'user_name': request.user.username,
+        'form': MetarConditionForm(),
+        'outmetar': [],
+        'next_url': None
+    }
+    if not request.GET:
+        return render(request, 'metarapp/conditions.html', params)
+    form = MetarConditionForm(request.GET)
+    params['form'] = form
+    if not form.is_valid():
+        return render(request, 'metarapp/conditions.html', params)
+    params['outmetar'], next_cursor = _search_conditions(form.cleaned_data, ['station_id', 'raw_text'])
+    if next_cursor is not None:
+        query = request.GET.copy()
+        query['after'] = next_cursor
+        params['next_url'] = '?' + query.urlencode()
+    return render(request, 'metarapp/conditions.html', params)
+
+
+def api_login_required(view):
+    """Decorator of API views returning 401 to anonymous users instead of
+    redirecting to the login page.
+    """
+    @wraps(view)
+    def wrapped_view(request: HttpRequest, *args, **kwargs) -> HttpResponse:
+        if not request.user.is_authenticated:
+            return JsonResponse({'error': 'Authentication required.'}, status=401)
+        return view(request, *args, **kwargs)
+    return wrapped_view
+
+
+@require_GET
+@api_login_required
+def api_metars(request: HttpRequest) -> HttpResponse:
+    """Read METARs as JSON pages or streamed NDJSON.
+
+    Query parameters are 'stations' (comma-separated), 'start', 'end',
+    'fields' (comma-separated), 'limit', 'after' and 'format'. A JSON page
+    has 'metars' and the cursor 'next' to be given as 'after' for the next
+    page ('next' is null at the last page). NDJSON is one METAR per line
+    until 'limit' or the end of the range. Every METAR has 'id'.
+    'near' ('latitude,longitude') and 'radius_km' select the airports around
+    the point from the registry in addition to 'stations'.
+
+    'derived' adds the quantities of analytics_function.DERIVED_FIELDS,
+    with 'runway' for the wind components and 'elevation_ft' for the
+    pressure altitude.
+    """
+    form = MetarApiForm(search_function.get_csv_field_names(), request.GET)
+    if not form.is_valid():
+        return JsonResponse({'error': form.errors.get_json_data()}, status=400)
+    query = search_function.search_metar_range(
+        form.cleaned_data['stations'],
+        form.cleaned_data['start'],
+        form.cleaned_data['end'],
+        form.cleaned_data['after']
+    )
+    field_names = ['id'] + [name for name in form.cleaned_data['fields'] if name != 'id']
+    derived_names = form.cleaned_data['derived']
+    # The fields for the derived quantities are read but not written.
+    query_fields = field_names + [
+        name for name in analytics_function.get_source_fields(derived_names) if name not in field_names
+    ]
+    derived_start = len(query_fields)
+    output_indexes = list(range(len(field_names))) + list(range(derived_start, derived_start + len(derived_names)))
+    output_names = field_names + derived_names
+    limit = form.cleaned_data['limit']
+    if form.cleaned_data['format'] == 'ndjson':
+        if limit is not None:
+            query = query[:limit]
+        rows = query.values_list(*query_fields).iterator(chunk_size=NDJSON_CHUNK_SIZE)
+        rows = _add_derived(rows, query_fields, derived_names, form.cleaned_data)
+        return StreamingHttpResponse(
+            _iter_ndjson_lines(output_names, (tuple(row[i] for i in output_indexes) for row in rows)),
+            content_type='application/x-ndjson'
+        )
+
+    limit = limit or MetarApiForm.DEFAULT_LIMIT
+    # The keys of the last row are always read for the cursor.
+    rows = list(query.values_list(*query_fields, 'observation_time')[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = search_function.encode_cursor(rows[-1][len(query_fields)], rows[-1][0])
+    rows = [row[:len(query_fields)] for row in rows]
+    metars = [
+        dict(zip(output_names, (row[i] for i in output_indexes)))
+        for row in _add_derived(rows, query_fields, derived_names, form.cleaned_data)
+    ]
+    return JsonResponse({'metars': metars, 'next': next_cursor})
+
+
+@require_GET
+@api_login_required
+def api_summary(request: HttpRequest) -> HttpResponse:
+    """Read statistics of the stations from the daily rollups.
+
+    Query parameters are 'stations' (comma-separated), 'start' and 'end'
+    (local days) and 'period' ('total', 'year', 'month' or 'day').
+    """
+    form = MetarSummaryForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'error': form.errors.get_json_data()}, status=400)
+    summary_list = rollup_function.summarize(
+        form.cleaned_data['stations'],
+        form.cleaned_data['start'],
+        form.cleaned_data['end'],
+        form.cleaned_data['period']
+    )
+    return JsonResponse({'summaries': summary_list})
+
+
+@require_GET
+@api_login_required
+def api_chart(request: HttpRequest) -> HttpResponse:
+    """Read the series of a station downsampled for the charts.
+
+    Query parameters are 'station', 'start', 'end', 'fields'
+    (comma-separated keys of chart_function.CHART_FIELDS), 'points' and
+    'method' ('minmax' or 'lttb').
+    """
+    form = MetarChartForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'error': form.errors.get_json_data()}, status=400)
+    chart = chart_function.get_chart(
+        form.cleaned_data['station'],
+        form.cleaned_data['start'],
+        form.cleaned_data['end'],
+        form.cleaned_data['fields'],
+        form.cleaned_data['points'],
+        form.cleaned_data['method']
+    )
+    return JsonResponse(chart)
+
+
+@require_GET
+@api_login_required
+def api_latest(request: HttpRequest) -> HttpResponse:
+    """Read the latest METAR of each station from the store in memory.
+
+    The query parameter is 'stations' (comma-separated), all stations if it
+    is not given.
+    """
+    form = MetarLatestForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'error': form.errors.get_json_data()}, status=400)
+    return HttpResponse(
+        latest_function.get_store().get_json(form.cleaned_data['stations']),
+        content_type='application/json'
+    )
+
+
+@require_GET
+@api_login_required
+def api_conditions(request: HttpRequest) -> HttpResponse:
+    """Search METARs by the conditions as JSON pages.
+
+    Query parameters are 'stations' (comma-separated, all stations if it is
+    not given), 'start', 'end', '<field>_min' and '<field>_max' of
+    condition_function.RANGE_FIELDS, 'wx' (comma-separated weather codes
+    like TS, FG and SN), 'category' (the minimum flight category), 'limit'
+    and 'after'. A page has 'metars' with 'id' and 'flight_category', and
+    the cursor 'next' like api_metars. The archived months are not
+    searched.
+    """
+    form = MetarConditionForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'error': form.errors.get_json_data()}, status=400)
+    field_names = ['id'] + search_function.get_csv_field_names() + ['flight_category']
+    metars, next_cursor = _search_conditions(form.cleaned_data, field_names)
+    for metar in metars:
+        metar['flight_category'] = analytics_function.FLIGHT_CATEGORIES[metar['flight_category']]
+    return JsonResponse({'metars': metars, 'next': next_cursor})
+
+
+@require_GET
+@staff_member_required
+def metrics(request: HttpRequest) -> HttpResponse:
+    """Metrics of this process in Prometheus text format for staff users.
+    """
+    cache_stats = cache_function.stats.as_dict()
+    counters = {
+        'metar_cache_%s_total' % name: ('Station-days of the METAR cache (%s).' % name, value)
+        for name, value in cache_stats.items()
+    }
+    return HttpResponse(
+        metrics_function.render_prometheus(counters),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
+
+
 def logout(request):
     return logout_then_login(request=request, login_url='/metarapp/login')
 
@@ -55,12 +299,131 @@ class Login(LoginView):
     template_name = 'metarapp/login.html'
 
 
-def _create_csv_response(query: QuerySet) -> HttpResponse:
-    response = HttpResponse(content_type='text/csv')
+class _Echo():
+    """File-like object which returns the written value for csv.writer.
+    """
+    def write(self, value: str) -> str:
+        return value
+
+
+def _get_index_page(data, cleaned_data: dict, metars, first_day: date, last_day: date) -> Tuple[list, dict]:
+    """Get the page of the index view and the information of the pages.
+
+    A broken cursor is ignored and the first page is shown.
+    """
+    cursor = data.get('after') or data.get('before')
+    backward = not data.get('after') and bool(data.get('before'))
+    key = None
+    if cursor:
+        try:
+            key = search_function.decode_page_cursor(cursor)
+        except ValueError:
+            backward = False
+    try:
+        number = max(int(data.get('page', 1)), 1) if key is not None else 1
+    except ValueError:
+        number = 1
+    descending = cleaned_data['metar_order'] == 'desc'
+    page, has_more = search_function.get_metar_page(metars, INDEX_PAGE_SIZE, key, descending, backward)
+    has_next = has_more if not backward else True
+    has_previous = key is not None if not backward else has_more
+    if isinstance(metars, list):
+        total, is_estimated = len(metars), False
+    else:
+        total = rollup_function.estimate_count(cleaned_data['stations'], first_day, last_day)
+        is_estimated = True
+    query = {
+        'icao': ','.join(cleaned_data['stations']),
+        'search_date': first_day.strftime(r'%Y-%m-%d'),
+        'end_date': last_day.strftime(r'%Y-%m-%d'),
+        'metar_order': cleaned_data['metar_order']
+    }
+    page_info = {
+        'number': number,
+        'count': None if total is None else max(math.ceil(total / INDEX_PAGE_SIZE), number),
+        'total': total,
+        'is_estimated': is_estimated,
+        'next_url': None,
+        'previous_url': None
+    }
+    if page and has_next:
+        page_info['next_url'] = '?' + urlencode(dict(
+            query, after=search_function.encode_page_cursor(page[-1]), page=number + 1
+        ))
+    if page and has_previous:
+        page_info['previous_url'] = '?' + urlencode(dict(
+            query, before=search_function.encode_page_cursor(page[0]), page=max(number - 1, 1)
+        ))
+    return page, page_info
+
+
+def _search_conditions(cleaned_data: dict, field_names: List[str]) -> Tuple[List[dict], str]:
+    """Read a page of the condition search as dicts of the fields, and the
+    cursor of the next page (None at the last page).
+    """
+    query = condition_function.search_conditions(
+        cleaned_data['stations'],
+        cleaned_data['start'],
+        cleaned_data['end'],
+        cleaned_data['ranges'],
+        cleaned_data['wx'],
+        cleaned_data['category'],
+        cleaned_data['after']
+    )
+    limit = cleaned_data['limit']
+    # The keys of the last row are always read for the cursor.
+    rows = list(query.values_list(*field_names, 'observation_time', 'id')[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = search_function.encode_cursor(rows[-1][-2], rows[-1][-1])
+    return [dict(zip(field_names, row)) for row in rows], next_cursor
+
+
+def _create_csv_response(field_names: List[str], rows: Iterable[tuple]) -> StreamingHttpResponse:
+    """Create CSV response streaming the rows.
+
+    The rows are written while they are read, so the memory does not grow
+    with the number of the rows when they are read with a server-side
+    cursor. CSV_DERIVED_FIELDS are computed by chunks of the rows.
+
+    Args:
+        field_names (List[str]): Field names of the rows.
+        rows (Iterable[tuple]): Rows of the fields.
+
+    Returns:
+        StreamingHttpResponse: Response of the CSV file.
+    """
+    writer = csv.writer(_Echo())
+    rows = analytics_function.iter_derived_rows(rows, field_names, CSV_DERIVED_FIELDS, CSV_CHUNK_SIZE)
+    response = StreamingHttpResponse(
+        _iter_csv_lines(writer, field_names + CSV_DERIVED_FIELDS, rows),
+        content_type='text/csv'
+    )
     response['Content-Disposition'] = 'attachment; filename="metar.csv"'
-    writer = csv.writer(response)
-    field_names = list(query.values()[0].keys())[1:]
-    writer.writerow(field_names)
-    for record in query.values_list():
-        writer.writerow(list(record)[1:])
     return response
+
+
+def _iter_csv_lines(writer, field_names: List[str], rows: Iterable[tuple]) -> Iterator[str]:
+    yield writer.writerow(field_names)
+    for record in rows:
+        yield writer.writerow(record)
+
+
+def _add_derived(rows: Iterable[tuple], field_names: List[str], derived_names: List[str], cleaned_data: dict):
+    if not derived_names:
+        return rows
+    return analytics_function.iter_derived_rows(
+        rows,
+        field_names,
+        derived_names,
+        NDJSON_CHUNK_SIZE,
+        cleaned_data['runway'],
+        cleaned_data['elevation_ft']
+    )
+
+
+def _iter_ndjson_lines(field_names: List[str], rows: Iterable[tuple]) -> Iterator[str]:
+    encoder = DjangoJSONEncoder()
+    for record in rows:
+        yield encoder.encode(dict(zip(field_names, record))) + '\n'